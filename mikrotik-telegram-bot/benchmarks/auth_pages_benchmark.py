@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Render benchmark for the device authorization pages of claude-relay-node.py
+
+Compares re-parsing the templates on every request (what render_template_string
+did) with the precompiled templates and the pre-rendered static pages.
+
+Usage:
+    python3 benchmarks/auth_pages_benchmark.py [iterations]
+"""
+
+import importlib.util
+import os
+import sys
+import timeit
+
+from jinja2 import DictLoader, Environment
+
+NODE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'claude-relay-node.py')
+
+
+def load_node():
+    """Import claude-relay-node.py (the hyphenated file name rules out a plain import)."""
+    spec = importlib.util.spec_from_file_location('claude_relay_node', NODE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def report(label: str, seconds: float, iterations: int, baseline: float = None):
+    per_call = seconds / iterations * 1e6
+    speedup = f"  ({baseline / seconds:.0f}x)" if baseline else ""
+    print(f"  {label:<34} {per_call:9.1f} us/render{speedup}")
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    node = load_node()
+    pages = node.auth_pages
+    context = {"router_identity": "core-router", "router_id": "core-router"}
+    
+    # cache_size=0: every get_template() parses and compiles again, like render_template_string
+    uncached = Environment(loader=DictLoader(node.AUTH_PAGE_TEMPLATES), autoescape=True, cache_size=0)
+    
+    print(f"Device authorization pages, {iterations} renders each\n")
+    for name, static_name in (("form.html", None), ("invalid_code.html", "invalid_code")):
+        print(name)
+        parsed = timeit.timeit(lambda: uncached.get_template(name).render(css_url=pages.css_url, **context), number=iterations)
+        report("parse + render per request", parsed, iterations)
+        compiled = timeit.timeit(lambda: pages.render(name, **context), number=iterations)
+        report("precompiled template", compiled, iterations, parsed)
+        if static_name:
+            static = timeit.timeit(lambda: pages.static_page(static_name, 404), number=iterations)
+            report("pre-rendered static page", static, iterations, parsed)
+        print()
+    
+    client = node.app.test_client()
+    elapsed = timeit.timeit(lambda: client.get('/auth/unknown-code'), number=iterations)
+    print(f"GET /auth/<invalid code> through Flask: {iterations / elapsed:,.0f} requests/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Prompt retrieval benchmark for claude-relay-node.py
+
+Grows the knowledge base with generated operations and examples (about 400
+entries on top of claude-relay-knowledge.json), then compares the full
+system prompt with prompt retrieval: prompt size, time to build the prompt,
+and how often the entry that answers a request makes it into the prompt.
+With --live every tenth query is also sent to the configured LLM backend
+(CLAUDE_API_KEY etc.) in both modes to compare latency and answers.
+
+Usage:
+    python3 benchmarks/prompt_retrieval_benchmark.py [iterations] [--live]
+"""
+
+import importlib.util
+import json
+import os
+import sys
+import time
+import timeit
+
+NODE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'claude-relay-node.py')
+KNOWLEDGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'claude-relay-knowledge.json')
+
+# (menu name, RouterOS path)
+MENUS = [
+    ("interface", "/interface"), ("bridge port", "/interface bridge port"), ("vlan", "/interface vlan"),
+    ("ip address", "/ip address"), ("ip route", "/ip route"), ("dhcp lease", "/ip dhcp-server lease"),
+    ("dhcp server", "/ip dhcp-server"), ("dhcp client", "/ip dhcp-client"), ("dns static entry", "/ip dns static"),
+    ("firewall filter rule", "/ip firewall filter"), ("nat rule", "/ip firewall nat"),
+    ("mangle rule", "/ip firewall mangle"), ("address list entry", "/ip firewall address-list"),
+    ("arp entry", "/ip arp"), ("ip pool", "/ip pool"), ("hotspot user", "/ip hotspot user"),
+    ("hotspot session", "/ip hotspot active"), ("ppp secret", "/ppp secret"), ("ppp connection", "/ppp active"),
+    ("wireless client", "/interface wireless registration-table"),
+    ("capsman client", "/caps-man registration-table"), ("simple queue", "/queue simple"),
+    ("queue tree", "/queue tree"), ("user", "/user"), ("user session", "/user active"),
+    ("scheduler task", "/system scheduler"), ("script", "/system script"), ("ntp server", "/system ntp client"),
+    ("ospf neighbor", "/routing ospf neighbor"), ("bgp session", "/routing bgp session"),
+    ("ipv6 address", "/ipv6 address"), ("ipv6 route", "/ipv6 route"), ("wireguard peer", "/interface wireguard peers"),
+    ("ipsec peer", "/ip ipsec peer"), ("snmp community", "/snmp community"), ("certificate", "/certificate"),
+    ("netwatch host", "/tool netwatch"), ("ip service", "/ip service"), ("neighbor", "/ip neighbor"),
+    ("package", "/system package"),
+]
+
+# (operation prefix, command suffix, example phrasing, query phrasing)
+VERBS = [
+    ("show", "print", "list all {m}s", "show {m}s"),
+    ("count", "print count-only", "how many {m}s are there", "count {m}s"),
+    ("export", "export", "export the {m} configuration", "export {m}s"),
+    ("show_disabled", "print where disabled", "which {m}s are disabled", "list disabled {m}s"),
+    ("detail", "print detail", "{m} details", "show {m} detail"),
+]
+
+
+def load_node():
+    """Import claude-relay-node.py (the hyphenated file name rules out a plain import)."""
+    spec = importlib.util.spec_from_file_location('claude_relay_node', NODE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def build_knowledge():
+    """Return the shipped knowledge base grown with generated entries, and (query, command) pairs."""
+    with open(KNOWLEDGE_PATH, 'r', encoding='utf-8') as f:
+        knowledge = json.load(f)
+    queries = []
+    for menu, path in MENUS:
+        for prefix, suffix, example, query in VERBS:
+            command = f"{path} {suffix}"
+            knowledge["common_operations"][f"{prefix}_{menu.replace(' ', '_')}"] = command
+            knowledge["context_examples"].append({"input": example.format(m=menu), "output": command})
+            queries.append((query.format(m=menu), command))
+    return knowledge, queries
+
+
+def retrieved(message: str, command: str) -> bool:
+    return f": {command}\n" in message or f"Output: {command}\n" in message
+
+
+def report(label: str, seconds: float, iterations: int):
+    print(f"  {label:<34} {seconds / iterations * 1e6:9.1f} us/request")
+
+
+# Every LIVE_SAMPLE-th query is sent upstream with --live
+LIVE_SAMPLE = 10
+
+
+def run_live(node, queries, retriever):
+    """Send the queries to the LLM backend with and without retrieval."""
+    for label, min_entries in (("full prompt", 0), ("prompt retrieval", 1)):
+        retriever.min_entries = min_entries
+        correct, elapsed = 0, 0.0
+        for query, command in queries:
+            started = time.perf_counter()
+            answer = node.call_claude_api(node.build_translation_message(query))
+            elapsed += time.perf_counter() - started
+            correct += (answer or "").strip() == command
+        print(f"  {label:<34} {elapsed / len(queries) * 1000:7.0f} ms/call  "
+              f"exact answers {correct}/{len(queries)}")
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    iterations = int(args[0]) if args else 200
+    node = load_node()
+    knowledge, queries = build_knowledge()
+    retriever = node.prompt_retriever
+
+    started = time.perf_counter()
+    snapshot = node.install_knowledge(knowledge, "benchmark")
+    index = snapshot.derived("prompt_index", retriever.build_index)
+    print(f"Knowledge base: {len(index.entries)} entries, installed and indexed in "
+          f"{(time.perf_counter() - started) * 1000:.1f} ms")
+    print(f"top_k={retriever.top_k}, token_budget={retriever.token_budget}, {len(queries)} queries\n")
+
+    retriever.min_entries = 0
+    full_tokens = node.estimate_tokens(node.build_system_prompt())
+    retriever.min_entries = 1
+    core_tokens = node.estimate_tokens(node.build_system_prompt())
+    messages = [node.build_translation_message(query) for query, _ in queries]
+    retrieval_tokens = core_tokens + sum(node.estimate_tokens(message) for message in messages) / len(messages)
+    hits = sum(retrieved(message, command) for message, (_, command) in zip(messages, queries))
+
+    print("Prompt size (estimated input tokens per translation)")
+    print(f"  {'full prompt':<34} {full_tokens:9.0f}")
+    print(f"  {'prompt retrieval':<34} {retrieval_tokens:9.0f}  ({retrieval_tokens / full_tokens:.1%})")
+    print(f"\nRecall: answering entry included for {hits}/{len(queries)} queries ({hits / len(queries):.1%})\n")
+
+    print(f"Prompt build time, {iterations} passes over the queries")
+    count = iterations * len(queries)
+    retriever.min_entries = 0
+    full = timeit.timeit(lambda: [(node.build_system_prompt(), node.build_translation_message(q)) for q, _ in queries],
+                         number=iterations)
+    report("full prompt (memoized)", full, count)
+    rendered = timeit.timeit(lambda: node.render_system_prompt(knowledge), number=iterations)
+    report("full prompt (rendered on reload)", rendered, iterations)
+    retriever.min_entries = 1
+    retrieval = timeit.timeit(lambda: [(node.build_system_prompt(), node.build_translation_message(q)) for q, _ in queries],
+                              number=iterations)
+    report("prompt retrieval", retrieval, count)
+
+    if '--live' in sys.argv:
+        sample = queries[::LIVE_SAMPLE]
+        print(f"\nLive calls, {len(sample)} queries ({', '.join(node.LLM_TASK_BACKENDS['translate'])})")
+        run_live(node, sample, retriever)
+
+
+if __name__ == '__main__':
+    main()
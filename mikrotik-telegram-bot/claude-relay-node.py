@@ -8,17 +8,58 @@ Crafted with love & frustration by P̷h̷e̷n̷i̷x̷
 """
 
 import os
+import sys
 import json
 import logging
+import math
+import re
+import ipaddress
 import threading
 import secrets
+import selectors
+import signal
+import socket
+import contextvars
+import hashlib
+import heapq
+import sqlite3
 import time
-from concurrent.futures import ThreadPoolExecutor
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict, deque, namedtuple
+from concurrent.futures import (
+    FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait as wait_futures,
+)
+from functools import lru_cache, wraps
 from datetime import datetime, timedelta
-from typing import Dict, Optional, Any
-from flask import Flask, request, jsonify, render_template_string
+from types import MappingProxyType
+from typing import Any, Callable, Dict, Iterator, Optional
+from flask import Flask, Response, request, jsonify, stream_with_context
+from jinja2 import DictLoader, Environment
 from flask_cors import CORS
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+# compact_responses.py sits next to this file (and is shared with relay-service/);
+# the directory is added for when the node is loaded from elsewhere, e.g. benchmarks
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from compact_responses import RESPONSE_MIMETYPES, encode_compact, get_response_format, negotiate_flask_response
+
+# Optional: asyncio serving mode (CLAUDE_RELAY_SERVER=asgi)
+try:
+    import asyncio
+    import httpx
+    import uvicorn
+    from a2wsgi import WSGIMiddleware
+    from starlette.applications import Starlette
+    from starlette.middleware import Middleware
+    from starlette.middleware.cors import CORSMiddleware
+    from starlette.responses import JSONResponse, Response as ASGIResponse, StreamingResponse
+    from starlette.routing import Mount, Route
+    ASGI_AVAILABLE = True
+except ImportError:
+    ASGI_AVAILABLE = False
 
 # Configure logging
 logging.basicConfig(
@@ -38,42 +79,262 @@ CONFIG = {
     'claude_api_key': os.getenv('CLAUDE_API_KEY', ''),
     'claude_api_url': os.getenv('CLAUDE_API_URL', 'https://api.anthropic.com/v1/messages'),
     'claude_model': os.getenv('CLAUDE_MODEL', 'claude-3-5-sonnet-20241022'),
-    'claude_mode': os.getenv('CLAUDE_MODE', 'anthropic'),  # 'anthropic' or 'local'
+    'claude_mode': os.getenv('CLAUDE_MODE', 'anthropic'),  # Default LLM backend: 'anthropic' or 'local'
     'max_workers': int(os.getenv('MAX_WORKERS', 10)),
     'request_timeout': int(os.getenv('REQUEST_TIMEOUT', 30)),
     'knowledge_base_path': os.getenv('KNOWLEDGE_BASE_PATH', 'claude-relay-knowledge.json'),
     'enable_cloud': os.getenv('CLAUDE_RELAY_ENABLE_CLOUD', 'false').lower() == 'true',
     'handshake_secret': os.getenv('CLAUDE_RELAY_HANDSHAKE_SECRET', ''),  # Optional secret for handshake
+    'cache_max_entries': int(os.getenv('TRANSLATION_CACHE_SIZE', 1024)),  # 0 disables the translation cache
+    'cache_ttl': int(os.getenv('TRANSLATION_CACHE_TTL', 3600)),  # Seconds a cached translation stays valid
+    'fast_path_enabled': os.getenv('FAST_PATH_ENABLED', 'true').lower() == 'true',
+    'fast_path_min_similarity': float(os.getenv('FAST_PATH_MIN_SIMILARITY', 0.8)),  # Token-set Jaccard threshold
+    'prompt_caching': os.getenv('CLAUDE_PROMPT_CACHING', 'true').lower() == 'true',  # Anthropic cache_control on system prompt
+    'prompt_retrieval_min_entries': int(os.getenv('PROMPT_RETRIEVAL_MIN_ENTRIES', 100)),  # Knowledge entries at which prompts carry only relevant ones, 0 disables
+    'prompt_top_k': int(os.getenv('PROMPT_TOP_K', 12)),  # Most operations + examples included per translation
+    'prompt_token_budget': int(os.getenv('PROMPT_TOKEN_BUDGET', 1200)),  # Estimated tokens of retrieved entries per translation
+    'api_connect_timeout': float(os.getenv('CLAUDE_CONNECT_TIMEOUT', 5)),  # Seconds to establish a connection
+    'api_attempt_timeout': float(os.getenv('CLAUDE_ATTEMPT_TIMEOUT', 20)),  # Read timeout per attempt, within request_timeout
+    'api_max_attempts': int(os.getenv('CLAUDE_MAX_ATTEMPTS', 2)),  # Attempts when connecting fails (sent requests are not retried)
+    'api_prewarm_connections': int(os.getenv('CLAUDE_PREWARM_CONNECTIONS', 2)),  # Connections opened at startup
+    'server_mode': os.getenv('CLAUDE_RELAY_SERVER', 'threaded').lower(),  # 'threaded' (Flask) or 'asgi' (asyncio)
+    'async_max_connections': int(os.getenv('ASYNC_MAX_CONNECTIONS', 100)),  # Upstream connections in asgi mode
+    'batch_max_items': int(os.getenv('BATCH_MAX_ITEMS', 50)),  # Max commands per /process-commands request (threaded: also <= workers + queue)
+    'knowledge_reload_interval': float(os.getenv('KNOWLEDGE_RELOAD_INTERVAL', 5)),  # Seconds between file checks, 0 disables
+    'executor_queue_size': int(os.getenv('EXECUTOR_QUEUE_SIZE', 20)),  # Tasks allowed to wait for a worker before 429
+    'busy_retry_after': int(os.getenv('BUSY_RETRY_AFTER', 2)),  # Retry-After seconds sent with 429 responses
+    'auth_max_pending': int(os.getenv('AUTH_MAX_PENDING', 1000)),  # Pending device codes before /auth/request is refused
+    'auth_store_path': os.getenv('AUTH_STORE_PATH', ''),  # SQLite file for device authorizations, empty = memory only
+    'auth_poll_interval': int(os.getenv('AUTH_POLL_INTERVAL', 5)),  # Seconds between short /auth/poll requests
+    'auth_poll_max_wait': int(os.getenv('AUTH_POLL_MAX_WAIT', 30)),  # Longest /auth/poll hold (wait parameter)
+    'auth_poll_max_held': int(os.getenv('AUTH_POLL_MAX_HELD', 0)),  # Long polls held at once in threaded mode, 0 = HTTP_WORKERS / 4
+    'llm_backends_translate': os.getenv('LLM_BACKENDS_TRANSLATE', os.getenv('LLM_BACKENDS', '')),  # Backend order for translations, e.g. "local,anthropic"; empty = CLAUDE_MODE
+    'llm_backends_error_fix': os.getenv('LLM_BACKENDS_ERROR_FIX', os.getenv('LLM_BACKENDS', '')),  # Backend order for /suggest-error-fix; empty = CLAUDE_MODE
+    'local_llm_url': os.getenv('LOCAL_LLM_URL', 'http://127.0.0.1:8080/v1/chat/completions'),  # OpenAI-compatible chat completions endpoint
+    'local_llm_model': os.getenv('LOCAL_LLM_MODEL', 'local'),
+    'local_llm_api_key': os.getenv('LOCAL_LLM_API_KEY', ''),  # Sent as a Bearer token when set
+    'local_llm_max_connections': int(os.getenv('LOCAL_LLM_MAX_CONNECTIONS', 8)),  # Connections to the local server
+    'local_llm_connect_timeout': float(os.getenv('LOCAL_LLM_CONNECT_TIMEOUT', 1)),  # Seconds to connect to the local server
+    'local_llm_attempt_timeout': float(os.getenv('LOCAL_LLM_ATTEMPT_TIMEOUT', 15)),  # Read timeout per local attempt
+    'claude_rpm_limit': int(os.getenv('CLAUDE_RPM_LIMIT', 0)),  # Anthropic requests per minute, 0 = unlimited
+    'claude_tpm_limit': int(os.getenv('CLAUDE_TPM_LIMIT', 0)),  # Anthropic input tokens per minute (estimated), 0 = unlimited
+    'local_llm_rpm_limit': int(os.getenv('LOCAL_LLM_RPM_LIMIT', 0)),  # Local server requests per minute, 0 = unlimited
+    'local_llm_tpm_limit': int(os.getenv('LOCAL_LLM_TPM_LIMIT', 0)),  # Local server input tokens per minute, 0 = unlimited
+    'rate_limit_retries': int(os.getenv('RATE_LIMIT_RETRIES', 2)),  # Retries of a call answered 429/529, within its deadline
+    'rate_limit_pause': float(os.getenv('RATE_LIMIT_PAUSE', 5)),  # Seconds to pause a backend on 429/529 without retry-after
+    'usage_store_path': os.getenv('USAGE_STORE_PATH', ''),  # SQLite file for usage counters, empty = memory only
+    'usage_flush_interval': float(os.getenv('USAGE_FLUSH_INTERVAL', 60)),  # Seconds between usage flushes to the store
+    'usage_retention_days': int(os.getenv('USAGE_RETENTION_DAYS', 90)),  # Days of usage kept in the store, 0 = forever
+    'usage_daily_token_quota': int(os.getenv('USAGE_DAILY_TOKEN_QUOTA', 0)),  # Input + output tokens per router per UTC day, 0 = unlimited
+    'usage_router_quotas': os.getenv('USAGE_ROUTER_QUOTAS', ''),  # Per-router overrides, e.g. "core-rtr=500000,lab=20000"
+    'session_max_turns': int(os.getenv('SESSION_MAX_TURNS', 6)),  # Translations remembered per router for follow-ups, 0 disables sessions
+    'session_token_budget': int(os.getenv('SESSION_TOKEN_BUDGET', 600)),  # Estimated tokens of turns and summary kept per router
+    'session_ttl': float(os.getenv('SESSION_TTL', 1800)),  # Seconds an idle router session is kept
+    'session_max_routers': int(os.getenv('SESSION_MAX_ROUTERS', 5000)),  # Sessions kept, least recently used dropped first
+    'session_memory_tokens': int(os.getenv('SESSION_MEMORY_TOKENS', 1000000)),  # Estimated tokens across all sessions
+    'session_summarize': os.getenv('SESSION_SUMMARIZE', 'false').lower() == 'true',  # Summarize turns leaving a session with the LLM
+    'circuit_failure_threshold': int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', 5)),  # Consecutive backend failures that open its circuit, 0 disables
+    'circuit_open_seconds': float(os.getenv('CIRCUIT_OPEN_SECONDS', 30)),  # Seconds an open circuit refuses calls before a probe
+    'hedge_enabled': os.getenv('HEDGE_ENABLED', 'true').lower() == 'true',  # Duplicate calls slower than the backend's p95
+    'hedge_min_samples': int(os.getenv('HEDGE_MIN_SAMPLES', 20)),  # Latency samples needed before hedging starts
+    'degraded_min_similarity': float(os.getenv('DEGRADED_MIN_SIMILARITY', 0.5)),  # Fast-path threshold while all circuits are open
+    'http_workers': int(os.getenv('HTTP_WORKERS', 64)),  # Threads serving HTTP requests, shared by all listeners
+    'shutdown_grace': float(os.getenv('SHUTDOWN_GRACE', 30)),  # Seconds to finish in-flight requests on SIGTERM/SIGINT
 }
 
-# Thread pool for concurrent processing
-executor = ThreadPoolExecutor(max_workers=CONFIG['max_workers'])
-
-# Load RouterOS knowledge base
-ROUTEROS_KNOWLEDGE = {}
+# RouterOS knowledge base: the current KnowledgeSnapshot, replaced atomically on reload
+KNOWLEDGE = None
+KNOWLEDGE_INSTALL_LOCK = threading.Lock()
 
-# Device authorization storage (in-memory, can be persisted to file)
-# Structure: {device_code: {api_key, router_id, router_identity, created_at, expires_at, authorized_at}}
-DEVICE_AUTHORIZATIONS = {}
-AUTHORIZATION_LOCK = threading.Lock()
+# Device authorizations live in authorization_store (see DEVICE AUTHORIZATION STORE)
 AUTHORIZATION_EXPIRY_HOURS = 24  # Device codes expire after 24 hours
 
 
+# ============================================================================
+# KNOWLEDGE BASE
+# ============================================================================
+
+def freeze_knowledge(value):
+    """Return a read-only copy of parsed JSON (dicts become mapping proxies, lists tuples)."""
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze_knowledge(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze_knowledge(item) for item in value)
+    return value
+
+
+class KnowledgeSnapshot:
+    """Immutable, versioned knowledge base with memoized derived data.
+    
+    Indexes, templates and the system prompt are built once per snapshot, so
+    swapping the snapshot invalidates all of them at once.
+    """
+
+    __slots__ = ('version', 'data', 'source', 'loaded_at', '_derived', '_lock')
+
+    def __init__(self, version: int, data: Dict[str, Any], source: str):
+        self.version = version
+        self.data = freeze_knowledge(data)
+        self.source = source
+        self.loaded_at = datetime.utcnow()
+        self._derived = {}
+        self._lock = threading.Lock()
+
+    def derived(self, name: str, factory: Callable[[Any], Any]) -> Any:
+        """Return factory(data), computed once per snapshot."""
+        value = self._derived.get(name)
+        if value is None:
+            with self._lock:
+                value = self._derived.get(name)
+                if value is None:
+                    value = factory(self.data)
+                    self._derived[name] = value
+        return value
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "version": self.version,
+            "source": self.source,
+            "loaded_at": self.loaded_at.isoformat(),
+        }
+
+
+def current_knowledge() -> KnowledgeSnapshot:
+    """Return the knowledge snapshot in effect (read without locking)."""
+    snapshot = KNOWLEDGE
+    if snapshot is None:
+        snapshot = install_knowledge(get_default_knowledge(), "built-in defaults")
+    return snapshot
+
+
+def validate_knowledge(data: Any):
+    """Check the structure of a parsed knowledge base, raising ValueError if unusable."""
+    if not isinstance(data, dict):
+        raise ValueError("Knowledge base must be a JSON object")
+    syntax = data.get("syntax_patterns", [])
+    if not isinstance(syntax, list) or not all(isinstance(p, str) for p in syntax):
+        raise ValueError("'syntax_patterns' must be a list of strings")
+    operations = data.get("common_operations", {})
+    if not isinstance(operations, dict) or not all(isinstance(v, str) for v in operations.values()):
+        raise ValueError("'common_operations' must map names to command strings")
+    examples = data.get("context_examples", [])
+    if not isinstance(examples, list) or not all(
+        isinstance(e, dict) and isinstance(e.get("input"), str) and isinstance(e.get("output"), str)
+        for e in examples
+    ):
+        raise ValueError("'context_examples' must be a list of {input, output} strings")
+    patterns = data.get("command_patterns", {})
+    if not isinstance(patterns, dict) or not all(
+        isinstance(targets, dict) and all(isinstance(v, str) for v in targets.values())
+        for targets in patterns.values()
+    ):
+        raise ValueError("'command_patterns' must map verbs to {target: command} objects")
+    safety = data.get("safety_rules", {})
+    if not isinstance(safety, dict):
+        raise ValueError("'safety_rules' must be an object")
+    dangerous = safety.get("dangerous_commands", [])
+    if not isinstance(dangerous, list) or not dangerous:
+        raise ValueError("'safety_rules.dangerous_commands' must be a non-empty list")
+    for entry in dangerous:
+        if not isinstance(entry, str) or not entry.startswith("/"):
+            raise ValueError(f"Invalid dangerous command entry: {entry!r}")
+        try:
+            parse_routeros_script(entry)
+        except RouterOSSyntaxError as e:
+            raise ValueError(f"Unparseable dangerous command {entry!r}: {e}")
+
+
+def read_knowledge_file(path: str) -> Dict[str, Any]:
+    """Read and validate a knowledge base file."""
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    validate_knowledge(data)
+    return data
+
+
+def install_knowledge(data: Dict[str, Any], source: str) -> KnowledgeSnapshot:
+    """Build a new snapshot, warm its derived data and swap it in atomically."""
+    global KNOWLEDGE
+    with KNOWLEDGE_INSTALL_LOCK:
+        version = (KNOWLEDGE.version if KNOWLEDGE else 0) + 1
+        snapshot = KnowledgeSnapshot(version, data, source)
+        # Build indexes, templates and prompt before requests can see the snapshot
+        snapshot.derived("fast_path", fast_path.build_index)
+        snapshot.derived("templates", template_engine.compile)
+        snapshot.derived("system_prompt", render_system_prompt)
+        snapshot.derived("prompt_index", prompt_retriever.build_index)
+        snapshot.derived("dangerous_trie", build_dangerous_trie)
+        KNOWLEDGE = snapshot
+    
+    # Translations produced with the previous knowledge base are no longer trusted
+    dropped = translation_cache.invalidate()
+    logger.info(
+        f"Knowledge base v{version} active ({source}); "
+        f"invalidated {dropped} cached translations"
+    )
+    return snapshot
+
+
 def load_knowledge_base() -> Dict[str, Any]:
     """Load RouterOS knowledge base from JSON file."""
-    global ROUTEROS_KNOWLEDGE
     try:
         if os.path.exists(CONFIG['knowledge_base_path']):
-            with open(CONFIG['knowledge_base_path'], 'r', encoding='utf-8') as f:
-                ROUTEROS_KNOWLEDGE = json.load(f)
+            knowledge = read_knowledge_file(CONFIG['knowledge_base_path'])
+            source = CONFIG['knowledge_base_path']
             logger.info(f"Loaded knowledge base from {CONFIG['knowledge_base_path']}")
         else:
             logger.warning(f"Knowledge base file not found: {CONFIG['knowledge_base_path']}")
-            ROUTEROS_KNOWLEDGE = get_default_knowledge()
+            knowledge, source = get_default_knowledge(), "built-in defaults"
     except Exception as e:
         logger.error(f"Error loading knowledge base: {e}")
-        ROUTEROS_KNOWLEDGE = get_default_knowledge()
-    return ROUTEROS_KNOWLEDGE
+        knowledge, source = get_default_knowledge(), "built-in defaults"
+    
+    return install_knowledge(knowledge, source).data
+
+
+class KnowledgeWatcher(threading.Thread):
+    """Polls the knowledge base file and hot-swaps it when it changes.
+    
+    Parsing and validation happen on this thread; a file that fails
+    validation is rejected and the current snapshot stays in effect.
+    """
+
+    def __init__(self, path: str, interval: float):
+        super().__init__(name="knowledge-watcher", daemon=True)
+        self.path = path
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._signature = self._stat()
+
+    def _stat(self) -> Optional[tuple]:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            signature = self._stat()
+            if signature is None or signature == self._signature:
+                continue
+            self._signature = signature
+            try:
+                self.reload()
+            except Exception:
+                logger.exception("Knowledge watcher error")
+
+    def reload(self):
+        try:
+            knowledge = read_knowledge_file(self.path)
+            install_knowledge(knowledge, self.path)
+        except Exception as e:
+            # Any failure (bad JSON, wrong types, a derived index that does not
+            # build) keeps the current snapshot and the watcher running
+            logger.error(f"Knowledge base reload rejected, keeping v{current_knowledge().version}: {e}")
+
+    def stop(self):
+        self._stop_event.set()
 
 
 def get_default_knowledge() -> Dict[str, Any]:
@@ -129,11 +390,649 @@ def get_default_knowledge() -> Dict[str, Any]:
     }
 
 
+# ============================================================================
+# METRICS
+# ============================================================================
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    """Fixed-bucket histogram; observe() is a bisect and one locked update."""
+
+    __slots__ = ('buckets', 'counts', 'total', 'count', '_lock')
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last slot is +Inf
+        self.total = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.total += value
+            self.count += 1
+
+    def snapshot(self) -> tuple:
+        with self._lock:
+            return list(self.counts), self.total, self.count
+
+
+class StageTimer:
+    """Context manager observing the duration of a block into a histogram."""
+
+    __slots__ = ('histogram', 'started')
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started)
+        return False
+
+
+def format_labels(labels: tuple) -> str:
+    """Render ((name, value), ...) as a Prometheus label set."""
+    if not labels:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    )
+    return "{" + pairs + "}"
+
+
+def series_key(name: str, labels: Dict[str, Any]) -> tuple:
+    """Identify one time series; label values are stringified so keys always sort."""
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+class MetricsRegistry:
+    """In-process counters, gauges and histograms in the Prometheus text format.
+    
+    Series are created on first use; recording takes one short lock, so it
+    stays on at full load.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}        # name -> (type, help)
+        self._values = {}      # (name, labels) -> number (counters and gauges)
+        self._histograms = {}  # (name, labels) -> Histogram
+
+    def describe(self, name: str, kind: str, help_text: str):
+        self._meta[name] = (kind, help_text)
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = series_key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def histogram(self, name: str, **labels) -> Histogram:
+        key = series_key(name, labels)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram())
+        return histogram
+
+    def observe(self, name: str, value: float, **labels):
+        self.histogram(name, **labels).observe(value)
+
+    def timer(self, name: str, **labels) -> StageTimer:
+        return StageTimer(self.histogram(name, **labels))
+
+    def render(self, gauges: tuple = ()) -> str:
+        """Return the exposition text; gauges are (name, help, [(labels, value)]) read at scrape time."""
+        with self._lock:
+            values = sorted(self._values.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+        
+        lines = []
+        described = set()
+        
+        def header(name, kind, help_text=""):
+            if name in described:
+                return
+            described.add(name)
+            kind, help_text = self._meta.get(name, (kind, help_text))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+        
+        for (name, labels), value in values:
+            header(name, "counter")
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        
+        for (name, labels), histogram in histograms:
+            header(name, "histogram")
+            counts, total, count = histogram.snapshot()
+            cumulative = 0
+            for bound, bucket_count in zip(histogram.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{name}_count{format_labels(labels)} {count}")
+        
+        for name, help_text, samples in gauges:
+            header(name, "gauge", help_text)
+            for labels, value in samples:
+                lines.append(f"{name}{format_labels(tuple(labels.items()))} {value}")
+        
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+metrics.describe("relay_stage_duration_seconds", "histogram",
+                 "Time spent per /process-command stage")
+metrics.describe("relay_upstream_responses_total", "counter",
+                 "LLM backend responses by backend and HTTP status (\"error\" when no response was received)")
+metrics.describe("relay_claude_tokens_total", "counter",
+                 "Tokens reported in LLM usage, by backend and type")
+metrics.describe("relay_upstream_calls_total", "counter",
+                 "LLM backend calls by backend and outcome: useful, wasted (caller gone when it returned), "
+                 "aborted (cut off at the deadline), failed, throttled (429/529, retried), "
+                 "skipped (no time left) or short_circuited (circuit open)")
+metrics.describe("relay_llm_fallbacks_total", "counter",
+                 "Calls passed to the next backend, by task and failed backend")
+metrics.describe("relay_outbound_wait_seconds", "histogram",
+                 "Time LLM calls waited for the outbound scheduler, by backend and lane")
+metrics.describe("relay_outbound_throttled_total", "counter",
+                 "429/529 responses that paused a backend, by backend and status")
+metrics.describe("relay_quota_rejections_total", "counter",
+                 "Requests of over-quota routers answered without a new LLM call, by endpoint")
+metrics.describe("relay_circuit_transitions_total", "counter",
+                 "Circuit breaker state changes, by backend and new state (closed, open, half_open)")
+metrics.describe("relay_hedges_total", "counter",
+                 "Hedged duplicate calls by backend and result: sent, won (the duplicate answered first) "
+                 "or lost (the original answered first)")
+metrics.describe("relay_degraded_responses_total", "counter",
+                 "Translations answered without a new LLM call, by reason (circuit_open, quota) "
+                 "and source (miss = no answer)")
+metrics.describe("relay_prompt_tokens_saved_total", "counter",
+                 "Estimated prompt tokens not sent thanks to prompt retrieval")
+metrics.describe("relay_session_evictions_total", "counter",
+                 "Router sessions dropped, by reason: ttl (idle), lru (SESSION_MAX_ROUTERS) or memory")
+metrics.describe("relay_executor_tasks_total", "counter",
+                 "Tasks submitted to the worker pool")
+metrics.describe("relay_http_requests_total", "counter",
+                 "HTTP requests accepted, by listener")
+# Component counters read from stats() at scrape time
+metrics.describe("relay_executor_dropped_total", "counter",
+                 "Tasks not run: refused (queue full), cancelled by the caller or expired while queued")
+metrics.describe("relay_cache_lookups_total", "counter",
+                 "Lookups by cache and result")
+metrics.describe("relay_single_flight_calls_saved_total", "counter",
+                 "Calls answered by joining an in-flight request")
+metrics.describe("relay_http_pool_connections_total", "counter",
+                 "Upstream connections by outcome")
+
+
+def timed_stage(stage: str):
+    """Decorator recording a function's duration as a stage latency."""
+    def decorator(fn):
+        histogram = metrics.histogram("relay_stage_duration_seconds", stage=stage)
+        
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with StageTimer(histogram):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_claude_usage(usage: Optional[Dict[str, Any]], backend: str = "anthropic"):
+    """Add the token counts of a Messages API usage object to the metrics."""
+    if not usage:
+        return
+    for field, kind in (
+        ("input_tokens", "input"),
+        ("output_tokens", "output"),
+        ("cache_read_input_tokens", "cache_read"),
+        ("cache_creation_input_tokens", "cache_write"),
+    ):
+        count = usage.get(field)
+        if count:
+            metrics.inc("relay_claude_tokens_total", count, backend=backend, type=kind)
+    usage_ledger.record_tokens(usage_scope.get(), usage)
+
+
+# ============================================================================
+# WORKER POOL
+# ============================================================================
+
+class ExecutorSaturated(Exception):
+    """Raised when the worker pool queue is full and a task is refused."""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Server busy, retry later")
+        self.retry_after = retry_after
+
+
+class DeadlineExpired(TimeoutError):
+    """Raised instead of starting work whose caller deadline has passed."""
+
+
+class RequestDeadline:
+    """Absolute deadline and cancellation flag carried through one request's work.
+    
+    Workers check it between stages and size upstream timeouts from
+    remaining(), so abandoned work stops instead of running to completion.
+    """
+
+    __slots__ = ('at', 'cancelled', 'parent')
+
+    def __init__(self, timeout: float, parent: Optional['RequestDeadline'] = None):
+        self.at = time.monotonic() + timeout
+        self.cancelled = False
+        self.parent = parent
+
+    def is_cancelled(self) -> bool:
+        return self.cancelled or (self.parent is not None and self.parent.is_cancelled())
+
+    def remaining(self) -> float:
+        if self.is_cancelled():
+            return 0.0
+        return max(0.0, self.at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.is_cancelled() or time.monotonic() >= self.at
+
+    def cancel(self):
+        """Mark the caller as gone."""
+        self.cancelled = True
+
+    def fork(self) -> 'RequestDeadline':
+        """Child deadline with the same expiry that can also be cancelled on its own."""
+        return RequestDeadline(self.remaining(), parent=self)
+
+    def check(self):
+        if self.expired():
+            raise DeadlineExpired("Request deadline passed")
+
+
+class SharedDeadline(RequestDeadline):
+    """Deadline of work shared by several callers (see SingleFlight).
+    
+    It runs until the latest expiry among the callers, and counts as
+    cancelled only once every caller has cancelled.
+    """
+
+    __slots__ = ('waiters',)
+
+    def __init__(self, deadline: RequestDeadline):
+        self.parent = None
+        self.waiters = [deadline]
+
+    def join(self, deadline: RequestDeadline):
+        self.waiters.append(deadline)
+
+    def is_cancelled(self) -> bool:
+        return all(waiter.is_cancelled() for waiter in tuple(self.waiters))
+
+    def remaining(self) -> float:
+        return max(waiter.remaining() for waiter in tuple(self.waiters))
+
+    def expired(self) -> bool:
+        return all(waiter.expired() for waiter in tuple(self.waiters))
+
+    def cancel(self):
+        for waiter in tuple(self.waiters):
+            waiter.cancel()
+
+
+class BoundedExecutor:
+    """Thread pool with a bounded admission queue and per-task deadlines.
+    
+    Tasks beyond max_workers + max_queue are refused immediately with
+    ExecutorSaturated; a task still queued when its deadline passes is dropped
+    instead of executed. Queue wait, depth and active workers are recorded.
+    """
+
+    def __init__(self, max_workers: int, max_queue: int, retry_after: int):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self.queued = 0
+        self.active = 0
+        self.rejected = 0
+        self.cancelled = 0
+        self.expired = 0
+        self._lock = threading.Lock()
+        self._queue_wait = metrics.histogram("relay_stage_duration_seconds", stage="queue_wait")
+
+    def submit(self, fn, *args, deadline: Optional[RequestDeadline] = None):
+        """Queue fn(*args), dropping it if the deadline passes before a worker is free."""
+        with self._lock:
+            if self.queued + self.active >= self.max_workers + self.max_queue:
+                self.rejected += 1
+                raise ExecutorSaturated(self.retry_after)
+            self.queued += 1
+        metrics.inc("relay_executor_tasks_total")
+        # Run in a copy of the caller's context so usage is accounted to its router
+        future = self.pool.submit(contextvars.copy_context().run, self._run, time.perf_counter(), deadline, fn, args)
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _run(self, submitted, deadline, fn, args):
+        self._queue_wait.observe(time.perf_counter() - submitted)
+        with self._lock:
+            self.queued -= 1
+            if deadline is not None and deadline.expired():
+                self.expired += 1
+                raise DeadlineExpired("Deadline passed while queued")
+            self.active += 1
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                self.active -= 1
+
+    def _on_done(self, future):
+        if future.cancelled():  # Caller gave up while the task was still queued
+            with self._lock:
+                self.queued -= 1
+                self.cancelled += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "queued": self.queued,
+                "active": self.active,
+                "rejected": self.rejected,
+                "cancelled": self.cancelled,
+                "expired": self.expired,
+            }
+
+
+# Thread pool for concurrent processing
+executor = BoundedExecutor(CONFIG['max_workers'], CONFIG['executor_queue_size'], CONFIG['busy_retry_after'])
+
+
+def busy_response(retry_after: int):
+    """429 response telling the caller when to retry."""
+    response = jsonify({
+        "success": False,
+        "error": "Server busy, retry later",
+        "retry_after": retry_after,
+    })
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+# ============================================================================
+# HTTP CLIENT
+# ============================================================================
+
+def failed_before_sending(error: requests.exceptions.RequestException) -> bool:
+    """True when a request failed while connecting, so the server never saw it."""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = error.args[0] if error.args else None
+    reason = getattr(reason, 'reason', reason)  # MaxRetryError wraps the cause
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+class PooledHTTPClient:
+    """Shared keep-alive HTTP session for upstream API calls.
+    
+    The connection pool is sized to the worker pool so every worker can hold
+    a warm connection. Failures to connect reset the session and retry within
+    the overall time budget. A request that may have reached the server is
+    never sent again: Messages API calls are billed and not idempotent.
+    """
+
+    def __init__(self, pool_size: int, connect_timeout: float, attempt_timeout: float, max_attempts: int):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.attempt_timeout = attempt_timeout
+        self.max_attempts = max(1, max_attempts)
+        self._session = None
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.requests = 0
+        self.warmups = 0
+        self.reconnects = 0
+        self.failures = 0
+        self._retired_connections = 0  # Connections opened by sessions that were reset
+
+    def _new_session(self) -> requests.Session:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size, max_retries=0)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def session(self) -> requests.Session:
+        """Return the shared session, creating it on first use."""
+        session = self._session
+        if session is None:
+            with self._lock:
+                if self._session is None:
+                    self._session = self._new_session()
+                session = self._session
+        return session
+
+    def reset(self, broken: Optional[requests.Session] = None):
+        """Drop the pooled connections so the next attempt reconnects."""
+        with self._lock:
+            if broken is not None and self._session is not broken:
+                return  # Another thread already reconnected
+            if self._session is not None:
+                self._retired_connections += self._opened_connections(self._session)
+                self._session.close()
+                self._session = None
+            with self._stats_lock:
+                self.reconnects += 1
+
+    def post(self, url: str, budget: float, **kwargs) -> requests.Response:
+        """POST with per-attempt timeouts inside an overall budget (seconds)."""
+        deadline = time.monotonic() + budget
+        last_error = None
+        for attempt in range(1, self.max_attempts + 1):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            session = self.session()
+            timeout = (min(self.connect_timeout, remaining), min(self.attempt_timeout, remaining))
+            with self._stats_lock:
+                self.requests += 1
+            try:
+                return session.post(url, timeout=timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+                self.reset(session)
+                if not failed_before_sending(e):
+                    # The request may have been processed (and billed) - don't replay it
+                    with self._stats_lock:
+                        self.failures += 1
+                    raise
+                last_error = e
+                logger.warning(f"Upstream connection failed (attempt {attempt}/{self.max_attempts}): {e}")
+        with self._stats_lock:
+            self.failures += 1
+        raise last_error or requests.exceptions.Timeout(f"No time left for request to {url}")
+
+    def warm(self, url: str, connections: int):
+        """Open keep-alive connections ahead of the first request."""
+        connections = min(connections, self.pool_size)
+        if connections <= 0:
+            return
+        session = self.session()
+
+        def open_connection():
+            with self._stats_lock:
+                self.warmups += 1
+            try:
+                session.head(url, timeout=(self.connect_timeout, self.connect_timeout))
+            except requests.exceptions.RequestException as e:
+                logger.warning(f"Connection pre-warm failed: {e}")
+
+        threads = [threading.Thread(target=open_connection, daemon=True) for _ in range(connections)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        logger.info(f"Pre-warmed {connections} connections to {url}")
+
+    @staticmethod
+    def _opened_connections(session: requests.Session) -> int:
+        opened = 0
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is not None:
+                    opened += pool.num_connections
+        return opened
+
+    def stats(self) -> Dict[str, Any]:
+        """Return connection reuse counters for monitoring."""
+        session = self._session
+        opened = self._retired_connections + (self._opened_connections(session) if session else 0)
+        with self._stats_lock:
+            return {
+                "pool_size": self.pool_size,
+                "requests": self.requests,
+                "warmups": self.warmups,
+                "connections_opened": opened,
+                "connections_reused": max(0, self.requests + self.warmups - opened),
+                "reconnects": self.reconnects,
+                "failures": self.failures,
+            }
+
+
+claude_http = PooledHTTPClient(
+    CONFIG['max_workers'],
+    CONFIG['api_connect_timeout'],
+    CONFIG['api_attempt_timeout'],
+    CONFIG['api_max_attempts'],
+)
+
+
+class AsyncHTTPClient:
+    """Shared httpx.AsyncClient with keep-alive connections for asgi mode."""
+
+    def __init__(self, max_connections: int, connect_timeout: float, attempt_timeout: float, max_attempts: int):
+        self.max_connections = max_connections
+        self.connect_timeout = connect_timeout
+        self.attempt_timeout = attempt_timeout
+        self.max_attempts = max(1, max_attempts)
+        self._client = None
+        self.requests = 0
+        self.failures = 0
+
+    def client(self) -> "httpx.AsyncClient":
+        """Return the shared client, creating it inside the running loop."""
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                ),
+            )
+        return self._client
+
+    async def post(self, url: str, budget: float, **kwargs) -> "httpx.Response":
+        """POST with per-attempt timeouts inside an overall budget (seconds)."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + budget
+        last_error = None
+        for attempt in range(1, self.max_attempts + 1):
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            timeout = httpx.Timeout(
+                min(self.attempt_timeout, remaining),
+                connect=min(self.connect_timeout, remaining),
+            )
+            self.requests += 1
+            try:
+                return await self.client().post(url, timeout=timeout, **kwargs)
+            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                # Failed while connecting, so the request was never sent; retry on a fresh connection.
+                # Errors after sending are not retried (the call may have been processed).
+                last_error = e
+                logger.warning(f"Upstream connection failed (attempt {attempt}/{self.max_attempts}): {e}")
+        self.failures += 1
+        raise last_error or httpx.TimeoutException(f"No time left for request to {url}")
+
+    async def open_stream(self, url: str, budget: float, **kwargs) -> "httpx.Response":
+        """Send a POST and return the response with its body still streaming.
+        
+        The caller must aclose() the response.
+        """
+        timeout = httpx.Timeout(min(self.attempt_timeout, budget), connect=min(self.connect_timeout, budget))
+        client = self.client()
+        self.requests += 1
+        try:
+            return await client.send(client.build_request("POST", url, timeout=timeout, **kwargs), stream=True)
+        except httpx.HTTPError:
+            self.failures += 1
+            raise
+
+    async def warm(self, url: str, connections: int):
+        """Open keep-alive connections ahead of the first request."""
+        connections = min(connections, self.max_connections)
+        if connections <= 0:
+            return
+        timeout = httpx.Timeout(self.connect_timeout)
+        results = await asyncio.gather(
+            *(self.client().head(url, timeout=timeout) for _ in range(connections)),
+            return_exceptions=True,
+        )
+        failed = [r for r in results if isinstance(r, Exception)]
+        if failed:
+            logger.warning(f"Connection pre-warm failed: {failed[0]}")
+        logger.info(f"Pre-warmed {connections - len(failed)} connections to {url}")
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> Dict[str, Any]:
+        """Return request counters for monitoring."""
+        return {
+            "max_connections": self.max_connections,
+            "requests": self.requests,
+            "failures": self.failures,
+        }
+
+
+async_claude_http = AsyncHTTPClient(
+    CONFIG['async_max_connections'],
+    CONFIG['api_connect_timeout'],
+    CONFIG['api_attempt_timeout'],
+    CONFIG['api_max_attempts'],
+) if ASGI_AVAILABLE else None
+
+
 def build_system_prompt() -> str:
-    """Build system prompt for Claude with RouterOS knowledge."""
-    knowledge = ROUTEROS_KNOWLEDGE or get_default_knowledge()
+    """Return system prompt for Claude with RouterOS knowledge.
     
-    prompt = """You are a RouterOS command expert assistant. Your task is to translate natural language commands or high-level abstractions into valid RouterOS commands.
+    The prompt is rendered once per knowledge base version and reused. Once
+    the knowledge base is large enough for prompt retrieval, the prompt
+    carries no operations or examples; build_translation_message adds the
+    relevant ones to each request instead.
+    """
+    knowledge = current_knowledge()
+    if prompt_retriever.enabled(knowledge.derived("prompt_index", prompt_retriever.build_index)):
+        return knowledge.derived("system_prompt_core", render_core_prompt)
+    return knowledge.derived("system_prompt", render_system_prompt)
+
+
+PROMPT_SYNTAX = """You are a RouterOS command expert assistant. Your task is to translate natural language commands or high-level abstractions into valid RouterOS commands.
 
 RouterOS Command Syntax:
 - Commands start with "/" (e.g., /interface print)
@@ -141,28 +1040,16 @@ RouterOS Command Syntax:
 - Use "find" for searching (e.g., /ip firewall filter find where src-address="192.168.1.0/24")
 - Use "add" to create (e.g., /ip firewall filter add chain=forward action=drop)
 - Use "remove" or "set" to modify (e.g., /ip firewall filter remove [find where ...])
-
-Common Operations:
 """
-    
-    for op, cmd in knowledge.get("common_operations", {}).items():
-        prompt += f"- {op}: {cmd}\n"
-    
-    prompt += """
-Safety Rules:
+
+PROMPT_SAFETY = """Safety Rules:
 - NEVER generate dangerous commands like /system reset-configuration
 - Always validate command syntax before returning
 - Prefer read-only commands when the intent is unclear
 - Add comments to firewall rules for traceability
-
-Examples:
 """
-    
-    for example in knowledge.get("context_examples", []):
-        prompt += f"Input: {example['input']}\nOutput: {example['output']}\n\n"
-    
-    prompt += """
-Instructions:
+
+PROMPT_INSTRUCTIONS = """Instructions:
 1. Analyze the user's request
 2. Determine the appropriate RouterOS command
 3. Return ONLY the RouterOS command, nothing else
@@ -171,33 +1058,172 @@ Instructions:
 
 Return format: Just the RouterOS command, or "ERROR: <reason>" if not possible.
 """
-    
-    return prompt
 
 
-def call_claude_api(user_message: str, custom_system_prompt: Optional[str] = None) -> Optional[str]:
-    """Call Claude API to process smart command.
+def render_operation(op: str, cmd: str) -> str:
+    return f"- {op}: {cmd}\n"
+
+
+def render_example(example: Dict[str, str]) -> str:
+    return f"Input: {example['input']}\nOutput: {example['output']}\n\n"
+
+
+def render_system_prompt(knowledge: Dict[str, Any]) -> str:
+    """Render the system prompt text for a knowledge base."""
+    parts = [PROMPT_SYNTAX, "\nCommon Operations:\n"]
+    for op, cmd in knowledge.get("common_operations", {}).items():
+        parts.append(render_operation(op, cmd))
+    parts.extend(["\n", PROMPT_SAFETY, "\nExamples:\n"])
+    for example in knowledge.get("context_examples", []):
+        parts.append(render_example(example))
+    parts.extend(["\n", PROMPT_INSTRUCTIONS])
+    return "".join(parts)
+
+
+def render_core_prompt(knowledge: Dict[str, Any]) -> str:
+    """Render the system prompt without operations and examples (used with prompt retrieval)."""
+    return "".join([
+        PROMPT_SYNTAX,
+        "\nThe operations and examples most relevant to a request are listed in the message before it.\n",
+        "\n", PROMPT_SAFETY, "\n", PROMPT_INSTRUCTIONS,
+    ])
+
+
+# ============================================================================
+# PROMPT RETRIEVAL
+# ============================================================================
+# A large knowledge base makes every translation pay for entries unrelated
+# to the request. Past PROMPT_RETRIEVAL_MIN_ENTRIES entries, operations and
+# examples are ranked by TF-IDF similarity to the command and only the top
+# ones that fit the token budget go into the request.
+
+# kind: "operation" or "example"; text: rendered prompt lines; tokens: estimate_tokens(text)
+PromptEntry = namedtuple('PromptEntry', 'kind text tokens')
+# postings: token -> [(entry index, weight)]; norms: per-entry vector length
+PromptIndex = namedtuple('PromptIndex', 'entries postings norms full_tokens')
+
+
+class PromptRetriever:
+    """Ranks knowledge entries against a command with an inverted TF-IDF index."""
+
+    def __init__(self, min_entries: int, top_k: int, token_budget: int):
+        self.min_entries = min_entries
+        self.top_k = top_k
+        self.token_budget = token_budget
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.entries_selected = 0
+        self.tokens_saved = 0
+
+    def enabled(self, index: PromptIndex) -> bool:
+        return 0 < self.min_entries <= len(index.entries)
+
+    def build_index(self, knowledge: Dict[str, Any]) -> PromptIndex:
+        """Index the operations and examples of a knowledge base."""
+        entries, documents = [], []
+        for op, cmd in knowledge.get("common_operations", {}).items():
+            text = render_operation(op, cmd)
+            entries.append(PromptEntry("operation", text, estimate_tokens(text)))
+            documents.append(tokenize_intent(f"{op} {cmd}"))
+        for example in knowledge.get("context_examples", []):
+            text = render_example(example)
+            entries.append(PromptEntry("example", text, estimate_tokens(text)))
+            documents.append(tokenize_intent(f"{example['input']} {example['output']}"))
+        
+        frequency = defaultdict(int)
+        for tokens in documents:
+            for token in tokens:
+                frequency[token] += 1
+        idf = {token: math.log((len(documents) + 1) / (count + 1)) + 1 for token, count in frequency.items()}
+        
+        postings = defaultdict(list)
+        norms = []
+        for position, tokens in enumerate(documents):
+            for token in tokens:
+                postings[token].append((position, idf[token]))
+            norms.append(math.sqrt(sum(idf[token] ** 2 for token in tokens)) or 1.0)
+        return PromptIndex(entries, dict(postings), norms, estimate_tokens(render_system_prompt(knowledge)))
+
+    def select(self, index: PromptIndex, command: str) -> list:
+        """Return the best matching entries for a command, within top_k and the token budget."""
+        scores = defaultdict(float)
+        for token in tokenize_intent(command):
+            for position, weight in index.postings.get(token, ()):
+                scores[position] += weight * weight
+        ranked = heapq.nlargest(self.top_k, scores, key=lambda position: scores[position] / index.norms[position])
+        
+        selected, budget = [], self.token_budget
+        for position in ranked:
+            entry = index.entries[position]
+            if entry.tokens <= budget:
+                selected.append(entry)
+                budget -= entry.tokens
+        return selected
+
+    def knowledge_section(self, command: str) -> str:
+        """Prompt lines with the knowledge entries relevant to a command ("" while disabled)."""
+        knowledge = current_knowledge()
+        index = knowledge.derived("prompt_index", self.build_index)
+        if not self.enabled(index):
+            return ""
+        
+        with metrics.timer("relay_stage_duration_seconds", stage="retrieval"):
+            selected = self.select(index, command)
+        parts = []
+        operations = [entry.text for entry in selected if entry.kind == "operation"]
+        if operations:
+            parts.extend(["Relevant Operations:\n"] + operations + ["\n"])
+        examples = [entry.text for entry in selected if entry.kind == "example"]
+        if examples:
+            parts.extend(["Examples:\n"] + examples)
+        section = "".join(parts)
+        
+        saved = index.full_tokens - estimate_tokens(knowledge.derived("system_prompt_core", render_core_prompt), section)
+        metrics.inc("relay_prompt_tokens_saved_total", max(0, saved))
+        with self._lock:
+            self.requests += 1
+            self.entries_selected += len(selected)
+            self.tokens_saved += max(0, saved)
+        return section
+
+    def stats(self) -> Dict[str, Any]:
+        """Return retrieval counters for monitoring."""
+        index = current_knowledge().derived("prompt_index", self.build_index)
+        with self._lock:
+            return {
+                "enabled": self.enabled(index),
+                "entries": len(index.entries),
+                "min_entries": self.min_entries,
+                "top_k": self.top_k,
+                "token_budget": self.token_budget,
+                "full_prompt_tokens": index.full_tokens,
+                "requests": self.requests,
+                "avg_entries_selected": round(self.entries_selected / self.requests, 2) if self.requests else 0.0,
+                "tokens_saved": self.tokens_saved,
+            }
+
+
+prompt_retriever = PromptRetriever(
+    CONFIG['prompt_retrieval_min_entries'],
+    CONFIG['prompt_top_k'],
+    CONFIG['prompt_token_budget'],
+)
+
+
+def build_claude_payload(user_message: str, system_prompt: str) -> Dict[str, Any]:
+    """Build the Messages API payload.
     
-    Args:
-        user_message: The user's message/command
-        custom_system_prompt: Optional custom system prompt (if None, uses default)
+    The system prompt is sent as a text block marked with cache_control so
+    repeat calls reuse the provider-side cached prefix.
     """
-    if not CONFIG['claude_api_key']:
-        logger.error("Claude API key not configured")
-        return None
-    
-    system_prompt = custom_system_prompt or build_system_prompt()
-    
-    headers = {
-        "x-api-key": CONFIG['claude_api_key'],
-        "anthropic-version": "2023-06-01",
-        "Content-Type": "application/json",
-    }
+    system_block = {"type": "text", "text": system_prompt}
+    if CONFIG['prompt_caching']:
+        system_block["cache_control"] = {"type": "ephemeral"}
     
-    payload = {
+    return {
         "model": CONFIG['claude_model'],
         "max_tokens": 1024,
-        "system": system_prompt,
+        "system": [system_block],
         "messages": [
             {
                 "role": "user",
@@ -205,108 +1231,2682 @@ def call_claude_api(user_message: str, custom_system_prompt: Optional[str] = Non
             }
         ]
     }
-    
-    try:
-        response = requests.post(
-            CONFIG['claude_api_url'],
-            headers=headers,
-            json=payload,
-            timeout=CONFIG['request_timeout']
+
+
+def build_claude_headers() -> Dict[str, str]:
+    """Return request headers for the Anthropic Messages API."""
+    return {
+        "x-api-key": CONFIG['claude_api_key'],
+        "anthropic-version": "2023-06-01",
+        "Content-Type": "application/json",
+    }
+
+
+def extract_claude_text(result: Dict[str, Any]) -> Optional[str]:
+    """Extract the completion text from a Messages API response body."""
+    usage = result.get('usage') or {}
+    record_claude_usage(usage)
+    if usage:
+        logger.debug(
+            f"Claude usage: input={usage.get('input_tokens', 0)} "
+            f"cache_read={usage.get('cache_read_input_tokens', 0)} "
+            f"cache_write={usage.get('cache_creation_input_tokens', 0)} "
+            f"output={usage.get('output_tokens', 0)}"
         )
-        response.raise_for_status()
-        result = response.json()
-        
-        # Extract content from Claude response
-        if 'content' in result and len(result['content']) > 0:
-            content = result['content'][0].get('text', '')
-            return content.strip()
-        else:
-            logger.error(f"Unexpected Claude API response: {result}")
-            return None
-            
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Claude API request failed: {e}")
-        return None
-    except Exception as e:
-        logger.error(f"Error processing Claude API response: {e}")
+    
+    # Extract content from Claude response
+    if 'content' in result and len(result['content']) > 0:
+        content = result['content'][0].get('text', '')
+        return content.strip()
+    logger.error(f"Unexpected Claude API response: {result}")
+    return None
+
+
+def parse_claude_stream_line(line: str) -> Optional[str]:
+    """Return the text delta carried by one line of a streamed Messages API response."""
+    if not line or not line.startswith("data:"):
         return None
+    event = json.loads(line[5:])
+    if event.get("type") == "message_start":
+        # output_tokens here is a placeholder; message_delta carries the final count
+        usage = dict(event.get("message", {}).get("usage") or {}, output_tokens=0)
+        record_claude_usage(usage)
+    elif event.get("type") == "message_delta":
+        record_claude_usage(event.get("usage"))
+    if event.get("type") == "content_block_delta":
+        return event.get("delta", {}).get("text")
+    if event.get("type") == "error":
+        raise RuntimeError(event.get("error", {}).get("message", "Claude API stream error"))
+    return None
 
 
-def validate_routeros_command(command: str):
+def record_upstream_outcome(outcome: str, backend: str):
+    metrics.inc("relay_upstream_calls_total", backend=backend, outcome=outcome)
+
+
+def completed_outcome(deadline: RequestDeadline) -> str:
+    """Outcome of an upstream call that returned: useful unless the caller already left."""
+    return "wasted" if deadline.expired() else "useful"
+
+
+# ============================================================================
+# LLM BACKENDS
+# ============================================================================
+# Completions come from an ordered list of backends per task: 'translate'
+# (/process-command, /process-commands) and 'error_fix' (/suggest-error-fix).
+# When a backend fails, the next one is tried within the same deadline.
+# Each backend has its own connection pools and timeouts, a circuit breaker
+# that skips it while it keeps failing, and a latency window used to hedge
+# calls that run past its p95.
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker for one LLM backend.
+    
+    closed: calls pass and failures (5xx or no response) are counted.
+    After failure_threshold consecutive failures the circuit opens and calls
+    are refused without touching the network for open_seconds. It then turns
+    half_open: one probe call is let through, and its result closes or
+    re-opens the circuit. A threshold of 0 disables the breaker.
+    """
+
+    STATE_VALUES = {"closed": 0, "half_open": 1, "open": 2}
+
+    def __init__(self, backend: str, failure_threshold: int, open_seconds: float):
+        self.backend = backend
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.transitions = 0
+        self._lock = threading.Lock()
+
+    def available(self) -> bool:
+        """Whether allow() would let a call through now, without claiming the probe."""
+        with self._lock:
+            if self.state == "open":
+                return time.monotonic() - self.opened_at >= self.open_seconds
+            return self.state == "closed" or not self.probing
+
+    def allow(self) -> bool:
+        """Admit a call; in half_open only the single probe call is admitted."""
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < self.open_seconds:
+                    return False
+                self._transition("half_open")
+            if self.probing:
+                return False
+            self.probing = True
+            return True
+
+    def record_status(self, status: int):
+        """Judge an answered call: 5xx counts as a failure, 429 (paced by the scheduler) as
+        no verdict, anything else as success."""
+        if status >= 500:
+            self.record_failure()
+        elif status == 429:
+            self.record_error(cancelled=True)
+        else:
+            self.record_success()
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.probing = False
+            if self.state != "closed":
+                self._transition("closed")
+
+    def record_failure(self):
+        if self.failure_threshold <= 0:
+            return
+        with self._lock:
+            self.failures += 1
+            self.probing = False
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+                self.opened_at = time.monotonic()
+                self._transition("open")
+
+    def record_error(self, cancelled: bool):
+        """Judge a call that got no response; calls the caller cancelled give no verdict."""
+        if cancelled:
+            self.release_probe()
+        else:
+            self.record_failure()
+
+    def release_probe(self):
+        """Give back the half_open probe of a call that ended without a verdict
+        (e.g. it never got past the outbound scheduler), so another call may probe."""
+        with self._lock:
+            self.probing = False
+
+    def retry_after(self) -> float:
+        """Seconds until an open circuit lets a probe through."""
+        with self._lock:
+            if self.state != "open":
+                return 0.0
+            return max(0.0, self.opened_at + self.open_seconds - time.monotonic())
+
+    def _transition(self, state: str):
+        # Called with the lock held
+        self.state = state
+        self.transitions += 1
+        metrics.inc("relay_circuit_transitions_total", backend=self.backend, state=state)
+        if state == "open":
+            logger.warning(f"{self.backend} circuit open after {self.failures} failures, "
+                           f"refusing calls for {self.open_seconds:g}s")
+        else:
+            logger.info(f"{self.backend} circuit {state}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "failure_threshold": self.failure_threshold,
+                "open_seconds": self.open_seconds,
+                "transitions": self.transitions,
+            }
+
+
+class LatencyWindow:
+    """Durations of a backend's most recent successful calls, for percentile estimates."""
+
+    def __init__(self, size: int = 200):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def quantile(self, q: float, min_samples: int = 1) -> Optional[float]:
+        """The q-quantile of the window, or None with fewer than min_samples samples."""
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples or len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+# Rough size of an upstream request, counted against TPM limits before the call
+CHARS_PER_TOKEN = 4
+
+# Lanes of the outbound scheduler; lower values are served first
+OUTBOUND_LANES = {'interactive': 0, 'background': 1}
+TASK_LANES = {'translate': 'interactive', 'error_fix': 'background', 'summarize': 'background'}
+
+
+def estimate_tokens(*texts: str) -> int:
+    """Estimate the token count of request text (about four characters per token)."""
+    return sum(len(text) for text in texts) // CHARS_PER_TOKEN + 1
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds from a retry-after header, or None when missing or not a number."""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """Allowance of `per_minute` units, refilled continuously; 0 means unlimited."""
+
+    __slots__ = ('capacity', 'level', 'updated')
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def wait_for(self, amount: float) -> float:
+        """Seconds until `amount` is available; requests above capacity wait for a full bucket."""
+        if not self.capacity:
+            return 0.0
+        missing = min(amount, self.capacity) - self.level
+        return missing * 60 / self.capacity if missing > 0 else 0.0
+
+    def take(self, amount: float):
+        if self.capacity:
+            self.level -= min(amount, self.capacity)
+
+
+class OutboundTicket:
+    """One call waiting for the outbound scheduler; `event` is set once it is granted."""
+
+    __slots__ = ('lane', 'tokens', 'granted', 'event', 'loop')
+
+    def __init__(self, lane: str, tokens: int, event, loop=None):
+        self.lane = lane
+        self.tokens = tokens
+        self.granted = False
+        self.event = event
+        self.loop = loop
+
+    def wake(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.event.set)
+        else:
+            self.event.set()
+
+
+class OutboundLimiter:
+    """Requests-per-minute and tokens-per-minute buckets, pause and wait queue of one backend."""
+
+    def __init__(self, rpm: int, tpm: int):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.paused_until = 0.0
+        self.queue = []  # heap of (lane priority, sequence, ticket)
+        self.granted = 0
+        self.timeouts = 0
+        self.throttled = 0
+
+    def wait_for(self, tokens: int, now: float) -> float:
+        self.requests.refill(now)
+        self.tokens.refill(now)
+        return max(self.paused_until - now, self.requests.wait_for(1), self.tokens.wait_for(tokens))
+
+
+class OutboundScheduler:
+    """Paces every outbound LLM call to the providers' rate limits.
+    
+    Each backend has RPM and TPM token buckets, charged with an estimate
+    made before the call, and a pause set from retry-after when the
+    provider answers 429/529. Calls that cannot go yet wait in priority
+    order: the interactive lane (translations) ahead of the background lane
+    (error analysis), first come first served within a lane. A call that
+    would wait past its deadline gives up instead.
+    """
+
+    def __init__(self, limits: Dict[str, tuple]):
+        self._lock = threading.Lock()
+        self._sequence = 0
+        self.limiters = {name: OutboundLimiter(rpm, tpm) for name, (rpm, tpm) in limits.items()}
+
+    def _enqueue(self, limiter: OutboundLimiter, ticket: OutboundTicket) -> float:
+        # Called with the lock held
+        self._sequence += 1
+        heapq.heappush(limiter.queue, (OUTBOUND_LANES[ticket.lane], self._sequence, ticket))
+        return self._dispatch(limiter)
+
+    def _dispatch(self, limiter: OutboundLimiter) -> float:
+        """Grant queued tickets in priority order while capacity lasts; return the head's wait."""
+        # Called with the lock held
+        now = time.monotonic()
+        while limiter.queue:
+            ticket = limiter.queue[0][2]
+            wait = limiter.wait_for(ticket.tokens, now)
+            if wait > 0:
+                return wait
+            heapq.heappop(limiter.queue)
+            limiter.requests.take(1)
+            limiter.tokens.take(ticket.tokens)
+            limiter.granted += 1
+            ticket.granted = True
+            ticket.wake()
+        return 0.0
+
+    def _give_up(self, limiter: OutboundLimiter, ticket: OutboundTicket) -> bool:
+        """Leave the queue at the deadline; True when the ticket was granted meanwhile."""
+        with self._lock:
+            if ticket.granted:
+                return True
+            limiter.queue = [entry for entry in limiter.queue if entry[2] is not ticket]
+            heapq.heapify(limiter.queue)
+            limiter.timeouts += 1
+            self._dispatch(limiter)
+            return False
+
+    def acquire(self, backend: str, tokens: int, lane: str, deadline: RequestDeadline) -> bool:
+        """Wait for a slot to call `backend`; False when the deadline passes first."""
+        limiter = self.limiters[backend]
+        ticket = OutboundTicket(lane, tokens, threading.Event())
+        started = time.monotonic()
+        with self._lock:
+            wait = self._enqueue(limiter, ticket)
+        while not ticket.granted:
+            remaining = deadline.remaining()
+            if remaining <= 0:
+                if self._give_up(limiter, ticket):
+                    break
+                return False
+            # Woken early when another caller's dispatch grants this ticket
+            ticket.event.wait(min(max(wait, 0.01), remaining))
+            with self._lock:
+                if not ticket.granted:
+                    wait = self._dispatch(limiter)
+        metrics.observe("relay_outbound_wait_seconds", time.monotonic() - started, backend=backend, lane=lane)
+        return True
+
+    async def acquire_async(self, backend: str, tokens: int, lane: str, deadline: RequestDeadline) -> bool:
+        """Async variant of acquire."""
+        limiter = self.limiters[backend]
+        ticket = OutboundTicket(lane, tokens, asyncio.Event(), asyncio.get_running_loop())
+        started = time.monotonic()
+        with self._lock:
+            wait = self._enqueue(limiter, ticket)
+        try:
+            while not ticket.granted:
+                remaining = deadline.remaining()
+                if remaining <= 0:
+                    if self._give_up(limiter, ticket):
+                        break
+                    return False
+                try:
+                    await asyncio.wait_for(ticket.event.wait(), min(max(wait, 0.01), remaining))
+                except asyncio.TimeoutError:
+                    pass
+                with self._lock:
+                    if not ticket.granted:
+                        wait = self._dispatch(limiter)
+        except asyncio.CancelledError:
+            self._give_up(limiter, ticket)
+            raise
+        metrics.observe("relay_outbound_wait_seconds", time.monotonic() - started, backend=backend, lane=lane)
+        return True
+
+    def throttled(self, backend: str, status: int, retry_after: Optional[str]) -> Optional[float]:
+        """Pause a backend after a 429/529 answer; returns the pause, or None for other statuses."""
+        if status not in (429, 529):
+            return None
+        pause = parse_retry_after(retry_after)
+        if pause is None:
+            pause = CONFIG['rate_limit_pause']
+        limiter = self.limiters[backend]
+        with self._lock:
+            limiter.paused_until = max(limiter.paused_until, time.monotonic() + pause)
+            limiter.throttled += 1
+        metrics.inc("relay_outbound_throttled_total", backend=backend, status=status)
+        logger.warning(f"{backend} backend answered {status}, pausing calls for {pause:g}s")
+        return pause
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            now = time.monotonic()
+            result = {}
+            for name, limiter in self.limiters.items():
+                limiter.wait_for(0, now)
+                result[name] = {
+                    "rpm_limit": int(limiter.requests.capacity),
+                    "tpm_limit": int(limiter.tokens.capacity),
+                    "requests_available": int(limiter.requests.level) if limiter.requests.capacity else None,
+                    "tokens_available": int(limiter.tokens.level) if limiter.tokens.capacity else None,
+                    "paused_for": round(max(0.0, limiter.paused_until - now), 3),
+                    "queued": {lane: sum(1 for _, _, ticket in limiter.queue if ticket.lane == lane)
+                               for lane in OUTBOUND_LANES},
+                    "granted": limiter.granted,
+                    "timeouts": limiter.timeouts,
+                    "throttled": limiter.throttled,
+                }
+            return result
+
+
+# Single scheduler for every outbound LLM call, keyed by backend name
+outbound_scheduler = OutboundScheduler({
+    'anthropic': (CONFIG['claude_rpm_limit'], CONFIG['claude_tpm_limit']),
+    'local': (CONFIG['local_llm_rpm_limit'], CONFIG['local_llm_tpm_limit']),
+})
+
+
+class LLMBackend:
+    """One completion provider: request format, response parsing and connection pools."""
+    name = ""
+
+    def __init__(self, url: str, model: str, http: PooledHTTPClient, async_http: Optional[AsyncHTTPClient]):
+        self.url = url
+        self.model = model
+        self.http = http
+        self.async_http = async_http
+        self.breaker = CircuitBreaker(self.name, CONFIG['circuit_failure_threshold'], CONFIG['circuit_open_seconds'])
+        self.latency = LatencyWindow()
+
+    def configured(self) -> bool:
+        return bool(self.url)
+
+    def build_payload(self, user_message: str, system_prompt: str, stream: bool = False) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def headers(self) -> Dict[str, str]:
+        raise NotImplementedError
+
+    def extract_text(self, result: Dict[str, Any]) -> Optional[str]:
+        raise NotImplementedError
+
+    def parse_stream_line(self, line: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def complete(self, user_message: str, system_prompt: str, deadline: RequestDeadline,
+                 lane: str = 'interactive') -> Optional[str]:
+        """Return the completion text, or None when the call failed.
+        
+        The call waits for the outbound scheduler, and a 429/529 answer is
+        retried after its retry-after pause while the deadline allows.
+        """
+        payload = self.build_payload(user_message, system_prompt)
+        tokens = estimate_tokens(system_prompt, user_message)
+        try:
+            for attempt in range(CONFIG['rate_limit_retries'] + 1):
+                if not outbound_scheduler.acquire(self.name, tokens, lane, deadline):
+                    return self.rate_limited(deadline)
+                started = time.monotonic()
+                with metrics.timer("relay_stage_duration_seconds", stage="claude_api"):
+                    response = self.http.post(
+                        self.url,
+                        budget=deadline.remaining(),
+                        headers=self.headers(),
+                        json=payload,
+                    )
+                    body = response.content
+                metrics.inc("relay_upstream_responses_total", backend=self.name, status=response.status_code)
+                if not self.retry_throttled(response.status_code, response.headers.get("retry-after"),
+                                            attempt, deadline):
+                    break
+            self.breaker.record_status(response.status_code)
+            if not response.ok:
+                record_upstream_outcome("failed", self.name)
+            response.raise_for_status()
+            self.latency.observe(time.monotonic() - started)
+            record_upstream_outcome(completed_outcome(deadline), self.name)
+            return self.extract_text(json.loads(body))
+        
+        except requests.exceptions.RequestException as e:
+            if getattr(e, "response", None) is None:
+                metrics.inc("relay_upstream_responses_total", backend=self.name, status="error")
+                self.breaker.record_error(deadline.is_cancelled())
+                record_upstream_outcome("aborted" if deadline.expired() else "failed", self.name)
+            logger.error(f"{self.name} backend request failed: {e}")
+            return None
+        except Exception as e:
+            logger.error(f"Error processing {self.name} backend response: {e}")
+            return None
+
+    async def complete_async(self, user_message: str, system_prompt: str,
+                             deadline: RequestDeadline, lane: str = 'interactive') -> Optional[str]:
+        """Async variant of complete for the asgi serving mode."""
+        payload = self.build_payload(user_message, system_prompt)
+        tokens = estimate_tokens(system_prompt, user_message)
+        try:
+            for attempt in range(CONFIG['rate_limit_retries'] + 1):
+                if not await outbound_scheduler.acquire_async(self.name, tokens, lane, deadline):
+                    return self.rate_limited(deadline)
+                started = time.monotonic()
+                with metrics.timer("relay_stage_duration_seconds", stage="claude_api"):
+                    response = await self.async_http.post(
+                        self.url,
+                        budget=deadline.remaining(),
+                        headers=self.headers(),
+                        json=payload,
+                    )
+                metrics.inc("relay_upstream_responses_total", backend=self.name, status=response.status_code)
+                if not self.retry_throttled(response.status_code, response.headers.get("retry-after"),
+                                            attempt, deadline):
+                    break
+            self.breaker.record_status(response.status_code)
+            if not response.is_success:
+                record_upstream_outcome("failed", self.name)
+            response.raise_for_status()
+            self.latency.observe(time.monotonic() - started)
+            record_upstream_outcome(completed_outcome(deadline), self.name)
+            return self.extract_text(response.json())
+        
+        except asyncio.CancelledError:
+            # Lost a hedge race or the caller went away
+            self.breaker.record_error(cancelled=True)
+            record_upstream_outcome("aborted", self.name)
+            raise
+        except httpx.HTTPError as e:
+            if not isinstance(e, httpx.HTTPStatusError):
+                metrics.inc("relay_upstream_responses_total", backend=self.name, status="error")
+                self.breaker.record_error(deadline.is_cancelled())
+                record_upstream_outcome("aborted" if deadline.expired() else "failed", self.name)
+            logger.error(f"{self.name} backend request failed: {e}")
+            return None
+        except Exception as e:
+            logger.error(f"Error processing {self.name} backend response: {e}")
+            return None
+
+    def rate_limited(self, deadline: RequestDeadline) -> None:
+        """Give up a call that could not get a scheduler slot before its deadline."""
+        self.breaker.record_error(cancelled=True)
+        record_upstream_outcome("skipped", self.name)
+        logger.warning(f"Skipping {self.name} backend call: rate limit wait exceeds the deadline")
+        return None
+
+    def retry_throttled(self, status: int, retry_after: Optional[str], attempt: int,
+                        deadline: RequestDeadline) -> bool:
+        """Pause the backend on 429/529 and tell whether the call should be retried after the pause."""
+        pause = outbound_scheduler.throttled(self.name, status, retry_after)
+        if pause is None or attempt >= CONFIG['rate_limit_retries'] or pause >= deadline.remaining():
+            return False
+        record_upstream_outcome("throttled", self.name)
+        return True
+
+    def hedge_delay(self, deadline: RequestDeadline) -> Optional[float]:
+        """Seconds to wait before sending a duplicate call, or None to not hedge this one."""
+        if not CONFIG['hedge_enabled'] or self.breaker.state != "closed":
+            return None
+        p95 = self.latency.quantile(0.95, CONFIG['hedge_min_samples'])
+        if p95 is None or p95 >= deadline.remaining():
+            return None
+        return p95
+
+    def complete_hedged(self, user_message: str, system_prompt: str, deadline: RequestDeadline,
+                        lane: str = 'interactive') -> Optional[str]:
+        """complete(), racing a duplicate call once the first outlives the backend's p95.
+        
+        The first answer wins. The other call cannot be interrupted in this
+        mode, so its deadline is cancelled and a late answer counts as wasted.
+        """
+        delay = self.hedge_delay(deadline)
+        if delay is None:
+            return self.complete(user_message, system_prompt, deadline, lane)
+        
+        original = deadline.fork()
+        future = hedge_pool.submit(contextvars.copy_context().run, self.complete, user_message, system_prompt,
+                                   original, lane)
+        calls = {future: ("original", original)}
+        done, pending = wait_futures(calls, timeout=delay)
+        if not done and self.breaker.allow():
+            duplicate = deadline.fork()
+            future = hedge_pool.submit(contextvars.copy_context().run, self.complete, user_message, system_prompt,
+                                       duplicate, lane)
+            calls[future] = ("duplicate", duplicate)
+            pending.add(future)
+            metrics.inc("relay_hedges_total", backend=self.name, result="sent")
+        
+        text, winner = None, None
+        try:
+            while True:
+                for future in done:
+                    if text is None and future.result() is not None:
+                        text, winner = future.result(), calls[future][0]
+                if text is not None or not pending:
+                    break
+                done, pending = wait_futures(pending, timeout=deadline.remaining(), return_when=FIRST_COMPLETED)
+                if not done:
+                    break
+        finally:
+            for future in pending:
+                calls[future][1].cancel()
+        if winner and len(calls) > 1:
+            metrics.inc("relay_hedges_total", backend=self.name, result="won" if winner == "duplicate" else "lost")
+        return text
+
+    async def complete_hedged_async(self, user_message: str, system_prompt: str,
+                                    deadline: RequestDeadline, lane: str = 'interactive') -> Optional[str]:
+        """Async variant of complete_hedged; the losing call is cancelled."""
+        delay = self.hedge_delay(deadline)
+        if delay is None:
+            return await self.complete_async(user_message, system_prompt, deadline, lane)
+        
+        calls = {asyncio.ensure_future(self.complete_async(user_message, system_prompt, deadline, lane)): "original"}
+        pending = set(calls)
+        text, winner = None, None
+        try:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if not done and self.breaker.allow():
+                future = asyncio.ensure_future(self.complete_async(user_message, system_prompt, deadline, lane))
+                calls[future] = "duplicate"
+                pending.add(future)
+                metrics.inc("relay_hedges_total", backend=self.name, result="sent")
+            while True:
+                for future in done:
+                    if text is None and future.result() is not None:
+                        text, winner = future.result(), calls[future]
+                if text is not None or not pending:
+                    break
+                done, pending = await asyncio.wait(pending, timeout=deadline.remaining(),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break
+        finally:
+            for future in pending:
+                future.cancel()
+        if winner and len(calls) > 1:
+            metrics.inc("relay_hedges_total", backend=self.name, result="won" if winner == "duplicate" else "lost")
+        return text
+
+    def open_stream(self, user_message: str, system_prompt: str, deadline: RequestDeadline,
+                    lane: str = 'interactive') -> requests.Response:
+        """Start a streamed completion; raises RequestException when it cannot start.
+        
+        The caller has claimed the breaker with allow(); every path out of
+        here either judges the call or releases the probe.
+        """
+        judged = False
+        try:
+            payload = self.build_payload(user_message, system_prompt, stream=True)
+            if not outbound_scheduler.acquire(self.name, estimate_tokens(system_prompt, user_message), lane, deadline):
+                raise requests.exceptions.Timeout(f"{self.name} rate limit wait exceeds the deadline")
+            try:
+                response = self.http.post(self.url, budget=deadline.remaining(), headers=self.headers(),
+                                          json=payload, stream=True)
+            except requests.exceptions.RequestException:
+                metrics.inc("relay_upstream_responses_total", backend=self.name, status="error")
+                judged = True
+                self.breaker.record_failure()
+                raise
+            metrics.inc("relay_upstream_responses_total", backend=self.name, status=response.status_code)
+            judged = True
+            self.breaker.record_status(response.status_code)
+        finally:
+            if not judged:
+                self.breaker.release_probe()
+        outbound_scheduler.throttled(self.name, response.status_code, response.headers.get("retry-after"))
+        if not response.ok:
+            response.close()
+            response.raise_for_status()
+        return response
+
+    async def open_stream_async(self, user_message: str, system_prompt: str, deadline: RequestDeadline,
+                                lane: str = 'interactive') -> "httpx.Response":
+        """Async variant of open_stream; the caller must aclose() the response."""
+        judged = False
+        try:
+            payload = self.build_payload(user_message, system_prompt, stream=True)
+            if not await outbound_scheduler.acquire_async(self.name, estimate_tokens(system_prompt, user_message),
+                                                          lane, deadline):
+                raise httpx.TimeoutException(f"{self.name} rate limit wait exceeds the deadline")
+            try:
+                response = await self.async_http.open_stream(self.url, budget=deadline.remaining(),
+                                                             headers=self.headers(), json=payload)
+            except httpx.HTTPError:
+                metrics.inc("relay_upstream_responses_total", backend=self.name, status="error")
+                judged = True
+                self.breaker.record_failure()
+                raise
+            metrics.inc("relay_upstream_responses_total", backend=self.name, status=response.status_code)
+            judged = True
+            self.breaker.record_status(response.status_code)
+        finally:
+            if not judged:
+                self.breaker.release_probe()
+        outbound_scheduler.throttled(self.name, response.status_code, response.headers.get("retry-after"))
+        if not response.is_success:
+            await response.aclose()
+            response.raise_for_status()
+        return response
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "configured": self.configured(),
+            "url": self.url,
+            "model": self.model,
+            "circuit": self.breaker.stats(),
+            "latency_p95": self.latency.quantile(0.95),
+            "http_pool": self.http.stats(),
+            "async_http_pool": self.async_http.stats() if self.async_http else None,
+        }
+
+
+class AnthropicBackend(LLMBackend):
+    """Anthropic Messages API (CLAUDE_API_URL)."""
+    name = "anthropic"
+
+    def configured(self) -> bool:
+        return bool(self.url and CONFIG['claude_api_key'])
+
+    def build_payload(self, user_message: str, system_prompt: str, stream: bool = False) -> Dict[str, Any]:
+        payload = build_claude_payload(user_message, system_prompt)
+        if stream:
+            payload["stream"] = True
+        return payload
+
+    def headers(self) -> Dict[str, str]:
+        return build_claude_headers()
+
+    def extract_text(self, result: Dict[str, Any]) -> Optional[str]:
+        return extract_claude_text(result)
+
+    def parse_stream_line(self, line: str) -> Optional[str]:
+        return parse_claude_stream_line(line)
+
+
+class OpenAICompatibleBackend(LLMBackend):
+    """OpenAI-compatible chat completions server, e.g. llama.cpp or Ollama on the LAN (LOCAL_LLM_URL)."""
+    name = "local"
+
+    def __init__(self, url: str, model: str, api_key: str, http: PooledHTTPClient,
+                 async_http: Optional[AsyncHTTPClient]):
+        super().__init__(url, model, http, async_http)
+        self.api_key = api_key
+
+    def build_payload(self, user_message: str, system_prompt: str, stream: bool = False) -> Dict[str, Any]:
+        return {
+            "model": self.model,
+            "max_tokens": 1024,
+            "stream": stream,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_message},
+            ],
+        }
+
+    def headers(self) -> Dict[str, str]:
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        return headers
+
+    def record_usage(self, usage: Optional[Dict[str, Any]]):
+        if usage:
+            record_claude_usage({
+                "input_tokens": usage.get("prompt_tokens"),
+                "output_tokens": usage.get("completion_tokens"),
+            }, backend=self.name)
+
+    def extract_text(self, result: Dict[str, Any]) -> Optional[str]:
+        self.record_usage(result.get("usage"))
+        choices = result.get("choices") or []
+        if choices and isinstance(choices[0].get("message"), dict):
+            return (choices[0]["message"].get("content") or "").strip()
+        logger.error(f"Unexpected local LLM response: {result}")
+        return None
+
+    def parse_stream_line(self, line: str) -> Optional[str]:
+        if not line or not line.startswith("data:"):
+            return None
+        data = line[5:].strip()
+        if data == "[DONE]":
+            return None
+        event = json.loads(data)
+        if "error" in event:
+            error = event["error"]
+            raise RuntimeError(error.get("message", "Local LLM stream error") if isinstance(error, dict) else str(error))
+        self.record_usage(event.get("usage"))
+        choices = event.get("choices") or []
+        if choices:
+            return (choices[0].get("delta") or {}).get("content")
+        return None
+
+
+local_llm_http = PooledHTTPClient(
+    CONFIG['local_llm_max_connections'],
+    CONFIG['local_llm_connect_timeout'],
+    CONFIG['local_llm_attempt_timeout'],
+    CONFIG['api_max_attempts'],
+)
+
+async_local_llm_http = AsyncHTTPClient(
+    CONFIG['local_llm_max_connections'],
+    CONFIG['local_llm_connect_timeout'],
+    CONFIG['local_llm_attempt_timeout'],
+    CONFIG['api_max_attempts'],
+) if ASGI_AVAILABLE else None
+
+llm_backends = {
+    'anthropic': AnthropicBackend(CONFIG['claude_api_url'], CONFIG['claude_model'], claude_http, async_claude_http),
+    'local': OpenAICompatibleBackend(CONFIG['local_llm_url'], CONFIG['local_llm_model'], CONFIG['local_llm_api_key'],
+                                     local_llm_http, async_local_llm_http),
+}
+
+
+def parse_backend_order(value: str) -> list:
+    """Backend names from a comma-separated list; empty means CLAUDE_MODE alone."""
+    names = [name.strip().lower() for name in (value or CONFIG['claude_mode']).split(",") if name.strip()]
+    unknown = [name for name in names if name not in llm_backends]
+    if unknown:
+        logger.warning(f"Ignoring unknown LLM backends: {', '.join(unknown)}")
+    return [name for name in dict.fromkeys(names) if name in llm_backends]
+
+
+LLM_TASK_BACKENDS = {
+    'translate': parse_backend_order(CONFIG['llm_backends_translate']),
+    'error_fix': parse_backend_order(CONFIG['llm_backends_error_fix']),
+}
+# Tasks without an order of their own, and the task whose order they follow
+SHARED_BACKEND_ORDERS = {'summarize': 'translate'}
+
+
+def backends_for(task: str) -> list:
+    """Configured backends for a task, in fallback order."""
+    order = LLM_TASK_BACKENDS[SHARED_BACKEND_ORDERS.get(task, task)]
+    return [llm_backends[name] for name in order if llm_backends[name].configured()]
+
+
+def active_backends() -> list:
+    """Configured backends used by at least one task."""
+    names = dict.fromkeys(name for order in LLM_TASK_BACKENDS.values() for name in order)
+    return [llm_backends[name] for name in names if llm_backends[name].configured()]
+
+
+def circuits_open(task: str) -> bool:
+    """True when the task has backends and every one of them refuses calls."""
+    backends = backends_for(task)
+    return bool(backends) and not any(backend.breaker.available() for backend in backends)
+
+
+def llm_retry_after(task: str) -> int:
+    """Whole seconds until the first of the task's open circuits lets a probe through."""
+    waits = [backend.breaker.retry_after() for backend in backends_for(task)]
+    return max(1, int(min(waits) + 0.999)) if waits else CONFIG['busy_retry_after']
+
+
+# Threads running hedged calls; at most two per caller thread, created on demand
+hedge_pool = ThreadPoolExecutor(max_workers=2 * (CONFIG['max_workers'] + CONFIG['http_workers']),
+                                thread_name_prefix='hedge')
+
+
+def record_fallback(task: str, failed: LLMBackend, following: LLMBackend):
+    metrics.inc("relay_llm_fallbacks_total", task=task, backend=failed.name)
+    logger.warning(f"{failed.name} backend failed for {task}, falling back to {following.name}")
+
+
+def call_claude_api(user_message: str, custom_system_prompt: Optional[str] = None,
+                    deadline: Optional[RequestDeadline] = None, task: str = 'translate') -> Optional[str]:
+    """Get a completion from the task's LLM backends, in fallback order.
+    
+    Backends whose circuit is open are skipped without a network call, and
+    slow calls are hedged (see LLMBackend.complete_hedged).
+    
+    Args:
+        user_message: The user's message/command
+        custom_system_prompt: Optional custom system prompt (if None, uses default)
+        deadline: Caller deadline; the calls use only the remaining budget
+        task: 'translate' or 'error_fix', selects the backend order
+    """
+    return call_llm(user_message, custom_system_prompt, deadline, task)[0]
+
+
+def call_llm(user_message: str, custom_system_prompt: Optional[str] = None,
+             deadline: Optional[RequestDeadline] = None, task: str = 'translate') -> tuple:
+    """call_claude_api, also naming the backend that answered.
+    
+    Returns:
+        tuple: (text or None, LLMBackend or None)
+    """
+    backends = backends_for(task)
+    if not backends:
+        logger.error(f"No LLM backend configured for {task}")
+        return None, None
+    deadline = deadline or RequestDeadline(CONFIG['request_timeout'])
+    
+    with metrics.timer("relay_stage_duration_seconds", stage="prompt_build"):
+        system_prompt = custom_system_prompt or build_system_prompt()
+    
+    for index, backend in enumerate(backends):
+        if deadline.expired():
+            record_upstream_outcome("skipped", backend.name)
+            logger.warning("Skipping LLM call: caller deadline passed")
+            return None, None
+        if backend.breaker.allow():
+            text = backend.complete_hedged(user_message, system_prompt, deadline, TASK_LANES[task])
+        else:
+            record_upstream_outcome("short_circuited", backend.name)
+            text = None
+        if text is not None:
+            return text, backend
+        if index + 1 < len(backends):
+            record_fallback(task, backend, backends[index + 1])
+    return None, None
+
+
+def stream_claude_api(user_message: str, custom_system_prompt: Optional[str] = None,
+                      task: str = 'translate', deadline: Optional[RequestDeadline] = None) -> Iterator[str]:
+    """Stream a completion from the task's LLM backends and yield text as it arrives.
+    
+    The next backend is tried only while no text has been sent and the
+    caller's deadline allows. Raises on configuration or upstream errors so
+    the caller can report them inside the stream.
+    """
+    backends = backends_for(task)
+    if not backends:
+        raise RuntimeError(f"No LLM backend configured for {task}")
+    deadline = deadline or RequestDeadline(CONFIG['request_timeout'])
+    
+    with metrics.timer("relay_stage_duration_seconds", stage="prompt_build"):
+        system_prompt = custom_system_prompt or build_system_prompt()
+    
+    for index, backend in enumerate(backends):
+        deadline.check()
+        if not backend.breaker.allow():
+            if index + 1 == len(backends):
+                raise RuntimeError(f"LLM backends unavailable, retry in {llm_retry_after(task)}s")
+            record_fallback(task, backend, backends[index + 1])
+            continue
+        try:
+            response = backend.open_stream(user_message, system_prompt, deadline, TASK_LANES[task])
+        except requests.exceptions.RequestException:
+            if index + 1 == len(backends):
+                raise
+            record_fallback(task, backend, backends[index + 1])
+            continue
+        with response:
+            for line in response.iter_lines(decode_unicode=True):
+                text = backend.parse_stream_line(line)
+                if text:
+                    yield text
+        return
+
+
+# ============================================================================
+# USAGE ACCOUNTING
+# ============================================================================
+# Requests, tokens and latency are counted per router and endpoint in memory
+# and added to a SQLite file (one row per day, router and endpoint) by a
+# background flush. The router comes from the request's router_id, the
+# X-Router-Id header or the client address, and is carried to worker threads
+# in usage_scope.
+
+USAGE_FIELDS = ('requests', 'input_tokens', 'output_tokens', 'cache_read_tokens', 'cache_write_tokens', 'latency_ms')
+USAGE_TOKEN_FIELDS = {
+    'input_tokens': 'input_tokens',
+    'output_tokens': 'output_tokens',
+    'cache_read_input_tokens': 'cache_read_tokens',
+    'cache_creation_input_tokens': 'cache_write_tokens',
+}
+
+# identified: the router named itself (router_id or X-Router-Id) rather than
+# being known only by its client address
+UsageScope = namedtuple('UsageScope', 'router endpoint identified')
+
+# Router and endpoint the current request is accounted to; copied into worker threads
+usage_scope = contextvars.ContextVar('usage_scope', default=None)
+
+
+def request_router(data: Optional[Dict], header_value: Optional[str], remote_addr: Optional[str]) -> tuple:
+    """Identify the calling router: router_id in the body, X-Router-Id, then the client address.
+    
+    Returns:
+        tuple: (router, identified) - identified is False when only the
+        client address was available.
+    """
+    router = data.get('router_id') if isinstance(data, dict) else None
+    named = str(router or header_value or "").strip()[:64]
+    if named:
+        return named, True
+    return str(remote_addr or "unknown").strip()[:64] or "unknown", False
+
+
+def parse_quotas(value: str) -> Dict[str, int]:
+    """Per-router daily token quotas from "router=tokens,router=tokens"."""
+    quotas = {}
+    for item in (value or "").split(","):
+        router, _, tokens = item.partition("=")
+        if router.strip() and tokens.strip().isdigit():
+            quotas[router.strip()] = int(tokens)
+        elif item.strip():
+            logger.warning(f"Ignoring malformed usage quota: {item.strip()}")
+    return quotas
+
+
+def usage_day() -> str:
+    return datetime.utcnow().strftime("%Y-%m-%d")
+
+
+class SQLiteUsageStore:
+    """Daily usage counters, one row per (day, router, endpoint)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS usage (day TEXT, router TEXT, endpoint TEXT, "
+            f"{', '.join(f'{field} INTEGER' for field in USAGE_FIELDS)}, "
+            "PRIMARY KEY (day, router, endpoint)) WITHOUT ROWID"
+        )
+
+    def add(self, deltas: Dict[tuple, list]):
+        """Add counters to the stored rows in one transaction."""
+        columns = ', '.join(USAGE_FIELDS)
+        updates = ', '.join(f"{field} = {field} + excluded.{field}" for field in USAGE_FIELDS)
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                f"INSERT INTO usage (day, router, endpoint, {columns}) "
+                f"VALUES (?, ?, ?, {', '.join('?' * len(USAGE_FIELDS))}) "
+                f"ON CONFLICT (day, router, endpoint) DO UPDATE SET {updates}",
+                [key + tuple(values) for key, values in deltas.items()],
+            )
+            self._conn.execute("COMMIT")
+
+    def query(self, since: str, router: Optional[str] = None) -> Iterator[tuple]:
+        """Yield ((day, router, endpoint), counters) for days from `since` on."""
+        sql = f"SELECT day, router, endpoint, {', '.join(USAGE_FIELDS)} FROM usage WHERE day >= ?"
+        params = [since]
+        if router:
+            sql += " AND router = ?"
+            params.append(router)
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        for row in rows:
+            yield tuple(row[:3]), list(row[3:])
+
+    def prune(self, before: str) -> int:
+        with self._lock:
+            return self._conn.execute("DELETE FROM usage WHERE day < ?", (before,)).rowcount
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class UsageLedger:
+    """In-memory usage counters with daily token quotas per router.
+    
+    Counters accumulate as deltas until flush() adds them to the store.
+    Quotas count input and output tokens of the current UTC day, including
+    what was flushed before a restart.
+    """
+
+    def __init__(self, store: Optional[SQLiteUsageStore], daily_quota: int, router_quotas: Dict[str, int],
+                 retention_days: int):
+        self.store = store
+        self.daily_quota = daily_quota
+        self.router_quotas = router_quotas
+        self.retention_days = retention_days
+        self._lock = threading.Lock()
+        self._pending = {}  # (day, router, endpoint) -> counters not yet flushed
+        self._day = usage_day()
+        self._tokens_today = {}  # router -> input + output tokens today
+        self.flushes = 0
+        self.flush_errors = 0
+        if store:
+            for (day, router, _), counters in store.query(self._day):
+                self._tokens_today[router] = self._tokens_today.get(router, 0) + self._quota_tokens(counters)
+
+    @staticmethod
+    def _quota_tokens(counters: list) -> int:
+        return counters[USAGE_FIELDS.index('input_tokens')] + counters[USAGE_FIELDS.index('output_tokens')]
+
+    def _counters(self, scope: UsageScope) -> list:
+        # Called with the lock held
+        day = usage_day()
+        if day != self._day:
+            self._day = day
+            self._tokens_today = {}
+        key = (day, scope.router, scope.endpoint)
+        counters = self._pending.get(key)
+        if counters is None:
+            counters = self._pending[key] = [0] * len(USAGE_FIELDS)
+        return counters
+
+    def record_request(self, scope: UsageScope, seconds: float):
+        with self._lock:
+            counters = self._counters(scope)
+            counters[0] += 1
+            counters[USAGE_FIELDS.index('latency_ms')] += int(seconds * 1000)
+
+    def record_tokens(self, scope: Optional[UsageScope], usage: Dict[str, Any]):
+        """Add the token counts of an LLM usage object to the request's router and endpoint."""
+        if scope is None:
+            return
+        with self._lock:
+            counters = self._counters(scope)
+            for field, name in USAGE_TOKEN_FIELDS.items():
+                counters[USAGE_FIELDS.index(name)] += int(usage.get(field) or 0)
+            spent = int(usage.get('input_tokens') or 0) + int(usage.get('output_tokens') or 0)
+            self._tokens_today[scope.router] = self._tokens_today.get(scope.router, 0) + spent
+
+    def quota(self, router: str) -> int:
+        """Daily token quota of a router; 0 means unlimited."""
+        return self.router_quotas.get(router, self.daily_quota)
+
+    def over_quota(self, scope: Optional[UsageScope]) -> bool:
+        if scope is None:
+            return False
+        quota = self.quota(scope.router)
+        if not quota:
+            return False
+        with self._lock:
+            if self._day != usage_day():
+                return False
+            return self._tokens_today.get(scope.router, 0) >= quota
+
+    def flush(self):
+        """Add pending counters to the store and drop rows past the retention period."""
+        if not self.store:
+            return  # Without a store the counters stay in memory
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        try:
+            self.store.add(pending)
+            if self.retention_days > 0:
+                cutoff = (datetime.utcnow() - timedelta(days=self.retention_days)).strftime("%Y-%m-%d")
+                self.store.prune(cutoff)
+            self.flushes += 1
+        except sqlite3.Error as e:
+            logger.error(f"Usage flush failed, keeping counters for the next one: {e}")
+            with self._lock:
+                self.flush_errors += 1
+                for key, counters in pending.items():
+                    merged = self._pending.setdefault(key, [0] * len(USAGE_FIELDS))
+                    for i, value in enumerate(counters):
+                        merged[i] += value
+
+    def query(self, days: int, router: Optional[str] = None) -> Dict[str, Any]:
+        """Usage per router and endpoint over the last `days` days, stored and pending."""
+        since = (datetime.utcnow() - timedelta(days=max(days, 1) - 1)).strftime("%Y-%m-%d")
+        totals = {}
+        rows = list(self.store.query(since, router)) if self.store else []
+        with self._lock:
+            rows += [(key, list(counters)) for key, counters in self._pending.items()
+                     if key[0] >= since and (not router or key[1] == router)]
+            tokens_today = dict(self._tokens_today)
+        for (_, row_router, endpoint), counters in rows:
+            endpoints = totals.setdefault(row_router, {})
+            merged = endpoints.setdefault(endpoint, [0] * len(USAGE_FIELDS))
+            for i, value in enumerate(counters):
+                merged[i] += value
+        
+        routers = {}
+        for row_router, endpoints in sorted(totals.items()):
+            summary = [sum(values) for values in zip(*endpoints.values())]
+            routers[row_router] = {
+                "total": self._summarize(summary),
+                "endpoints": {endpoint: self._summarize(counters) for endpoint, counters in sorted(endpoints.items())},
+                "quota": {"daily_tokens": self.quota(row_router), "used_today": tokens_today.get(row_router, 0)},
+            }
+        return {"since": since, "routers": routers}
+
+    @staticmethod
+    def _summarize(counters: list) -> Dict[str, Any]:
+        summary = dict(zip(USAGE_FIELDS, counters))
+        latency_ms = summary.pop('latency_ms')
+        summary['avg_latency_ms'] = round(latency_ms / summary['requests'], 1) if summary['requests'] else 0.0
+        return summary
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "store": self.store.path if self.store else None,
+                "pending_rows": len(self._pending),
+                "routers_today": len(self._tokens_today),
+                "daily_quota": self.daily_quota,
+                "flushes": self.flushes,
+                "flush_errors": self.flush_errors,
+            }
+
+    def close(self):
+        self.flush()
+        if self.store:
+            self.store.close()
+
+
+class UsageFlusher(threading.Thread):
+    """Flushes the usage ledger to its store every `interval` seconds."""
+
+    def __init__(self, ledger: UsageLedger, interval: float):
+        super().__init__(name="usage-flusher", daemon=True)
+        self.ledger = ledger
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.ledger.flush()
+
+    def stop(self):
+        self._stop_event.set()
+
+
+usage_ledger = UsageLedger(
+    SQLiteUsageStore(CONFIG['usage_store_path']) if CONFIG['usage_store_path'] else None,
+    CONFIG['usage_daily_token_quota'],
+    parse_quotas(CONFIG['usage_router_quotas']),
+    CONFIG['usage_retention_days'],
+)
+
+
+def accounted(endpoint: str):
+    """Decorator accounting a Flask view's requests and LLM usage to the calling router.
+    
+    The scope is left set after the view returns so streamed responses,
+    produced later on the same thread, are still accounted.
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            router, identified = request_router(request.get_json(silent=True), request.headers.get('X-Router-Id'),
+                                                request.remote_addr)
+            scope = UsageScope(router, endpoint, identified)
+            usage_scope.set(scope)
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                usage_ledger.record_request(scope, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def quota_exceeded_body(scope: UsageScope) -> Dict[str, Any]:
+    metrics.inc("relay_quota_rejections_total", endpoint=scope.endpoint)
+    return {
+        "success": False,
+        "error": f"Daily token quota exceeded for router {scope.router}",
+        "quota_exceeded": True,
+    }
+
+
+# ============================================================================
+# CONVERSATION SESSIONS
+# ============================================================================
+# Each router keeps its last SESSION_MAX_TURNS translations (within
+# SESSION_TOKEN_BUDGET) so follow-ups such as "now block the second one" can
+# be resolved. Sessions are kept in LRU order of last use: idle sessions
+# expire after SESSION_TTL, and the least recently used are dropped beyond
+# SESSION_MAX_ROUTERS or SESSION_MEMORY_TOKENS. With SESSION_SUMMARIZE,
+# turns pushed out of a session are folded into a short summary by a
+# background LLM call.
+
+# command: the router's request; routeros_command: its translation; tokens: estimate_tokens of both
+SessionTurn = namedtuple('SessionTurn', 'command routeros_command tokens')
+# What a translation sees of a session: summary text and turns, oldest first
+SessionHistory = namedtuple('SessionHistory', 'summary turns')
+
+SESSION_SUMMARY_PROMPT = """You maintain the conversation memory of a RouterOS assistant. You are given an earlier summary (possibly empty) and requests that are leaving the memory, each with the RouterOS command it was translated to.
+
+Write a new summary that keeps what later requests may refer to: devices, addresses, interfaces, rules and the order in which results were listed. Drop everything else.
+
+Return only the summary, in plain text, in at most {words} words.
+"""
+
+
+class RouterSession:
+    """Turns and summary of one router (guarded by the SessionStore lock)."""
+
+    __slots__ = ('turns', 'summary', 'tokens', 'last_used', 'folding', 'summarizing')
+
+    def __init__(self):
+        self.turns = deque()
+        self.summary = ""
+        self.tokens = 0
+        self.last_used = time.monotonic()
+        self.folding = []  # turns waiting to be summarized
+        self.summarizing = False
+
+
+class SessionStore:
+    """Memory-bounded per-router conversation sessions with LRU and TTL eviction."""
+
+    def __init__(self, max_turns: int, token_budget: int, ttl: float, max_routers: int,
+                 memory_tokens: int, summarize: bool):
+        self.max_turns = max_turns
+        self.token_budget = token_budget
+        self.ttl = ttl
+        self.max_routers = max_routers
+        self.memory_tokens = memory_tokens
+        self.summarize = summarize
+        self._sessions = OrderedDict()  # router -> RouterSession, least recently used first
+        self._lock = threading.Lock()
+        self._tokens = 0
+        self._summary_pool = None
+        self.evictions = {"ttl": 0, "lru": 0, "memory": 0}
+        self.turns_dropped = 0
+        self.summaries = 0
+        self.summary_failures = 0
+
+    def enabled(self) -> bool:
+        return self.max_turns > 0 and self.token_budget > 0
+
+    def history(self, router: Optional[str]) -> Optional[SessionHistory]:
+        """Return a router's session for the next translation, or None when it has none."""
+        if router is None or not self.enabled():
+            return None
+        with self._lock:
+            self._expire(time.monotonic())
+            session = self._sessions.get(router)
+            if session is None or not (session.turns or session.summary):
+                return None
+            return SessionHistory(session.summary, tuple(session.turns))
+
+    def record(self, router: Optional[str], command: str, result: Dict[str, Any]):
+        """Append a successful translation to the router's session."""
+        if router is None or not self.enabled() or not result.get("success"):
+            return
+        turn = SessionTurn(command, result["routeros_command"],
+                           estimate_tokens(command, result["routeros_command"]))
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            session = self._sessions.get(router)
+            if session is None:
+                session = self._sessions[router] = RouterSession()
+            self._sessions.move_to_end(router)
+            session.last_used = now
+            session.turns.append(turn)
+            self._add_tokens(session, turn.tokens)
+            
+            dropped = []
+            while session.turns and (len(session.turns) > self.max_turns or session.tokens > self.token_budget):
+                old = session.turns.popleft()
+                self._add_tokens(session, -old.tokens)
+                dropped.append(old)
+            self.turns_dropped += len(dropped)
+            if dropped and self.summarize:
+                session.folding.extend(dropped)
+                if not session.summarizing:
+                    session.summarizing = True
+                    self._summarizer().submit(contextvars.copy_context().run, self._fold, router, session)
+            
+            while len(self._sessions) > self.max_routers:
+                self._evict("lru")
+            while self._tokens > self.memory_tokens and len(self._sessions) > 1:
+                self._evict("memory")
+
+    def _add_tokens(self, session: RouterSession, tokens: int):
+        # Called with the lock held
+        session.tokens += tokens
+        self._tokens += tokens
+
+    def _evict(self, reason: str):
+        # Called with the lock held; drops the least recently used session
+        _, session = self._sessions.popitem(last=False)
+        self._tokens -= session.tokens
+        self.evictions[reason] += 1
+        metrics.inc("relay_session_evictions_total", reason=reason)
+
+    def _expire(self, now: float):
+        # Called with the lock held; sessions are in order of last use, so expired ones come first
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if now - session.last_used < self.ttl:
+                break
+            self._evict("ttl")
+
+    def _summarizer(self) -> ThreadPoolExecutor:
+        if self._summary_pool is None:
+            self._summary_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='session-summary')
+        return self._summary_pool
+
+    def _fold(self, router: str, session: RouterSession):
+        """Summarize the turns pushed out of a session (runs on the summary thread)."""
+        summary_tokens = max(1, self.token_budget // 3)
+        while True:
+            with self._lock:
+                if not session.folding or self._sessions.get(router) is not session:
+                    session.folding = []
+                    session.summarizing = False
+                    return
+                turns, session.folding = session.folding, []
+                previous = session.summary
+            
+            lines = [f"Earlier summary: {previous or '(none)'}", ""]
+            lines.extend(f"Input: {turn.command}\nOutput: {turn.routeros_command}" for turn in turns)
+            text = call_claude_api(
+                "\n".join(lines),
+                custom_system_prompt=SESSION_SUMMARY_PROMPT.format(words=summary_tokens * 3 // 4),
+                task='summarize',
+            )
+            
+            with self._lock:
+                if text is None:
+                    self.summary_failures += 1
+                    continue
+                # Keep the summary within its share of the session budget
+                text = " ".join(text.split())[:summary_tokens * CHARS_PER_TOKEN]
+                self.summaries += 1
+                if self._sessions.get(router) is session:
+                    self._add_tokens(session, estimate_tokens(text) - estimate_tokens(session.summary))
+                    session.summary = text
+
+    def close(self):
+        if self._summary_pool is not None:
+            self._summary_pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return session counters for monitoring."""
+        with self._lock:
+            return {
+                "enabled": self.enabled(),
+                "sessions": len(self._sessions),
+                "max_routers": self.max_routers,
+                "tokens": self._tokens,
+                "memory_tokens": self.memory_tokens,
+                "max_turns": self.max_turns,
+                "token_budget": self.token_budget,
+                "ttl": self.ttl,
+                "evictions": dict(self.evictions),
+                "turns_dropped": self.turns_dropped,
+                "summarize": self.summarize,
+                "summaries": self.summaries,
+                "summary_failures": self.summary_failures,
+            }
+
+
+session_store = SessionStore(
+    CONFIG['session_max_turns'],
+    CONFIG['session_token_budget'],
+    CONFIG['session_ttl'],
+    CONFIG['session_max_routers'],
+    CONFIG['session_memory_tokens'],
+    CONFIG['session_summarize'],
+)
+
+
+def session_router() -> Optional[str]:
+    """Router whose session a translation uses: the router of the current usage
+    scope, if it named itself. Client addresses are shared behind NAT, so
+    anonymous callers get no session."""
+    scope = usage_scope.get()
+    return scope.router if scope and scope.identified else None
+
+
+def render_session(history: SessionHistory) -> str:
+    """Prompt lines describing a router's earlier requests."""
+    parts = []
+    if history.summary:
+        parts.append(f"Earlier in this conversation: {history.summary}\n\n")
+    if history.turns:
+        parts.append("Recent requests from this router:\n")
+        parts.extend(f"Input: {turn.command}\nOutput: {turn.routeros_command}\n\n" for turn in history.turns)
+    return "".join(parts)
+
+
+def build_translation_message(command: str, context: Optional[Dict] = None,
+                              history: Optional[SessionHistory] = None) -> str:
+    """User message for translating a command.
+    
+    The command alone, or preceded by retrieved knowledge entries, the
+    router's session and the context the router sent.
+    """
+    parts = [prompt_retriever.knowledge_section(command)]
+    if history:
+        parts.append(render_session(history))
+    if context:
+        if isinstance(context, dict):
+            lines = "".join(f"{key}: {value}\n" for key, value in context.items())
+        else:
+            lines = f"{context}\n"
+        # Router-supplied text is held to the session budget
+        parts.append("Router context:\n" + lines[:CONFIG['session_token_budget'] * CHARS_PER_TOKEN] + "\n")
+    prefix = "".join(parts)
+    return f"{prefix}Request: {command}" if prefix else command
+
+
+# ============================================================================
+# ROUTEROS COMMAND PARSER
+# ============================================================================
+# Grammar (one statement per ";" or newline):
+#   statement  := ["/"] path-word* [verb] argument* ["where" expression]
+#   argument   := key "=" value | flag | value | expression (find/print only, e.g. find name!="x")
+#   value      := word | "quoted string" | "[" statement "]" | "{" statements "}"
+#   expression := ["!"] (key op value | key | "(" expression ")") (("and"|"or") expression)*
+#   op         := "=" | "!=" | "~" | "<" | ">" | "<=" | ">=" | "in"
+# Path segments may be separated by spaces or slashes ("/ip firewall filter"
+# and "/ip/firewall/filter" are the same menu), and ".." moves up one level.
+
+class RouterOSSyntaxError(ValueError):
+    """Raised when a command cannot be parsed as RouterOS CLI syntax."""
+
+
+# absolute: bool, path: tuple of segments, verb: str or None,
+# args: tuple of (key or None, value), where: tuple of expression terms
+RouterOSCommand = namedtuple('RouterOSCommand', 'absolute path verb args where')
+
+ROUTEROS_VERBS = frozenset({
+    "add", "remove", "set", "unset", "get", "print", "find", "enable", "disable", "comment",
+    "move", "export", "import", "edit", "monitor", "monitor-traffic", "reset", "reset-counters",
+    "reset-counters-all", "reset-configuration", "reboot", "shutdown", "uninstall", "install",
+    "downgrade", "upgrade", "check-for-updates", "run", "ping", "traceroute", "fetch", "torch",
+    "make-static", "release", "renew", "flush", "send", "scan", "sniff", "cancel", "clear",
+    "bandwidth-test", "apply-changes", "update", "blink", "save", "load",
+})
+ROUTEROS_WHERE_OPS = frozenset({"=", "!=", "~", "<", ">", "<=", ">="})
+# Verbs whose arguments may be conditions without "where", e.g. [find comment~"x"]
+ROUTEROS_QUERY_VERBS = frozenset({"find", "print"})
+# Scripting commands reachable from the root menu (also with a ":" prefix anywhere)
+ROUTEROS_SCRIPT_COMMANDS = frozenset({
+    "execute", "parse", "do", "for", "foreach", "while", "if", "global", "local", "put", "delay",
+    "import", "onerror", "retry", "return", "error",
+})
+# Arguments whose value is a script run later (scripts, schedulers, netwatch,
+# PPP profiles, DHCP); their bodies are validated like commands
+ROUTEROS_SCRIPT_ARGUMENTS = frozenset({
+    "source", "on-event", "up-script", "down-script", "test-script", "on-up", "on-down",
+    "lease-script", "script",
+})
+ROUTEROS_CONNECTORS = {"and": "and", "&&": "and", "or": "or", "||": "or"}
+ROUTEROS_TOKEN = re.compile(r"""
+    (?P<ws>[ \t\r]+)
+  | (?P<newline>\n)
+  | (?P<string>"(?:\\.|[^"\\])*")
+  | (?P<op>!=|<=|>=|[=~<>!])
+  | (?P<punct>[\[\]{}();])
+  | (?P<slash>/)
+  | (?P<word>[^\s\[\]{}();"=!~<>/]+)
+  | (?P<error>")
+""", re.VERBOSE)
+ROUTEROS_WHITESPACE = re.compile(r'("(?:\\.|[^"\\])*")|[ \t]+')
+ROUTEROS_STRING_PART = re.compile(r'"((?:\\.|[^"\\])*)"')
+ROUTEROS_ESCAPES = {"n": "\n", "t": "\t", "r": "\r"}
+
+
+def tokenize_routeros(command: str) -> list:
+    """Split a command into (kind, text, spaced) tokens.
+    
+    spaced is True when whitespace precedes the token, which separates
+    arguments (values such as 10.0.0.0/24 span several adjacent tokens).
+    """
+    tokens = []
+    spaced = True
+    for match in ROUTEROS_TOKEN.finditer(command):
+        kind = match.lastgroup
+        if kind == "ws":
+            spaced = True
+            continue
+        if kind == "error":
+            raise RouterOSSyntaxError(f"Unterminated string at position {match.start()}")
+        if kind == "newline":
+            kind = "punct"
+            text = ";"
+        else:
+            text = match.group()
+        tokens.append((kind, text, spaced))
+        spaced = False
+    return tokens
+
+
+class RouterOSParser:
+    """Recursive descent parser producing RouterOSCommand trees."""
+
+    def __init__(self, tokens: list):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self, offset: int = 0):
+        index = self.pos + offset
+        return self.tokens[index] if index < len(self.tokens) else (None, None, True)
+
+    def advance(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def expect(self, text: str):
+        kind, value, _ = self.advance()
+        if value != text:
+            raise RouterOSSyntaxError(f"Expected '{text}' but found {value or 'end of command'}")
+
+    def parse_script(self, closing: Optional[str] = None) -> tuple:
+        statements = []
+        while True:
+            kind, text, _ = self.peek()
+            if text == ";":
+                self.advance()
+                continue
+            if kind is None or text == closing:
+                break
+            statements.append(self.parse_statement({";", closing}))
+        if closing:
+            self.expect(closing)
+        return tuple(statements)
+
+    def parse_statement(self, stops: set) -> RouterOSCommand:
+        absolute = self.peek()[0] == "slash"
+        path, verb = [], None
+        while True:
+            kind, text, _ = self.peek()
+            if kind == "slash":
+                self.advance()
+            elif kind == "word" and text != "where" and self.peek(1)[1] != "=":
+                self.advance()
+                if text.lower() in ROUTEROS_VERBS:
+                    verb = text
+                    break
+                path.append(text)
+            else:
+                break
+        
+        query = verb is not None and verb.lower() in ROUTEROS_QUERY_VERBS
+        args, where = [], ()
+        while True:
+            kind, text, spaced = self.peek()
+            if kind is None or text in stops:
+                break
+            if kind == "word" and text == "where":
+                self.advance()
+                where = self.parse_expression(stops | {")"})
+                continue
+            if query and (text == "(" or (kind == "word" and self.starts_condition())):
+                where = self.parse_expression(stops | {")"})
+                continue
+            if kind == "word" and self.peek(1)[1] == "=" and not self.peek(1)[2]:
+                self.advance()
+                self.advance()
+                args.append((text, self.parse_value()))
+                continue
+            if kind == "op" and text == "!":
+                # Negated flag, e.g. "print !disabled"
+                self.advance()
+                args.append((None, "!" + self.parse_value()))
+                continue
+            if kind in ("word", "string", "slash") or text in ("[", "{"):
+                args.append((None, self.parse_value()))
+                continue
+            raise RouterOSSyntaxError(f"Unexpected '{text}'")
+        return RouterOSCommand(absolute, tuple(path), verb, tuple(args), where)
+
+    def starts_condition(self) -> bool:
+        """True when the word at the cursor is followed by a where-operator other than "="."""
+        op_kind, op, _ = self.peek(1)
+        return (op_kind == "op" and op in ROUTEROS_WHERE_OPS and op != "=") or (op_kind == "word" and op == "in")
+
+    def parse_value(self):
+        kind, text, _ = self.peek()
+        if text == "[":
+            self.advance()
+            inner = self.parse_statement({"]"})
+            self.expect("]")
+            return inner
+        if text == "{":
+            self.advance()
+            return self.parse_script("}")
+        parts = []
+        while True:
+            kind, text, spaced = self.peek()
+            if kind in ("word", "string", "slash") and (not parts or not spaced):
+                parts.append(text)
+                self.advance()
+            else:
+                break
+        return "".join(parts)
+
+    def parse_expression(self, stops: set) -> tuple:
+        terms = []
+        while True:
+            kind, text, _ = self.peek()
+            if kind is None or text in stops:
+                break
+            if kind == "word" and text.lower() in ROUTEROS_CONNECTORS:
+                self.advance()
+                terms.append((ROUTEROS_CONNECTORS[text.lower()],))
+            elif kind == "op" and text == "!":
+                self.advance()
+                terms.append(("not",))
+            elif text == "(":
+                self.advance()
+                terms.append(("group", self.parse_expression(stops | {")"})))
+                self.expect(")")
+            elif kind == "word":
+                self.advance()
+                op_kind, op, _ = self.peek()
+                if (op_kind == "op" and op in ROUTEROS_WHERE_OPS) or (op_kind == "word" and op == "in"):
+                    self.advance()
+                    terms.append(("cond", text, op, self.parse_value()))
+                else:
+                    terms.append(("flag", text))
+            else:
+                raise RouterOSSyntaxError(f"Unexpected '{text}' in where clause")
+        return tuple(terms)
+
+
+@lru_cache(maxsize=4096)
+def parse_routeros_script(command: str) -> tuple:
+    """Parse one or more RouterOS statements into RouterOSCommand trees."""
+    parser = RouterOSParser(tokenize_routeros(command))
+    statements = parser.parse_script()
+    if parser.pos < len(parser.tokens):
+        raise RouterOSSyntaxError(f"Unexpected '{parser.peek()[1]}'")
+    return statements
+
+
+def resolve_menu_path(base: tuple, command: RouterOSCommand) -> tuple:
+    """Return the absolute, lower-cased menu path of a command."""
+    segments = [] if command.absolute else list(base)
+    for segment in command.path:
+        if segment == "..":
+            if segments:
+                segments.pop()
+        else:
+            segments.append(segment.lower())
+    return tuple(segments)
+
+
+def iter_condition_values(terms: tuple) -> Iterator[Any]:
+    """Yield the values compared in a where expression, including (groups)."""
+    for term in terms:
+        if term[0] == "cond":
+            yield term[3]
+        elif term[0] == "group":
+            yield from iter_condition_values(term[1])
+
+
+def script_argument_body(value: str) -> str:
+    """Unquote a script argument value such as source="/ip address print"."""
+    unescape = lambda m: ROUTEROS_ESCAPES.get(m.group(1), m.group(1))
+    return ROUTEROS_STRING_PART.sub(lambda m: re.sub(r"\\(.)", unescape, m.group(1)), value)
+
+
+def walk_statements(statements: tuple, base: tuple = ()) -> Iterator[tuple]:
+    """Yield (path+verb, command) of every command, including [subexpressions], {blocks}
+    and the bodies of script arguments (source=, on-event=, ...), which run from the root.
+    
+    Raises:
+        RouterOSSyntaxError: a script argument body does not parse.
+    """
+    for command in statements:
+        path = resolve_menu_path(base, command)
+        yield path + ((command.verb.lower(),) if command.verb else ()), command
+        nested = [value for _, value in command.args]
+        nested.extend(iter_condition_values(command.where))
+        for value in nested:
+            if isinstance(value, RouterOSCommand):
+                yield from walk_statements((value,), path)
+            elif isinstance(value, tuple):
+                yield from walk_statements(value, path)
+        for key, value in command.args:
+            if key and key.lower() in ROUTEROS_SCRIPT_ARGUMENTS and isinstance(value, str):
+                yield from walk_statements(parse_routeros_script(script_argument_body(value)))
+
+
+def iter_menu_paths(statements: tuple, base: tuple = ()) -> Iterator[tuple]:
+    """Yield path+verb of every command, including [subexpressions] and {blocks}."""
+    for path, _ in walk_statements(statements, base):
+        yield path
+
+
+def is_scripting_command(path: tuple, command: RouterOSCommand) -> bool:
+    """True for scripting commands such as :execute, at any depth, or /execute at the root."""
+    words = command.path + ((command.verb,) if command.verb else ())
+    if any(word.startswith(":") for word in words):
+        return True
+    return bool(path) and path[0] in ROUTEROS_SCRIPT_COMMANDS
+
+
+class MenuPathTrie:
+    """Prefix trie of dangerous menu paths (path segments + verb)."""
+
+    def __init__(self, entries: list):
+        self.root = {}
+        for entry in entries:
+            try:
+                paths = list(iter_menu_paths(parse_routeros_script(entry)))
+            except RouterOSSyntaxError:
+                logger.warning(f"Ignoring unparseable dangerous command: {entry}")
+                continue
+            for path in paths[:1]:
+                node = self.root
+                for segment in path:
+                    node = node.setdefault(segment, {})
+                node.setdefault(None, entry)
+
+    def match(self, path: tuple) -> Optional[str]:
+        """Return the dangerous entry that prefixes path, if any.
+        
+        RouterOS accepts abbreviated menu and command names ("/sys reboot").
+        A segment is also matched against every name it abbreviates; an
+        abbreviated command name only counts as the last element of the path
+        ("/sys res print" is /system resource print).
+        """
+        return self._match(self.root, path, 0)
+
+    def _match(self, node: dict, path: tuple, index: int) -> Optional[str]:
+        if index == len(path):
+            return None
+        segment = path[index]
+        last = index + 1 == len(path)
+        for name, child in node.items():
+            if name is None or not name.startswith(segment):
+                continue
+            if None in child:
+                if name == segment or last:
+                    return child[None]
+                continue
+            found = self._match(child, path, index + 1)
+            if found:
+                return found
+        return None
+
+
+def build_dangerous_trie(knowledge: Dict[str, Any]) -> MenuPathTrie:
+    """Compile the dangerous command list of a knowledge base."""
+    return MenuPathTrie(knowledge.get("safety_rules", {}).get("dangerous_commands", []))
+
+
+def dangerous_command_trie() -> MenuPathTrie:
+    """Return the dangerous command trie for the current knowledge base."""
+    return current_knowledge().derived("dangerous_trie", build_dangerous_trie)
+
+
+@timed_stage("validation")
+def validate_routeros_command(command: str):
     """Validate RouterOS command syntax and safety.
     
     Returns:
-        tuple: (is_valid: bool, validated_command_or_error: str)
+        tuple: (is_valid: bool, validated_command_or_error: str)
+    """
+    if not command or not command.strip():
+        return False, "Empty command"
+    
+    command = command.strip()
+    
+    # Basic syntax validation
+    if not command.startswith("/"):
+        return False, "RouterOS commands must start with '/'"
+    
+    try:
+        statements = parse_routeros_script(command)
+    except RouterOSSyntaxError as e:
+        return False, f"Syntax error: {e}"
+    
+    # Every statement must be a menu command, not a scripting command like :execute
+    for statement in statements:
+        if not statement.absolute:
+            return False, "RouterOS commands must start with '/'"
+    
+    # Check for scripting and dangerous commands anywhere in the tree,
+    # script argument bodies included
+    trie = dangerous_command_trie()
+    try:
+        for path, statement in walk_statements(statements):
+            if is_scripting_command(path, statement):
+                return False, "Scripting commands are not allowed"
+            dangerous_cmd = trie.match(path)
+            if dangerous_cmd:
+                return False, f"Dangerous command blocked: {dangerous_cmd}"
+    except RouterOSSyntaxError as e:
+        return False, f"Syntax error in script body: {e}"
+    
+    # Collapse repeated whitespace outside quoted strings
+    command = ROUTEROS_WHITESPACE.sub(lambda m: m.group(1) or " ", command)
+    
+    return True, command
+
+
+# ============================================================================
+# TRANSLATION CACHE
+# ============================================================================
+
+class TranslationCache:
+    """Thread-safe LRU cache with TTL for validated smart command translations.
+    
+    Expired entries stay until replaced or evicted, so get_stale() can still
+    answer while every LLM backend is unreachable.
+    """
+
+    def __init__(self, max_entries: int, ttl: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, result)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key) -> Optional[Dict[str, Any]]:
+        """Return a copy of the cached result, or None on miss/expiry."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, result = entry
+            if expires_at <= time.monotonic():
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return dict(result)
+
+    def get_stale(self, key) -> Optional[Dict[str, Any]]:
+        """Return a copy of the cached result even when expired, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return dict(entry[1]) if entry else None
+
+    def put(self, key, result: Dict[str, Any]):
+        """Store a result, evicting the least recently used entry when full."""
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, dict(result))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self) -> int:
+        """Drop all entries and return how many were removed."""
+        with self._lock:
+            count = len(self._entries)
+            self._entries.clear()
+            return count
+
+    def stats(self) -> Dict[str, Any]:
+        """Return cache counters for monitoring."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+translation_cache = TranslationCache(CONFIG['cache_max_entries'], CONFIG['cache_ttl'])
+
+
+def normalize_command(command: str) -> str:
+    """Normalize command text so trivially different requests share a cache entry."""
+    normalized = " ".join(command.split())
+    if normalized.startswith("/"):
+        # RouterOS syntax is case sensitive in values (comments, names)
+        return normalized
+    return normalized.lower().rstrip("?!. ")
+
+
+# ============================================================================
+# FAST-PATH RESOLVER
+# ============================================================================
+
+FAST_PATH_STOPWORDS = {"a", "an", "the", "me", "my", "all", "please", "of", "on", "in", "for", "to", "us"}
+FAST_PATH_SYNONYMS = {"list": "show", "display": "show", "view": "show", "print": "show"}
+
+
+def tokenize_intent(text: str) -> frozenset:
+    """Reduce natural language to a comparable set of tokens."""
+    tokens = set()
+    for token in re.findall(r"[a-z0-9]+", text.lower().replace("_", " ")):
+        if token in FAST_PATH_STOPWORDS:
+            continue
+        token = FAST_PATH_SYNONYMS.get(token, token)
+        if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+            token = token[:-1]
+        tokens.add(token)
+    return frozenset(tokens)
+
+
+# exact: normalized phrase -> (command, label); entries: [(tokens, command, label)];
+# token_index: token -> [entry index]
+FastPathIndex = namedtuple('FastPathIndex', 'exact entries token_index')
+
+
+class FastPathResolver:
+    """Deterministic resolver that answers known intents from the knowledge base without an LLM call."""
+
+    def __init__(self, min_similarity: float):
+        self.min_similarity = min_similarity
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def build_index(self, knowledge: Dict[str, Any]) -> FastPathIndex:
+        """Index example inputs and operation names of a knowledge base."""
+        phrases = []
+        for example in knowledge.get("context_examples", []):
+            phrases.append((example.get("input", ""), example.get("output", ""), "example"))
+        for op, cmd in knowledge.get("common_operations", {}).items():
+            phrases.append((op.replace("_", " "), cmd, f"operation:{op}"))
+        for verb, targets in knowledge.get("command_patterns", {}).items():
+            for target, cmd in targets.items():
+                phrases.append((f"{verb} {target.replace('_', ' ')}", cmd, f"pattern:{verb}.{target}"))
+        
+        exact, entries, token_index = {}, [], {}
+        for phrase, cmd, label in phrases:
+            # Parameterized commands need slot values and are not answered here
+            if not phrase or not cmd or "{" in cmd:
+                continue
+            exact.setdefault(normalize_command(phrase), (cmd, label))
+            tokens = tokenize_intent(phrase)
+            if not tokens:
+                continue
+            for token in tokens:
+                token_index.setdefault(token, []).append(len(entries))
+            entries.append((tokens, cmd, label))
+        
+        logger.info(f"Fast-path index built: {len(exact)} phrases")
+        return FastPathIndex(exact, entries, token_index)
+
+    def resolve(self, normalized: str, fuzzy: bool = True) -> Optional[tuple]:
+        """Return (command, label) for a known intent, or None to fall through.
+        
+        With fuzzy False only an exact phrase matches.
+        """
+        index = current_knowledge().derived("fast_path", self.build_index)
+        match = index.exact.get(normalized)
+        if not match and fuzzy:
+            match = self._fuzzy_match(index, normalized, self.min_similarity)
+        with self._lock:
+            if match:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return match
+
+    def resolve_relaxed(self, normalized: str, min_similarity: float) -> Optional[tuple]:
+        """Fuzzy match at a lower threshold, for answers while the LLM is unreachable."""
+        index = current_knowledge().derived("fast_path", self.build_index)
+        return self._fuzzy_match(index, normalized, min_similarity)
+
+    def _fuzzy_match(self, index: FastPathIndex, normalized: str, min_similarity: float) -> Optional[tuple]:
+        """Token-set Jaccard match; ambiguous best matches fall through."""
+        tokens = tokenize_intent(normalized)
+        if not tokens:
+            return None
+        candidates = set()
+        for token in tokens:
+            candidates.update(index.token_index.get(token, ()))
+        
+        best_score, best = 0.0, []
+        for idx in candidates:
+            entry_tokens, cmd, label = index.entries[idx]
+            score = len(tokens & entry_tokens) / len(tokens | entry_tokens)
+            if score > best_score:
+                best_score, best = score, [(cmd, label)]
+            elif score == best_score:
+                best.append((cmd, label))
+        
+        if best_score < min_similarity or len({cmd for cmd, _ in best}) != 1:
+            return None
+        return best[0]
+
+    def stats(self) -> Dict[str, Any]:
+        """Return resolver counters for monitoring."""
+        index = current_knowledge().derived("fast_path", self.build_index)
+        with self._lock:
+            return {
+                "enabled": CONFIG['fast_path_enabled'],
+                "phrases": len(index.exact),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+fast_path = FastPathResolver(CONFIG['fast_path_min_similarity'])
+
+
+# ============================================================================
+# TEMPLATE ENGINE
+# ============================================================================
+
+# Placeholder name -> slot type
+TEMPLATE_SLOT_TYPES = {
+    "ip": "address", "address": "address", "src": "address", "dst": "address",
+    "network": "address", "subnet": "address",
+    "mac": "mac",
+    "interface": "interface", "iface": "interface",
+    "port": "port",
+}
+# Filler nouns allowed around a slot value ("block device 10.0.0.5", "block host 10.0.0.5")
+TEMPLATE_FILLER_WORDS = {"device", "ip", "address", "host", "client", "mac", "interface", "port", "now"}
+TEMPLATE_PLACEHOLDER = re.compile(r"\{(\w+)\}")
+MAC_PATTERN = re.compile(r"^[0-9a-f]{2}([:-])(?:[0-9a-f]{2}\1){4}[0-9a-f]{2}$", re.IGNORECASE)
+INTERFACE_PATTERN = re.compile(
+    r"^(?:ether|sfp|sfpplus|qsfp|wlan|wifi|bridge|vlan|bond|pppoe|l2tp|ovpn|wg|wireguard|lte|gre|eoip|veth)[\w.-]*$",
+    re.IGNORECASE,
+)
+INTERFACE_NAME_PATTERN = re.compile(r"^[\w.-]+$")
+
+
+def extract_slot_values(text: str) -> tuple:
+    """Split input into typed slot values and the remaining words.
+    
+    Returns:
+        tuple: ({slot_type: [values]}, remaining_words: list)
+    """
+    slots = {}
+    words = []
+    raw_tokens = [token.strip(",;\"'()") for token in text.split()]
+    for i, token in enumerate(raw_tokens):
+        if not token:
+            continue
+        previous = raw_tokens[i - 1].lower() if i > 0 else ""
+        slot_type, value = None, None
+        try:
+            value = str(ipaddress.ip_network(token, strict=False)) if "/" in token else str(ipaddress.ip_address(token))
+            slot_type = "address"
+        except ValueError:
+            if MAC_PATTERN.match(token):
+                slot_type, value = "mac", token.upper().replace("-", ":")
+            elif previous == "port" and token.isdigit() and 0 < int(token) < 65536:
+                slot_type, value = "port", token
+            elif INTERFACE_PATTERN.match(token) or (previous == "interface" and INTERFACE_NAME_PATTERN.match(token)):
+                slot_type, value = "interface", token
+        if slot_type:
+            slots.setdefault(slot_type, []).append(value)
+        else:
+            words.append(token)
+    return slots, words
+
+
+class CommandTemplate:
+    """A parameterized knowledge base operation compiled into a matcher."""
+
+    def __init__(self, name: str, verb: str, keywords: set, template: str, slots: Dict[str, str]):
+        self.name = name
+        self.verb = verb
+        self.vocabulary = keywords | TEMPLATE_FILLER_WORDS
+        self.template = template
+        self.slots = slots  # placeholder -> slot type
+
+    def match(self, slot_values: Dict[str, list], word_tokens: frozenset) -> Optional[str]:
+        """Return the filled command if the input fits this template."""
+        if self.verb not in word_tokens or not word_tokens <= self.vocabulary:
+            return None
+        filled = {}
+        for placeholder, slot_type in self.slots.items():
+            values = slot_values.get(slot_type, [])
+            if len(values) != 1:
+                return None
+            filled[placeholder] = values[0]
+        # Every extracted value must be consumed by a placeholder
+        if sum(len(v) for v in slot_values.values()) != len(set(self.slots.values())):
+            return None
+        return TEMPLATE_PLACEHOLDER.sub(lambda m: filled[m.group(1)], self.template)
+
+
+class TemplateEngine:
+    """Fills parameterized common_operations locally instead of asking the LLM."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def compile(self, knowledge: Dict[str, Any]) -> tuple:
+        """Compile every parameterized operation of a knowledge base."""
+        sources = [(op, op.split("_"), cmd) for op, cmd in knowledge.get("common_operations", {}).items()]
+        for verb, targets in knowledge.get("command_patterns", {}).items():
+            for target, cmd in targets.items():
+                sources.append((f"{verb}.{target}", [verb] + target.split("_"), cmd))
+        
+        templates = []
+        for name, words, cmd in sources:
+            placeholders = TEMPLATE_PLACEHOLDER.findall(cmd)
+            if not placeholders:
+                continue
+            slots = {p: TEMPLATE_SLOT_TYPES.get(p) for p in placeholders}
+            if None in slots.values():
+                logger.debug(f"Skipping template {name}: unknown placeholder in {cmd}")
+                continue
+            verb_tokens = tokenize_intent(words[0])
+            if not verb_tokens:
+                continue
+            keywords = set(tokenize_intent(" ".join(words)))
+            templates.append(CommandTemplate(name, next(iter(verb_tokens)), keywords, cmd, slots))
+        
+        logger.info(f"Compiled {len(templates)} command templates")
+        return tuple(templates)
+
+    def resolve(self, text: str) -> Optional[tuple]:
+        """Return (command, template name) when exactly one template fits."""
+        templates = current_knowledge().derived("templates", self.compile)
+        slot_values, words = extract_slot_values(text)
+        match = None
+        if slot_values:
+            word_tokens = tokenize_intent(" ".join(words))
+            matches = {}
+            for template in templates:
+                filled = template.match(slot_values, word_tokens)
+                if filled:
+                    matches.setdefault(filled, template.name)
+            if len(matches) == 1:
+                match = next(iter(matches.items()))
+        with self._lock:
+            if match:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return match
+
+    def stats(self) -> Dict[str, Any]:
+        """Return template engine counters for monitoring."""
+        templates = current_knowledge().derived("templates", self.compile)
+        with self._lock:
+            return {
+                "templates": len(templates),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+template_engine = TemplateEngine()
+
+
+def resolve_locally(command: str, normalized: str, contextual: bool = False) -> Optional[Dict[str, Any]]:
+    """Answer a command without the LLM when possible.
+    
+    A contextual request (see refers_to_session) may refer to earlier
+    results, so only answers that do not depend on them are given:
+    passthrough, templates and exact fast-path phrases, not fuzzy matches.
+    
+    Returns:
+        Result dict with "source" set, or None to fall through to the LLM.
+    """
+    if normalized.startswith("/"):
+        # Already RouterOS syntax - no translation needed, only validation
+        is_valid, validated_command = validate_routeros_command(normalized)
+        if is_valid:
+            return {
+                "success": True,
+                "routeros_command": validated_command,
+                "original_command": command,
+                "source": "passthrough",
+            }
+        return {
+            "success": False,
+            "error": validated_command or "Invalid command syntax",
+            "original_command": command,
+            "source": "passthrough",
+        }
+    
+    if not CONFIG['fast_path_enabled']:
+        return None
+    
+    # Parameterized operations first, so slot values are never fuzzy-matched
+    source = "template"
+    match = template_engine.resolve(normalized)
+    if not match:
+        source = "fast_path"
+        match = fast_path.resolve(normalized, fuzzy=not contextual)
+    if not match:
+        return None
+    routeros_command, label = match
+    is_valid, validated_command = validate_routeros_command(routeros_command)
+    if not is_valid:
+        return None
+    return {
+        "success": True,
+        "routeros_command": validated_command,
+        "original_command": command,
+        "source": source,
+        "matched": label,
+    }
+
+
+# ============================================================================
+# REQUEST COALESCING
+# ============================================================================
+
+class SingleFlight:
+    """Share one upstream call between concurrent identical requests.
+    
+    The first caller for a key (the leader) runs the call; callers arriving
+    while it is in flight wait for and receive the same result. The call
+    runs under a SharedDeadline of all its callers, so one caller timing out
+    or cancelling does not cut it short for the others.
+    """
+
+    def __init__(self):
+        self._calls = {}  # key -> (threading.Event, result holder, SharedDeadline)
+        self._tasks = {}  # key -> (asyncio.Task, SharedDeadline) (asgi mode)
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.shared = 0
+
+    def do(self, key, fn: Callable[[RequestDeadline], Any], deadline: RequestDeadline) -> Any:
+        """Run fn(shared deadline) once per in-flight key from worker threads."""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = (threading.Event(), {}, SharedDeadline(deadline))
+                self._calls[key] = call
+                self.leaders += 1
+                leader = True
+            else:
+                call[2].join(deadline)
+                self.shared += 1
+                leader = False
+        done, holder, shared = call
+        
+        if not leader:
+            if not done.wait(deadline.remaining()):
+                raise TimeoutError("Timed out waiting for coalesced upstream call")
+            if "error" in holder:
+                raise holder["error"]
+            return holder["result"]
+        
+        try:
+            holder["result"] = fn(shared)
+            return holder["result"]
+        except Exception as e:
+            holder["error"] = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            done.set()
+
+    async def do_async(self, key, coro_fn: Callable[[RequestDeadline], Any], deadline: RequestDeadline) -> Any:
+        """Run coro_fn(shared deadline) once per in-flight key from the event loop."""
+        call = self._tasks.get(key)
+        if call is None:
+            shared = SharedDeadline(deadline)
+            task = asyncio.ensure_future(coro_fn(shared))
+            self._tasks[key] = (task, shared)
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+            self.leaders += 1
+        else:
+            task, shared = call
+            shared.join(deadline)
+            self.shared += 1
+        # A caller timing out must not cancel the call other callers wait on
+        return await asyncio.shield(task)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return coalescing counters for monitoring."""
+        with self._lock:
+            return {
+                "in_flight": len(self._calls) + len(self._tasks),
+                "upstream_calls": self.leaders,
+                "calls_saved": self.shared,
+            }
+
+
+llm_flights = SingleFlight()
+
+
+def flight_key(cache_key, context: Optional[Dict], history: Optional[SessionHistory] = None):
+    """Key identifying identical translations: command, knowledge version, context and session."""
+    return cache_key, json.dumps(context or {}, sort_keys=True, default=str), history
+
+
+def backend_cache_key(cache_key, backend: 'LLMBackend') -> tuple:
+    """Translation cache key of an answer: command, knowledge version, and the backend and model that gave it."""
+    return cache_key + (backend.name, backend.model)
+
+
+def resolve_without_llm(command: str, contextual: bool = False) -> tuple:
+    """Run every resolution stage that does not need the LLM.
+    
+    Contextual requests skip fuzzy fast-path matches and the translation
+    cache, whose answers were produced without their context. Cached answers are
+    served only when they came from the backend and model that would answer
+    now (the first of the translate order whose circuit lets calls through).
+    
+    Returns:
+        tuple: (result or None, cache_key) - a None result means the LLM
+        must translate; cache_key (command, knowledge version) is extended
+        with the answering backend to store its answer.
     """
-    if not command or not command.strip():
-        return False, "Empty command"
-    
-    command = command.strip()
-    
-    # Check for dangerous commands
-    knowledge = ROUTEROS_KNOWLEDGE or get_default_knowledge()
-    dangerous = knowledge.get("safety_rules", {}).get("dangerous_commands", [])
-    
-    for dangerous_cmd in dangerous:
-        if command.startswith(dangerous_cmd):
-            return False, f"Dangerous command blocked: {dangerous_cmd}"
+    normalized = normalize_command(command)
+    local_result = resolve_locally(command, normalized, contextual)
+    if local_result:
+        return local_result, None
     
-    # Basic syntax validation
-    if not command.startswith("/"):
-        return False, "RouterOS commands must start with '/'"
+    cache_key = (normalized, current_knowledge().version)
+    backends = backends_for('translate')
+    if contextual or not backends:
+        return None, cache_key
+    answering = next((backend for backend in backends if backend.breaker.available()), backends[0])
+    cached = translation_cache.get(backend_cache_key(cache_key, answering))
+    if cached:
+        cached["original_command"] = command
+        cached["source"] = "cache"
+        return cached, cache_key
+    return None, cache_key
+
+
+def degraded_translation(command: str, cache_key, reason: str, failure: Dict[str, Any]) -> Dict[str, Any]:
+    """Answer a translation without a new LLM call.
     
-    # Check for common syntax errors
-    if "  " in command:  # Double spaces
-        command = command.replace("  ", " ")
+    Used while every LLM backend circuit is open (reason "circuit_open") and
+    for routers over their token quota ("quota"). Serves an expired
+    translation cache entry, then a fast-path match at DEGRADED_MIN_SIMILARITY;
+    answers are marked "degraded". Without one, `failure` is returned.
+    """
+    result = None
+    for backend in backends_for('translate'):
+        result = translation_cache.get_stale(backend_cache_key(cache_key, backend))
+        if result:
+            break
+    if result:
+        result["original_command"] = command
+        result["source"] = "stale_cache"
+    elif CONFIG['fast_path_enabled']:
+        match = fast_path.resolve_relaxed(cache_key[0], CONFIG['degraded_min_similarity'])
+        if match:
+            is_valid, validated_command = validate_routeros_command(match[0])
+            if is_valid:
+                result = {
+                    "success": True,
+                    "routeros_command": validated_command,
+                    "original_command": command,
+                    "source": "fast_path",
+                    "matched": match[1],
+                }
     
-    return True, command
+    if not result:
+        metrics.inc("relay_degraded_responses_total", reason=reason, source="miss")
+        return dict(failure, original_command=command)
+    metrics.inc("relay_degraded_responses_total", reason=reason, source=result["source"])
+    result["degraded"] = True
+    return result
 
 
-def process_smart_command(command: str, context: Optional[Dict] = None) -> Dict[str, Any]:
-    """Process a smart command and return RouterOS command."""
-    try:
-        # Call Claude API
-        routeros_command = call_claude_api(command)
-        
-        if not routeros_command:
-            return {
-                "success": False,
-                "error": "Failed to process command with Claude API",
-                "original_command": command,
-            }
-        
-        # Check if Claude returned an error
-        if routeros_command.startswith("ERROR:"):
-            return {
-                "success": False,
-                "error": routeros_command.replace("ERROR:", "").strip(),
-                "original_command": command,
-            }
-        
-        # Validate the generated command
-        is_valid, validated_command = validate_routeros_command(routeros_command)
-        
-        if not is_valid:
-            return {
-                "success": False,
-                "error": validated_command or "Invalid command syntax",
-                "original_command": command,
-                "generated_command": routeros_command,
-            }
-        
+def circuit_open_body(task: str) -> Dict[str, Any]:
+    retry_after = llm_retry_after(task)
+    return {
+        "success": False,
+        "error": f"LLM backends unavailable, retry in {retry_after}s",
+        "retry_after": retry_after,
+    }
+
+
+def finalize_llm_translation(command: str, routeros_command: Optional[str], cache_key,
+                             cacheable: bool = True, backend: Optional['LLMBackend'] = None) -> Dict[str, Any]:
+    """Validate the LLM output for a command and cache it when valid and cacheable.
+    
+    The answer is cached under the backend and model that produced it.
+    Translations made with a router's session or context are not cacheable:
+    the same words may mean something else to another router.
+    """
+    if not routeros_command:
         return {
-            "success": True,
-            "routeros_command": validated_command,
+            "success": False,
+            "error": "Failed to process command with Claude API",
             "original_command": command,
         }
-        
-    except Exception as e:
-        logger.error(f"Error processing smart command: {e}")
+    
+    # Check if Claude returned an error
+    if routeros_command.startswith("ERROR:"):
+        return {
+            "success": False,
+            "error": routeros_command.replace("ERROR:", "").strip(),
+            "original_command": command,
+        }
+    
+    # Validate the generated command
+    is_valid, validated_command = validate_routeros_command(routeros_command)
+    
+    if not is_valid:
         return {
             "success": False,
-            "error": str(e),
+            "error": validated_command or "Invalid command syntax",
             "original_command": command,
+            "generated_command": routeros_command,
         }
+    
+    result = {
+        "success": True,
+        "routeros_command": validated_command,
+        "original_command": command,
+    }
+    # Only validated translations are cached
+    if cacheable and backend is not None:
+        translation_cache.put(backend_cache_key(cache_key, backend), result)
+    result["source"] = "llm"
+    return result
+
+
+# Words that point back at an earlier turn ("restart it", "the second one")
+SESSION_REFERENCE_WORDS = frozenset({
+    "it", "its", "that", "this", "those", "these", "them", "they", "there", "same", "one", "ones",
+    "first", "second", "third", "last", "previous", "above", "again",
+})
+
+
+def refers_to_session(command: str, context: Optional[Dict], history: Optional[SessionHistory]) -> bool:
+    """Whether a request depends on more than its own text.
+    
+    True with a non-empty context, or with session history when the command
+    uses a word referring back to it. A self-contained command from a router
+    with history (a repeated "show dhcp leases") is answered like any other.
+    """
+    if context:
+        return True
+    if not history:
+        return False
+    words = re.findall(r"[a-z]+", normalize_command(command))
+    return not SESSION_REFERENCE_WORDS.isdisjoint(words)
+
+
+# router: session key; history: its SessionHistory or None; result: answer
+# found without the LLM, or None; cache_key: where the LLM answer is cached;
+# contextual: refers_to_session(), which keeps the answer out of the cache
+PreparedCommand = namedtuple('PreparedCommand', 'router history result cache_key contextual')
+
+
+def prepare_smart_command(command: str, context: Optional[Dict] = None) -> PreparedCommand:
+    """Look up the caller's session and run the resolution stages that need no LLM."""
+    router = session_router()
+    history = session_store.history(router)
+    contextual = refers_to_session(command, context, history)
+    result, cache_key = resolve_without_llm(command, contextual)
+    return PreparedCommand(router, history, result, cache_key, contextual)
+
+
+def smart_command_error(command: str, error: Exception) -> Dict[str, Any]:
+    logger.error(f"Error processing smart command: {error}")
+    return {
+        "success": False,
+        "error": str(error),
+        "original_command": command,
+    }
+
+
+def process_smart_command(command: str, context: Optional[Dict] = None,
+                          deadline: Optional[RequestDeadline] = None,
+                          prepared: Optional[PreparedCommand] = None) -> Dict[str, Any]:
+    """Process a smart command and return RouterOS command.
+    
+    `prepared` is the prepare_smart_command() result when the caller already
+    ran it (batches answer local items inline). The calling router's session
+    is offered to the LLM, and successful answers are added to it (see
+    SessionStore).
+    """
+    if prepared is None:
+        try:
+            prepared = prepare_smart_command(command, context)
+        except Exception as e:
+            return smart_command_error(command, e)
+    result = prepared.result or translate_smart_command(command, context, deadline, prepared)
+    session_store.record(prepared.router, command, result)
+    return result
+
+
+def translate_smart_command(command: str, context: Optional[Dict], deadline: Optional[RequestDeadline],
+                            prepared: PreparedCommand) -> Dict[str, Any]:
+    """Translate a smart command that needs the LLM into a RouterOS command.
+    
+    Resolution order: passthrough, templates, fast-path, translation cache
+    (see prepare_smart_command; fuzzy fast-path matches and the cache only
+    for requests that do not refer to context or earlier turns), then Claude API. The "source" field of the
+    result reports which path answered. Work stops early once the deadline
+    passes or the caller cancels it. While every backend circuit is open, or
+    the calling router is over its token quota, degraded_translation answers
+    instead.
+    """
+    deadline = deadline or RequestDeadline(CONFIG['request_timeout'])
+    history, cache_key = prepared.history, prepared.cache_key
+    try:
+        scope = usage_scope.get()
+        if usage_ledger.over_quota(scope):
+            return degraded_translation(command, cache_key, "quota", quota_exceeded_body(scope))
+        
+        # Call Claude API, sharing the call with identical in-flight requests
+        deadline.check()
+        routeros_command, backend = llm_flights.do(
+            flight_key(cache_key, context, history),
+            lambda shared: call_llm(build_translation_message(command, context, history), deadline=shared),
+            deadline,
+        )
+        if routeros_command is None and circuits_open('translate'):
+            return degraded_translation(command, cache_key, "circuit_open", circuit_open_body('translate'))
+        return finalize_llm_translation(command, routeros_command, cache_key, not prepared.contextual, backend)
+        
+    except Exception as e:
+        return smart_command_error(command, e)
+
+
+# ============================================================================
+# LISTENERS
+# ============================================================================
+# One process binds the local port and, when cloud access is enabled, the
+# cloud port. A request belongs to the listener whose port accepted it, and
+# each listener only reaches the endpoints its policy allows.
+
+LISTENER_POLICIES = {
+    'local': None,  # Every endpoint
+    'cloud': frozenset({
+        'health_check',
+        'process_command',
+        'process_commands',
+        'suggest_error_fix',
+        'handshake',
+        'request_device_authorization',
+        'device_authorization_page',
+        'auth_page_stylesheet',
+        'poll_device_authorization',
+    }),
+}
+
+
+def configured_listeners() -> list:
+    """Return (name, port) for every listener this node binds."""
+    listeners = [('local', CONFIG['port'])]
+    if CONFIG['enable_cloud']:
+        listeners.append(('cloud', CONFIG['cloud_port']))
+    return listeners
+
+
+def listener_for_port(port) -> str:
+    """Name the listener that accepted a connection on this local port."""
+    if CONFIG['enable_cloud'] and str(port) == str(CONFIG['cloud_port']):
+        return 'cloud'
+    return 'local'
+
+
+def listener_allows(listener: str, endpoint: str) -> bool:
+    allowed = LISTENER_POLICIES.get(listener)
+    return allowed is None or endpoint in allowed
+
+
+@app.before_request
+def enforce_listener_policy():
+    """Answer 404 for endpoints the receiving listener does not expose."""
+    listener = listener_for_port(request.environ.get('SERVER_PORT'))
+    if request.endpoint and not listener_allows(listener, request.endpoint):
+        return jsonify({"success": False, "error": "Not found"}), 404
+
+
+# ============================================================================
+# COMPACT RESPONSES
+# ============================================================================
+# RouterOS scripts can ask for kv or dsv replies instead of JSON; the
+# encoders live in compact_responses.py, shared with relay-service/.
+
+# Fields of compact replies per endpoint; a (name, fields) pair describes a list of items
+COMPACT_FIELDS = {
+    'health_check': ('status',),
+    'handshake': ('success', 'message', 'cloud_port', 'error'),
+    'process_command': ('success', 'routeros_command', 'source', 'degraded', 'error', 'retry_after'),
+    'process_commands': ('success', 'total', 'successful', 'failed', 'error', 'retry_after',
+                         ('results', ('success', 'routeros_command', 'source', 'error'))),
+    'suggest_error_fix': ('success', 'suggestion', 'error', 'retry_after'),
+}
+
+
+@app.after_request
+def negotiate_response_format(response):
+    """Re-encode JSON replies of router-facing endpoints when a compact format was asked for."""
+    return negotiate_flask_response(response, request, COMPACT_FIELDS.get(request.endpoint))
 
 
 @app.route('/health', methods=['GET'])
@@ -318,16 +3918,109 @@ def health_check():
         "timestamp": datetime.utcnow().isoformat(),
         "config": {
             "mode": CONFIG['claude_mode'],
+            "server": CONFIG['server_mode'],
             "api_configured": bool(CONFIG['claude_api_key']),
-        }
+            "listeners": dict(configured_listeners()),
+            "llm_backends": LLM_TASK_BACKENDS,
+        },
+        "knowledge": current_knowledge().info(),
+        "cache": translation_cache.stats(),
+        "fast_path": fast_path.stats(),
+        "templates": template_engine.stats(),
+        "prompt_retrieval": prompt_retriever.stats(),
+        "single_flight": llm_flights.stats(),
+        "llm_backends": {name: backend.stats() for name, backend in llm_backends.items()},
+        "outbound": outbound_scheduler.stats(),
+        "usage": usage_ledger.stats(),
+        "sessions": session_store.stats(),
+        "executor": executor.stats(),
+        "http_server": http_server.stats() if http_server else None,
+        "authorizations": authorization_store.stats(),
+        "long_polls": held_polls.stats() if http_server else None,
     })
 
 
+def collect_gauges() -> tuple:
+    """Read the component stats exported as gauges on /metrics."""
+    cache = translation_cache.stats()
+    resolvers = {"fast_path": fast_path.stats(), "template": template_engine.stats()}
+    workers = executor.stats()
+    flights = llm_flights.stats()
+    pools = {name: backend.http.stats() for name, backend in llm_backends.items()}
+    latencies = {backend.name: backend.latency.quantile(0.95) for backend in active_backends()}
+    outbound = outbound_scheduler.stats()
+    sessions = session_store.stats()
+    return (
+        ("relay_cache_hit_ratio", "Hit ratio of local lookups by cache",
+         [({"cache": "translation"}, cache["hit_ratio"])] + [
+             ({"cache": name}, round(stats["hits"] / (stats["hits"] + stats["misses"]), 4)
+              if stats["hits"] + stats["misses"] else 0.0)
+             for name, stats in resolvers.items()
+         ]),
+        ("relay_cache_lookups_total", "Lookups since start by cache and result",
+         [({"cache": "translation", "result": "hit"}, cache["hits"]),
+          ({"cache": "translation", "result": "miss"}, cache["misses"])] + [
+             ({"cache": name, "result": result}, stats[field])
+             for name, stats in resolvers.items() for result, field in (("hit", "hits"), ("miss", "misses"))
+         ]),
+        ("relay_cache_entries", "Entries in the translation cache", [({}, cache["entries"])]),
+        ("relay_executor_queue_depth", "Tasks waiting for a worker", [({}, workers["queued"])]),
+        ("relay_executor_active_workers", "Workers running a task", [({}, workers["active"])]),
+        ("relay_executor_max_workers", "Worker pool size", [({}, workers["max_workers"])]),
+        ("relay_executor_dropped_total", "Tasks not run by reason",
+         [({"reason": "rejected"}, workers["rejected"]),
+          ({"reason": "cancelled"}, workers["cancelled"]),
+          ({"reason": "expired"}, workers["expired"])]),
+        ("relay_single_flight_in_flight", "Distinct upstream calls in progress", [({}, flights["in_flight"])]),
+        ("relay_single_flight_calls_saved_total", "Calls answered by joining an in-flight request", [({}, flights["calls_saved"])]),
+        ("relay_http_pool_connections_total", "Upstream connections by outcome since start",
+         [({"backend": name, "state": state}, pool[field])
+          for name, pool in pools.items()
+          for state, field in (("opened", "connections_opened"), ("reused", "connections_reused"),
+                               ("reconnect", "reconnects"))]),
+        ("relay_outbound_queue_depth", "LLM calls waiting for the outbound scheduler, by backend and lane",
+         [({"backend": name, "lane": lane}, count)
+          for name, stats in outbound.items() for lane, count in stats["queued"].items()]),
+        ("relay_circuit_state", "Circuit breaker state by backend: 0 closed, 1 half_open, 2 open",
+         [({"backend": backend.name}, CircuitBreaker.STATE_VALUES[backend.breaker.state])
+          for backend in active_backends()]),
+        ("relay_upstream_latency_p95_seconds", "p95 of recent successful calls by backend (hedge delay)",
+         [({"backend": name}, round(p95, 4)) for name, p95 in latencies.items() if p95 is not None]),
+        ("relay_sessions", "Routers with a conversation session", [({}, sessions["sessions"])]),
+        ("relay_session_tokens", "Estimated tokens held by conversation sessions", [({}, sessions["tokens"])]),
+        ("relay_knowledge_version", "Active knowledge base version", [({}, current_knowledge().version)]),
+        ("relay_http_in_flight", "HTTP requests being served (threaded mode)",
+         [({}, http_server.in_flight)] if http_server else []),
+    )
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus metrics endpoint (local listener only)."""
+    return Response(metrics.render(collect_gauges()), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/usage', methods=['GET'])
+def usage_endpoint():
+    """Token and latency accounting per router and endpoint (local listener only)."""
+    try:
+        days = min(max(int(request.args.get('days', 1)), 1), 366)
+    except ValueError:
+        return jsonify({
+            "success": False,
+            "error": "'days' must be an integer"
+        }), 400
+    usage = usage_ledger.query(days, request.args.get('router') or None)
+    return jsonify(dict(usage, success=True, days=days))
+
+
 @app.route('/process-command', methods=['POST'])
+@accounted('process_command')
 def process_command():
     """Process a smart command and return RouterOS command."""
     try:
-        data = request.get_json()
+        with metrics.timer("relay_stage_duration_seconds", stage="json_parse"):
+            data = request.get_json()
         
         if not data or 'command' not in data:
             return jsonify({
@@ -338,12 +4031,29 @@ def process_command():
         command = data['command']
         context = data.get('context', {})
         
-        # Process command asynchronously
-        future = executor.submit(process_smart_command, command, context)
-        result = future.result(timeout=CONFIG['request_timeout'])
+        # Process command asynchronously; refuse quickly when the pool is saturated
+        deadline = RequestDeadline(CONFIG['request_timeout'])
+        future = executor.submit(process_smart_command, command, context, deadline, deadline=deadline)
+        try:
+            result = future.result(timeout=deadline.remaining())
+        except FutureTimeoutError:
+            # Stop the worker at its next check instead of letting it finish for nobody
+            deadline.cancel()
+            future.cancel()
+            raise
         
-        return jsonify(result)
+        with metrics.timer("relay_stage_duration_seconds", stage="serialization"):
+            return jsonify(result)
         
+    except ExecutorSaturated as e:
+        logger.warning("Rejected /process-command: worker pool saturated")
+        return busy_response(e.retry_after)
+    except FutureTimeoutError:
+        logger.warning("Timed out processing /process-command")
+        return jsonify({
+            "success": False,
+            "error": "Timed out"
+        }), 504
     except Exception as e:
         logger.error(f"Error in process_command endpoint: {e}")
         return jsonify({
@@ -352,6 +4062,117 @@ def process_command():
         }), 500
 
 
+def parse_batch_request(data: Optional[Dict], max_items: int) -> tuple:
+    """Validate a /process-commands body.
+    
+    Returns:
+        tuple: (items, timeout, error) - items is a list of (command, context)
+        where command is None for malformed entries.
+    """
+    if not data or not isinstance(data.get('commands'), list):
+        return None, None, "Missing 'commands' array in request body"
+    if len(data['commands']) > max_items:
+        return None, None, f"Too many commands (max {max_items})"
+    
+    items = []
+    for entry in data['commands']:
+        if isinstance(entry, str):
+            items.append((entry, {}))
+        elif isinstance(entry, dict) and isinstance(entry.get('command'), str):
+            items.append((entry['command'], entry.get('context', {})))
+        else:
+            items.append((None, None))
+    
+    # One deadline for the whole batch, never longer than request_timeout
+    timeout = CONFIG['request_timeout']
+    try:
+        timeout = min(timeout, float(data.get('timeout', timeout)))
+    except (TypeError, ValueError):
+        pass
+    return items, timeout, None
+
+
+def build_batch_response(results: list) -> Dict[str, Any]:
+    """Summarize per-item results, keeping request order."""
+    successful = sum(1 for r in results if r.get('success'))
+    return {
+        "success": successful == len(results),
+        "total": len(results),
+        "successful": successful,
+        "failed": len(results) - successful,
+        "results": results,
+    }
+
+
+def batch_item_error(command: Optional[str], error: str) -> Dict[str, Any]:
+    result = {"success": False, "error": error}
+    if command is not None:
+        result["original_command"] = command
+    return result
+
+
+@app.route('/process-commands', methods=['POST'])
+@accounted('process_commands')
+def process_commands():
+    """Translate several smart commands concurrently under one deadline."""
+    try:
+        # A batch is admitted whole, so it can never be larger than the pool admits
+        max_items = min(CONFIG['batch_max_items'], executor.max_workers + executor.max_queue)
+        items, timeout, error = parse_batch_request(request.get_json(silent=True), max_items)
+        if error:
+            return jsonify({
+                "success": False,
+                "error": error
+            }), 400
+        
+        deadline = RequestDeadline(timeout)
+        results = [None] * len(items)
+        futures = {}
+        for index, (command, context) in enumerate(items):
+            if command is None:
+                results[index] = batch_item_error(None, "Missing 'command' in item")
+                continue
+            # Local answers are immediate; only LLM work goes to the pool
+            prepared = prepare_smart_command(command, context)
+            if prepared.result:
+                results[index] = process_smart_command(command, context, deadline, prepared)
+                continue
+            try:
+                future = executor.submit(process_smart_command, command, context, deadline, prepared,
+                                         deadline=deadline)
+            except ExecutorSaturated as e:
+                # Admit the batch whole or not at all; items already running
+                # see the cancelled deadline and stop before calling upstream
+                deadline.cancel()
+                for admitted in futures:
+                    admitted.cancel()
+                logger.warning("Rejected /process-commands: worker pool saturated")
+                return busy_response(e.retry_after)
+            futures[future] = index
+        
+        if futures:
+            wait_futures(futures, timeout=deadline.remaining())
+        deadline.cancel()  # Items still running are abandoned
+        for future, index in futures.items():
+            command = items[index][0]
+            if not future.done():
+                future.cancel()
+                results[index] = batch_item_error(command, "Timed out")
+            elif future.exception():
+                results[index] = batch_item_error(command, str(future.exception()))
+            else:
+                results[index] = future.result()
+        
+        return jsonify(build_batch_response(results))
+        
+    except Exception as e:
+        logger.error(f"Error in process_commands endpoint: {e}")
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+
 @app.route('/execute', methods=['POST'])
 def execute_command():
     """Execute RouterOS command remotely (optional feature)."""
@@ -452,6 +4273,263 @@ def handshake():
         }), 500
 
 
+# ============================================================================
+# DEVICE AUTHORIZATION STORE
+# ============================================================================
+
+class AuthorizationStoreFull(Exception):
+    """Raised when the number of pending device codes has reached its cap."""
+
+
+class SQLiteAuthorizationBackend:
+    """Write-through SQLite persistence so device authorizations survive restarts."""
+
+    COLUMNS = ('device_code', 'router_id', 'router_identity', 'api_key', 'status',
+               'created_at', 'expires_at', 'authorized_at')
+    DATETIME_FIELDS = ('created_at', 'expires_at', 'authorized_at')
+
+    def __init__(self, path: str):
+        self.path = path
+        new_file = not os.path.exists(path)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        if new_file:
+            os.chmod(path, 0o600)  # The file holds API keys
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS device_authorizations ("
+            "device_code TEXT PRIMARY KEY, router_id TEXT, router_identity TEXT, api_key TEXT, "
+            "status TEXT, created_at TEXT, expires_at TEXT, authorized_at TEXT)"
+        )
+
+    def load(self) -> Iterator[tuple]:
+        """Yield (device_code, record) for every stored authorization."""
+        cursor = self._conn.execute(f"SELECT {', '.join(self.COLUMNS)} FROM device_authorizations")
+        for row in cursor:
+            record = dict(zip(self.COLUMNS[1:], row[1:]))
+            for field in self.DATETIME_FIELDS:
+                if record[field]:
+                    record[field] = datetime.fromisoformat(record[field])
+            yield row[0], record
+
+    def save(self, device_code: str, record: Dict[str, Any]):
+        values = [device_code] + [
+            record[field].isoformat() if field in self.DATETIME_FIELDS and record[field] else record[field]
+            for field in self.COLUMNS[1:]
+        ]
+        self._conn.execute(
+            f"INSERT OR REPLACE INTO device_authorizations ({', '.join(self.COLUMNS)}) "
+            f"VALUES ({', '.join('?' * len(self.COLUMNS))})",
+            values,
+        )
+
+    def delete(self, device_codes: list):
+        self._conn.executemany(
+            "DELETE FROM device_authorizations WHERE device_code = ?",
+            [(code,) for code in device_codes],
+        )
+
+    def close(self):
+        self._conn.close()
+
+
+class DeviceAuthorizationStore:
+    """Device codes indexed by code and router_id, expired through a min-heap.
+    
+    Expired entries are popped from the heap head as operations run, so no
+    request scans the whole table. Codes of one router live side by side
+    until they expire (/auth/request is unauthenticated, so a new request
+    must not cancel another one), and the number of pending codes is capped.
+    """
+
+    def __init__(self, max_pending: int, backend: Optional[SQLiteAuthorizationBackend] = None):
+        self.max_pending = max_pending
+        self.backend = backend
+        self._records = {}      # device_code -> record
+        self._by_router = {}    # router_id -> set of device codes
+        self._expiry = []       # heap of (expires_at, device_code), may hold entries of removed codes
+        self._waiters = {}      # device_code -> [callback] run when the code is authorized or removed
+        self._last_poll = {}    # device_code -> time.monotonic() of the previous short poll
+        self._pending = 0
+        self._lock = threading.Lock()
+        self.expired = 0
+        self.compactions = 0
+        if backend:
+            for device_code, record in backend.load():
+                self._insert(device_code, record)
+            with self._lock:
+                self._purge_expired()
+            logger.info(f"Loaded {len(self._records)} device authorizations from {backend.path}")
+
+    def _insert(self, device_code: str, record: Dict[str, Any]):
+        self._records[device_code] = record
+        self._by_router.setdefault(record['router_id'], set()).add(device_code)
+        heapq.heappush(self._expiry, (record['expires_at'], device_code))
+        if record['status'] == 'pending':
+            self._pending += 1
+
+    def _remove(self, device_code: str) -> Optional[Dict[str, Any]]:
+        record = self._records.pop(device_code, None)
+        if record is None:
+            return None
+        codes = self._by_router.get(record['router_id'])
+        if codes is not None:
+            codes.discard(device_code)
+            if not codes:
+                del self._by_router[record['router_id']]
+        if record['status'] == 'pending':
+            self._pending -= 1
+        self._last_poll.pop(device_code, None)
+        self._wake(device_code)
+        # The heap entry is skipped when it reaches the top, unless the heap
+        # is rebuilt first because stale entries have taken over
+        if len(self._expiry) > 2 * len(self._records):
+            self._compact()
+        return record
+
+    def _compact(self):
+        """Rebuild the expiry heap from live entries; O(n), amortized over the removals."""
+        self._expiry = [(record['expires_at'], code) for code, record in self._records.items()]
+        heapq.heapify(self._expiry)
+        self.compactions += 1
+
+    def _wake(self, device_code: str):
+        for callback in self._waiters.pop(device_code, ()):
+            callback()
+
+    def _purge_expired(self) -> list:
+        """Drop entries whose expiry has passed; O(log n) per expired entry."""
+        now = datetime.utcnow()
+        removed = []
+        while self._expiry and self._expiry[0][0] <= now:
+            expires_at, device_code = heapq.heappop(self._expiry)
+            record = self._records.get(device_code)
+            if record is not None and record['expires_at'] == expires_at:
+                self._remove(device_code)
+                removed.append(device_code)
+        if removed:
+            self.expired += len(removed)
+            if self.backend:
+                self.backend.delete(removed)
+            logger.info(f"Cleaned up {len(removed)} expired device authorizations")
+        return removed
+
+    def create(self, router_id: str, router_identity: str) -> tuple:
+        """Register a pending device code for a router and return (device_code, record)."""
+        now = datetime.utcnow()
+        device_code = generate_device_code()
+        record = {
+            'api_key': None,
+            'router_id': router_id,
+            'router_identity': router_identity,
+            'created_at': now,
+            'expires_at': now + timedelta(hours=AUTHORIZATION_EXPIRY_HOURS),
+            'authorized_at': None,
+            'status': 'pending',
+        }
+        with self._lock:
+            self._purge_expired()
+            if self._pending >= self.max_pending:
+                raise AuthorizationStoreFull("Too many pending device authorizations")
+            self._insert(device_code, record)
+            if self.backend:
+                self.backend.save(device_code, record)
+        return device_code, dict(record)
+
+    def get(self, device_code: str) -> Optional[Dict[str, Any]]:
+        """Return a copy of an unexpired authorization, or None."""
+        with self._lock:
+            self._purge_expired()
+            record = self._records.get(device_code)
+            return dict(record) if record else None
+
+    def authorize(self, device_code: str, api_key: str) -> Optional[Dict[str, Any]]:
+        """Attach an API key to a device code; returns the updated record or None."""
+        with self._lock:
+            self._purge_expired()
+            record = self._records.get(device_code)
+            if record is None:
+                return None
+            if record['status'] == 'pending':
+                self._pending -= 1
+            record.update(api_key=api_key, authorized_at=datetime.utcnow(), status='authorized')
+            if self.backend:
+                self.backend.save(device_code, record)
+            self._wake(device_code)
+            return dict(record)
+
+    def add_waiter(self, device_code: str, callback: Callable[[], None]) -> bool:
+        """Call callback once the pending code is authorized or removed.
+        
+        Returns False (without registering) when the code is unknown or no
+        longer pending, so there is nothing to wait for.
+        """
+        with self._lock:
+            self._purge_expired()
+            record = self._records.get(device_code)
+            if record is None or record['status'] != 'pending':
+                return False
+            self._waiters.setdefault(device_code, []).append(callback)
+            return True
+
+    def discard_waiter(self, device_code: str, callback: Callable[[], None]):
+        with self._lock:
+            callbacks = self._waiters.get(device_code)
+            if callbacks and callback in callbacks:
+                callbacks.remove(callback)
+                if not callbacks:
+                    del self._waiters[device_code]
+
+    def seconds_since_poll(self, device_code: str) -> float:
+        """Record a short poll and return the time since the previous one."""
+        now = time.monotonic()
+        with self._lock:
+            previous = self._last_poll.get(device_code)
+            if device_code in self._records:
+                self._last_poll[device_code] = now
+        return now - previous if previous is not None else float('inf')
+
+    def remove(self, device_code: str) -> bool:
+        """Delete a device code (e.g. after one-time retrieval)."""
+        with self._lock:
+            removed = self._remove(device_code) is not None
+            if removed and self.backend:
+                self.backend.delete([device_code])
+            return removed
+
+    def for_router(self, router_id: str) -> list:
+        """Return copies of the unexpired authorizations of a router."""
+        with self._lock:
+            self._purge_expired()
+            return [dict(self._records[code], device_code=code) for code in self._by_router.get(router_id, ())]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._records),
+                "pending": self._pending,
+                "max_pending": self.max_pending,
+                "routers": len(self._by_router),
+                "waiting": sum(len(callbacks) for callbacks in self._waiters.values()),
+                "expired": self.expired,
+                "expiry_heap": len(self._expiry),
+                "compactions": self.compactions,
+                "persistent": self.backend is not None,
+            }
+
+    def close(self):
+        """Release the backend; called once the servers have stopped."""
+        with self._lock:
+            if self.backend:
+                self.backend.close()
+                self.backend = None
+
+
+authorization_store = DeviceAuthorizationStore(
+    CONFIG['auth_max_pending'],
+    SQLiteAuthorizationBackend(CONFIG['auth_store_path']) if CONFIG['auth_store_path'] else None,
+)
+
+
 # ============================================================================
 # DEVICE AUTHORIZATION HELPERS
 # ============================================================================
@@ -461,18 +4539,108 @@ def generate_device_code() -> str:
     return secrets.token_urlsafe(32)
 
 
-def cleanup_expired_authorizations():
-    """Remove expired device authorizations."""
-    with AUTHORIZATION_LOCK:
-        current_time = datetime.utcnow()
-        expired_codes = [
-            code for code, auth in DEVICE_AUTHORIZATIONS.items()
-            if auth.get('expires_at') and auth['expires_at'] < current_time
-        ]
-        for code in expired_codes:
-            del DEVICE_AUTHORIZATIONS[code]
-        if expired_codes:
-            logger.info(f"Cleaned up {len(expired_codes)} expired device authorizations")
+def parse_poll_wait(data: Dict, query_value: Optional[str]) -> float:
+    """Return the requested long-poll hold in seconds, clamped to auth_poll_max_wait."""
+    value = data.get('wait', query_value)
+    try:
+        wait = float(value) if value not in (None, '') else 0.0
+    except (TypeError, ValueError):
+        wait = 0.0
+    return min(max(wait, 0.0), CONFIG['auth_poll_max_wait'])
+
+
+class HeldPollLimit:
+    """Caps the long polls holding HTTP worker threads at once (threaded mode).
+    
+    A poll past the cap is answered right away as a short poll; its interval
+    hint tells the router when to come back, so waiting routers cannot take
+    over the worker pool shared with translation requests.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.held = 0
+        self.degraded = 0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        with self._lock:
+            if self.held >= self.limit:
+                self.degraded += 1
+                return False
+            self.held += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.held -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"held": self.held, "limit": self.limit, "degraded": self.degraded}
+
+
+held_polls = HeldPollLimit(CONFIG['auth_poll_max_held'] or max(1, CONFIG['http_workers'] // 4))
+
+
+def wait_for_authorization(device_code: str, wait: float) -> Optional[Dict[str, Any]]:
+    """Hold until the code is authorized (or gone) or wait seconds pass; returns the record."""
+    event = threading.Event()
+    if authorization_store.add_waiter(device_code, event.set):
+        try:
+            event.wait(wait)
+        finally:
+            authorization_store.discard_waiter(device_code, event.set)
+    return authorization_store.get(device_code)
+
+
+def build_poll_response(device_code: str, auth_info: Optional[Dict[str, Any]], wait: float, waited: float) -> tuple:
+    """Build the /auth/poll body and status code.
+    
+    Pending responses carry an OAuth-style polling hint: interval is how long
+    to wait before the next poll (0 right after a full long-poll hold), and
+    slow_down is set when short polls arrive faster than the interval.
+    """
+    if not auth_info:
+        return {
+            "success": False,
+            "error": "Invalid or expired device code",
+            "authorized": False
+        }, 404
+    
+    # Check if authorized
+    if auth_info.get('api_key') and auth_info.get('status') == 'authorized':
+        # Optionally remove from storage after retrieval (one-time use)
+        # Or keep it for re-authorization
+        # authorization_store.remove(device_code)
+        
+        logger.info(f"Device authorization retrieved: router_id={auth_info.get('router_id')}, device_code={device_code[:8]}...")
+        
+        return {
+            "success": True,
+            "authorized": True,
+            "api_key": auth_info['api_key'],
+            "router_id": auth_info.get('router_id'),
+            "router_identity": auth_info.get('router_identity'),
+            "authorized_at": auth_info.get('authorized_at').isoformat() if auth_info.get('authorized_at') else None
+        }, 200
+    
+    interval = CONFIG['auth_poll_interval']
+    slow_down = False
+    if wait > 0:
+        interval = 0  # The hold already spaced the polls out
+    elif authorization_store.seconds_since_poll(device_code) < interval:
+        slow_down = True
+        interval += 5
+    return {
+        "success": True,
+        "authorized": False,
+        "status": auth_info.get('status', 'pending'),
+        "message": "Authorization pending - user has not yet authorized this device",
+        "interval": interval,
+        "slow_down": slow_down,
+        "waited": int(round(waited)),  # Whole seconds: RouterOS scripts have no floats
+    }, 200
 
 
 def get_authorization_url(device_code: str, base_url: str = None) -> str:
@@ -487,6 +4655,179 @@ def get_authorization_url(device_code: str, base_url: str = None) -> str:
     return f"{base_url}/auth/{device_code}"
 
 
+# ============================================================================
+# DEVICE AUTHORIZATION PAGES
+# ============================================================================
+# Compiled once at startup: pages without per-device data are rendered once
+# and served as bytes; the stylesheet is shared and cached by browsers.
+
+AUTH_PAGE_CSS = """
+body { font-family: Arial, sans-serif; max-width: 600px; margin: 50px auto; padding: 20px; }
+body.form-page { background: #f5f5f5; }
+.error { background: #fee; border: 1px solid #fcc; padding: 15px; border-radius: 5px; color: #c00; }
+.success { background: #efe; border: 1px solid #cfc; padding: 15px; border-radius: 5px; color: #0a0; }
+.note { background: #eef; border: 1px solid #ccf; padding: 15px; border-radius: 5px; margin-top: 15px; }
+.retry-form { margin-top: 20px; }
+.retry-form input { width: 100%; padding: 8px; margin: 10px 0; }
+.retry-form button { padding: 10px 20px; background: #007bff; color: white; border: none; border-radius: 5px; cursor: pointer; }
+.container { background: white; padding: 30px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }
+.container h1 { color: #333; }
+.container .info { background: #e3f2fd; border-left: 4px solid #2196F3; padding: 15px; margin: 20px 0; }
+.container .warning { background: #fff3e0; border-left: 4px solid #ff9800; padding: 15px; margin: 20px 0; }
+.container label { display: block; margin: 15px 0 5px 0; font-weight: bold; color: #555; }
+.container input[type="text"] { width: 100%; padding: 12px; border: 2px solid #ddd; border-radius: 5px; font-size: 14px; box-sizing: border-box; }
+.container input[type="text"]:focus { border-color: #007bff; outline: none; }
+.container button { padding: 12px 30px; background: #007bff; color: white; border: none; border-radius: 5px; cursor: pointer; font-size: 16px; margin-top: 10px; }
+.container button:hover { background: #0056b3; }
+.help { margin-top: 20px; padding: 15px; background: #f9f9f9; border-radius: 5px; font-size: 14px; color: #666; }
+.help a { color: #007bff; text-decoration: none; }
+.help a:hover { text-decoration: underline; }
+"""
+
+AUTH_PAGE_TEMPLATES = {
+    "layout.html": """<!DOCTYPE html>
+<html>
+<head>
+    <title>{% block title %}Device Authorization{% endblock %}</title>
+    <link rel="stylesheet" href="{{ css_url }}">
+</head>
+<body{% block body_class %}{% endblock %}>
+{% block content %}{% endblock %}
+</body>
+</html>
+""",
+    "invalid_code.html": """{% extends "layout.html" %}
+{% block title %}Device Authorization - Invalid Code{% endblock %}
+{% block content %}
+    <h1>❌ Invalid Authorization Code</h1>
+    <div class="error">
+        <p>This authorization code is invalid or has expired.</p>
+        <p>Please request a new authorization code from your router.</p>
+    </div>
+{% endblock %}
+""",
+    "already_authorized.html": """{% extends "layout.html" %}
+{% block title %}Device Authorization - Already Authorized{% endblock %}
+{% block content %}
+    <h1>✅ Device Already Authorized</h1>
+    <div class="success">
+        <p><strong>Router:</strong> {{ router_identity }}</p>
+        <p>This device has already been authorized.</p>
+        <p>You can close this page.</p>
+    </div>
+{% endblock %}
+""",
+    "key_error.html": """{% extends "layout.html" %}
+{% block title %}Device Authorization - Error{% endblock %}
+{% block content %}
+    <h1>Device Authorization</h1>
+    <div class="error">
+        <p>{{ message }}</p>
+    </div>
+    <form method="POST" class="retry-form">
+        <label>Claude API Key:</label><br>
+        <input type="text" name="api_key" placeholder="sk-ant-api03-..."><br>
+        <button type="submit">Authorize Device</button>
+    </form>
+{% endblock %}
+""",
+    "authorized.html": """{% extends "layout.html" %}
+{% block title %}Device Authorization - Success{% endblock %}
+{% block content %}
+    <h1>✅ Device Authorized Successfully!</h1>
+    <div class="success">
+        <p><strong>Router:</strong> {{ router_identity }}</p>
+        <p>Your router has been authorized and can now use Claude API.</p>
+        <p>You can close this page.</p>
+    </div>
+    <div class="note">
+        <p><strong>Note:</strong> The API key is now stored on your router and tied to this device only.</p>
+    </div>
+{% endblock %}
+""",
+    "form.html": """{% extends "layout.html" %}
+{% block body_class %} class="form-page"{% endblock %}
+{% block content %}
+    <div class="container">
+        <h1>🔐 Authorize Router Device</h1>
+        
+        <div class="info">
+            <p><strong>Router:</strong> {{ router_identity }}</p>
+            <p><strong>Device ID:</strong> {{ router_id }}</p>
+        </div>
+        
+        <div class="warning">
+            <p><strong>⚠️ Security Notice:</strong></p>
+            <p>This API key will be stored on your router and will only work for this specific device.</p>
+        </div>
+        
+        <form method="POST">
+            <label for="api_key">Enter your Claude API Key:</label>
+            <input type="text" id="api_key" name="api_key" placeholder="sk-ant-api03-..." required>
+            
+            <button type="submit">✅ Authorize Device</button>
+        </form>
+        
+        <div class="help">
+            <p><strong>How to get your Claude API Key:</strong></p>
+            <ol>
+                <li>Visit <a href="https://console.anthropic.com/" target="_blank">Anthropic Console</a></li>
+                <li>Sign in or create an account</li>
+                <li>Go to API Keys section</li>
+                <li>Create a new API key or use an existing one</li>
+                <li>Copy the key (starts with <code>sk-ant-</code>)</li>
+                <li>Paste it above and click "Authorize Device"</li>
+            </ol>
+        </div>
+    </div>
+{% endblock %}
+""",
+}
+
+
+class AuthPages:
+    """Device authorization pages, compiled once with static pages pre-rendered."""
+
+    # Cache-busting version so the stylesheet can be cached for a year
+    css_version = hashlib.sha256(AUTH_PAGE_CSS.encode('utf-8')).hexdigest()[:12]
+    css_url = f"/auth/static/auth.css?v={css_version}"
+
+    def __init__(self):
+        env = Environment(loader=DictLoader(AUTH_PAGE_TEMPLATES), autoescape=True, auto_reload=False)
+        self.templates = {name: env.get_template(name) for name in AUTH_PAGE_TEMPLATES}
+        self.css = AUTH_PAGE_CSS.encode('utf-8')
+        self.static = {
+            "invalid_code": self._encode("invalid_code.html"),
+            "missing_key": self._encode("key_error.html", message="Invalid API key. Please enter a valid Claude API key."),
+            "bad_key_format": self._encode(
+                "key_error.html",
+                message="Invalid API key format. Claude API keys should start with 'sk-ant-'.",
+            ),
+        }
+
+    def render(self, name: str, **context) -> str:
+        return self.templates[name].render(css_url=self.css_url, **context)
+
+    def _encode(self, name: str, **context) -> bytes:
+        return self.render(name, **context).encode('utf-8')
+
+    def static_page(self, name: str, status: int = 200) -> Response:
+        """Serve a pre-rendered page without touching the template engine."""
+        return Response(self.static[name], status=status, mimetype='text/html')
+
+
+auth_pages = AuthPages()
+
+
+@app.route('/auth/static/auth.css', methods=['GET'])
+def auth_page_stylesheet():
+    """Shared stylesheet of the authorization pages (versioned URL, cached for a year)."""
+    response = Response(auth_pages.css, mimetype='text/css')
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response.headers['ETag'] = f'"{auth_pages.css_version}"'
+    return response
+
+
 # ============================================================================
 # DEVICE AUTHORIZATION ENDPOINTS
 # ============================================================================
@@ -509,20 +4850,15 @@ def request_device_authorization():
                 "error": "Missing 'router_id' or 'device_id' in request"
             }), 400
         
-        # Generate device code
-        device_code = generate_device_code()
-        
-        # Store authorization request
-        with AUTHORIZATION_LOCK:
-            DEVICE_AUTHORIZATIONS[device_code] = {
-                'api_key': None,
-                'router_id': router_id,
-                'router_identity': router_identity or router_id,
-                'created_at': datetime.utcnow(),
-                'expires_at': datetime.utcnow() + timedelta(hours=AUTHORIZATION_EXPIRY_HOURS),
-                'authorized_at': None,
-                'status': 'pending'
-            }
+        # Generate and store device code
+        try:
+            device_code, _ = authorization_store.create(router_id, router_identity or router_id)
+        except AuthorizationStoreFull as e:
+            logger.warning(f"Refused device authorization for router_id={router_id}: {e}")
+            return jsonify({
+                "success": False,
+                "error": "Too many pending authorizations, retry later"
+            }), 503
         
         # Generate authorization URL
         auth_url = get_authorization_url(device_code)
@@ -549,206 +4885,46 @@ def request_device_authorization():
 def device_authorization_page(device_code: str):
     """Web page for user to enter API key for device authorization."""
     try:
-        # Cleanup expired codes
-        cleanup_expired_authorizations()
-        
-        # Get authorization info
-        with AUTHORIZATION_LOCK:
-            auth_info = DEVICE_AUTHORIZATIONS.get(device_code)
+        # Get authorization info (expired codes are dropped by the store)
+        auth_info = authorization_store.get(device_code)
         
         if not auth_info:
-            return render_template_string("""
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <title>Device Authorization - Invalid Code</title>
-                <style>
-                    body { font-family: Arial, sans-serif; max-width: 600px; margin: 50px auto; padding: 20px; }
-                    .error { background: #fee; border: 1px solid #fcc; padding: 15px; border-radius: 5px; color: #c00; }
-                </style>
-            </head>
-            <body>
-                <h1>❌ Invalid Authorization Code</h1>
-                <div class="error">
-                    <p>This authorization code is invalid or has expired.</p>
-                    <p>Please request a new authorization code from your router.</p>
-                </div>
-            </body>
-            </html>
-            """), 404
+            return auth_pages.static_page("invalid_code", 404)
         
         # Check if already authorized
         if auth_info.get('api_key'):
-            return render_template_string("""
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <title>Device Authorization - Already Authorized</title>
-                <style>
-                    body { font-family: Arial, sans-serif; max-width: 600px; margin: 50px auto; padding: 20px; }
-                    .success { background: #efe; border: 1px solid #cfc; padding: 15px; border-radius: 5px; color: #0a0; }
-                </style>
-            </head>
-            <body>
-                <h1>✅ Device Already Authorized</h1>
-                <div class="success">
-                    <p><strong>Router:</strong> {{ router_identity }}</p>
-                    <p>This device has already been authorized.</p>
-                    <p>You can close this page.</p>
-                </div>
-            </body>
-            </html>
-            """, router_identity=auth_info.get('router_identity', 'Unknown'))
+            return auth_pages.render(
+                "already_authorized.html",
+                router_identity=auth_info.get('router_identity', 'Unknown'),
+            )
         
         # Handle POST (API key submission)
         if request.method == 'POST':
             api_key = request.form.get('api_key', '').strip()
             
             if not api_key or len(api_key) < 10:
-                return render_template_string("""
-                <!DOCTYPE html>
-                <html>
-                <head>
-                    <title>Device Authorization - Error</title>
-                    <style>
-                        body { font-family: Arial, sans-serif; max-width: 600px; margin: 50px auto; padding: 20px; }
-                        .error { background: #fee; border: 1px solid #fcc; padding: 15px; border-radius: 5px; color: #c00; }
-                        form { margin-top: 20px; }
-                    </style>
-                </head>
-                <body>
-                    <h1>Device Authorization</h1>
-                    <div class="error">
-                        <p>Invalid API key. Please enter a valid Claude API key.</p>
-                    </div>
-                    <form method="POST">
-                        <label>Claude API Key:</label><br>
-                        <input type="text" name="api_key" style="width: 100%; padding: 8px; margin: 10px 0;" placeholder="sk-ant-api03-..."><br>
-                        <button type="submit" style="padding: 10px 20px; background: #007bff; color: white; border: none; border-radius: 5px; cursor: pointer;">Authorize Device</button>
-                    </form>
-                </body>
-                </html>
-                """)
+                return auth_pages.static_page("missing_key")
             
             # Validate API key format (basic check)
             if not api_key.startswith('sk-ant-'):
-                return render_template_string("""
-                <!DOCTYPE html>
-                <html>
-                <head>
-                    <title>Device Authorization - Error</title>
-                    <style>
-                        body { font-family: Arial, sans-serif; max-width: 600px; margin: 50px auto; padding: 20px; }
-                        .error { background: #fee; border: 1px solid #fcc; padding: 15px; border-radius: 5px; color: #c00; }
-                        form { margin-top: 20px; }
-                    </style>
-                </head>
-                <body>
-                    <h1>Device Authorization</h1>
-                    <div class="error">
-                        <p>Invalid API key format. Claude API keys should start with 'sk-ant-'.</p>
-                    </div>
-                    <form method="POST">
-                        <label>Claude API Key:</label><br>
-                        <input type="text" name="api_key" style="width: 100%; padding: 8px; margin: 10px 0;" placeholder="sk-ant-api03-..."><br>
-                        <button type="submit" style="padding: 10px 20px; background: #007bff; color: white; border: none; border-radius: 5px; cursor: pointer;">Authorize Device</button>
-                    </form>
-                </body>
-                </html>
-                """)
+                return auth_pages.static_page("bad_key_format")
             
             # Store API key
-            with AUTHORIZATION_LOCK:
-                if device_code in DEVICE_AUTHORIZATIONS:
-                    DEVICE_AUTHORIZATIONS[device_code]['api_key'] = api_key
-                    DEVICE_AUTHORIZATIONS[device_code]['authorized_at'] = datetime.utcnow()
-                    DEVICE_AUTHORIZATIONS[device_code]['status'] = 'authorized'
+            authorization_store.authorize(device_code, api_key)
             
             logger.info(f"Device authorized: router_id={auth_info.get('router_id')}, device_code={device_code[:8]}...")
             
-            return render_template_string("""
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <title>Device Authorization - Success</title>
-                <style>
-                    body { font-family: Arial, sans-serif; max-width: 600px; margin: 50px auto; padding: 20px; }
-                    .success { background: #efe; border: 1px solid #cfc; padding: 15px; border-radius: 5px; color: #0a0; }
-                    .info { background: #eef; border: 1px solid #ccf; padding: 15px; border-radius: 5px; margin-top: 15px; }
-                </style>
-            </head>
-            <body>
-                <h1>✅ Device Authorized Successfully!</h1>
-                <div class="success">
-                    <p><strong>Router:</strong> {{ router_identity }}</p>
-                    <p>Your router has been authorized and can now use Claude API.</p>
-                    <p>You can close this page.</p>
-                </div>
-                <div class="info">
-                    <p><strong>Note:</strong> The API key is now stored on your router and tied to this device only.</p>
-                </div>
-            </body>
-            </html>
-            """, router_identity=auth_info.get('router_identity', 'Unknown'))
+            return auth_pages.render(
+                "authorized.html",
+                router_identity=auth_info.get('router_identity', 'Unknown'),
+            )
         
         # GET - Show authorization form
-        return render_template_string("""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <title>Device Authorization</title>
-            <style>
-                body { font-family: Arial, sans-serif; max-width: 600px; margin: 50px auto; padding: 20px; background: #f5f5f5; }
-                .container { background: white; padding: 30px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }
-                h1 { color: #333; }
-                .info { background: #e3f2fd; border-left: 4px solid #2196F3; padding: 15px; margin: 20px 0; }
-                .warning { background: #fff3e0; border-left: 4px solid #ff9800; padding: 15px; margin: 20px 0; }
-                label { display: block; margin: 15px 0 5px 0; font-weight: bold; color: #555; }
-                input[type="text"] { width: 100%; padding: 12px; border: 2px solid #ddd; border-radius: 5px; font-size: 14px; box-sizing: border-box; }
-                input[type="text"]:focus { border-color: #007bff; outline: none; }
-                button { padding: 12px 30px; background: #007bff; color: white; border: none; border-radius: 5px; cursor: pointer; font-size: 16px; margin-top: 10px; }
-                button:hover { background: #0056b3; }
-                .help { margin-top: 20px; padding: 15px; background: #f9f9f9; border-radius: 5px; font-size: 14px; color: #666; }
-                .help a { color: #007bff; text-decoration: none; }
-                .help a:hover { text-decoration: underline; }
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <h1>🔐 Authorize Router Device</h1>
-                
-                <div class="info">
-                    <p><strong>Router:</strong> {{ router_identity }}</p>
-                    <p><strong>Device ID:</strong> {{ router_id }}</p>
-                </div>
-                
-                <div class="warning">
-                    <p><strong>⚠️ Security Notice:</strong></p>
-                    <p>This API key will be stored on your router and will only work for this specific device.</p>
-                </div>
-                
-                <form method="POST">
-                    <label for="api_key">Enter your Claude API Key:</label>
-                    <input type="text" id="api_key" name="api_key" placeholder="sk-ant-api03-..." required>
-                    
-                    <button type="submit">✅ Authorize Device</button>
-                </form>
-                
-                <div class="help">
-                    <p><strong>How to get your Claude API Key:</strong></p>
-                    <ol>
-                        <li>Visit <a href="https://console.anthropic.com/" target="_blank">Anthropic Console</a></li>
-                        <li>Sign in or create an account</li>
-                        <li>Go to API Keys section</li>
-                        <li>Create a new API key or use an existing one</li>
-                        <li>Copy the key (starts with <code>sk-ant-</code>)</li>
-                        <li>Paste it above and click "Authorize Device"</li>
-                    </ol>
-                </div>
-            </div>
-        </body>
-        </html>
-        """, router_identity=auth_info.get('router_identity', 'Unknown'), router_id=auth_info.get('router_id', 'Unknown'))
+        return auth_pages.render(
+            "form.html",
+            router_identity=auth_info.get('router_identity', 'Unknown'),
+            router_id=auth_info.get('router_id', 'Unknown'),
+        )
         
     except Exception as e:
         logger.error(f"Error in device_authorization_page: {e}")
@@ -757,9 +4933,13 @@ def device_authorization_page(device_code: str):
 
 @app.route('/auth/poll', methods=['POST'])
 def poll_device_authorization():
-    """Poll for device authorization status - router checks if API key is available."""
+    """Poll for device authorization status - router checks if API key is available.
+    
+    With "wait" (body or query, seconds) the request is held until the user
+    authorizes the device or the wait expires.
+    """
     try:
-        data = request.get_json() or {}
+        data = request.get_json(silent=True) or {}
         device_code = data.get('device_code', '')
         
         if not device_code:
@@ -768,45 +4948,21 @@ def poll_device_authorization():
                 "error": "Missing 'device_code' in request"
             }), 400
         
-        # Cleanup expired codes
-        cleanup_expired_authorizations()
-        
-        # Get authorization info
-        with AUTHORIZATION_LOCK:
-            auth_info = DEVICE_AUTHORIZATIONS.get(device_code)
-        
-        if not auth_info:
-            return jsonify({
-                "success": False,
-                "error": "Invalid or expired device code",
-                "authorized": False
-            }), 404
-        
-        # Check if authorized
-        if auth_info.get('api_key') and auth_info.get('status') == 'authorized':
-            api_key = auth_info['api_key']
-            
-            # Optionally remove from storage after retrieval (one-time use)
-            # Or keep it for re-authorization
-            # del DEVICE_AUTHORIZATIONS[device_code]
-            
-            logger.info(f"Device authorization retrieved: router_id={auth_info.get('router_id')}, device_code={device_code[:8]}...")
-            
-            return jsonify({
-                "success": True,
-                "authorized": True,
-                "api_key": api_key,
-                "router_id": auth_info.get('router_id'),
-                "router_identity": auth_info.get('router_identity'),
-                "authorized_at": auth_info.get('authorized_at').isoformat() if auth_info.get('authorized_at') else None
-            })
+        wait = parse_poll_wait(data, request.args.get('wait'))
+        if wait > 0 and not held_polls.acquire():
+            wait = 0.0  # Too many polls held already: answer as a short poll
+        started = time.monotonic()
+        if wait > 0:
+            try:
+                auth_info = wait_for_authorization(device_code, wait)
+            finally:
+                held_polls.release()
         else:
-            return jsonify({
-                "success": True,
-                "authorized": False,
-                "status": auth_info.get('status', 'pending'),
-                "message": "Authorization pending - user has not yet authorized this device"
-            })
+            # Get authorization info (expired codes are dropped by the store)
+            auth_info = authorization_store.get(device_code)
+        
+        body, status = build_poll_response(device_code, auth_info, wait, time.monotonic() - started)
+        return jsonify(body), status
         
     except Exception as e:
         logger.error(f"Error in poll_device_authorization: {e}")
@@ -816,30 +4972,7 @@ def poll_device_authorization():
         }), 500
 
 
-@app.route('/suggest-error-fix', methods=['POST'])
-def suggest_error_fix():
-    """Analyze command error and suggest fixes using Claude."""
-    try:
-        data = request.get_json()
-        
-        if not data:
-            return jsonify({
-                "success": False,
-                "error": "Missing request body"
-            }), 400
-        
-        original_command = data.get('original_command', '')
-        error_message = data.get('error_message', '')
-        command_output = data.get('command_output', '')
-        
-        if not original_command:
-            return jsonify({
-                "success": False,
-                "error": "Missing 'original_command' in request body"
-            }), 400
-        
-        # Build prompt for Claude to analyze the error
-        system_prompt = """You are a RouterOS command expert assistant. Your task is to analyze command errors and suggest fixes.
+ERROR_FIX_SYSTEM_PROMPT = """You are a RouterOS command expert assistant. Your task is to analyze command errors and suggest fixes.
 
 When a RouterOS command fails, analyze:
 1. The original command that was attempted
@@ -854,7 +4987,10 @@ Provide helpful suggestions including:
 
 Be concise and actionable. Focus on RouterOS-specific syntax and common mistakes."""
 
-        user_prompt = f"""A RouterOS command failed. Please analyze and suggest a fix.
+
+def build_error_fix_prompt(original_command: str, error_message: str, command_output: str) -> str:
+    """Build the user prompt asking Claude to analyze a failed command."""
+    return f"""A RouterOS command failed. Please analyze and suggest a fix.
 
 Original Command:
 {original_command}
@@ -872,28 +5008,148 @@ Please provide:
 
 Format your response clearly with the corrected command if possible."""
 
-        # Call Claude API with custom system prompt for error analysis
-        suggestion = call_claude_api(user_prompt, custom_system_prompt=system_prompt)
+
+def build_error_fix_response(suggestion: Optional[str], original_command: str, error_message: str) -> tuple:
+    """Build the (body, status) reply for a Claude error-fix suggestion."""
+    if not suggestion:
+        if circuits_open('error_fix'):
+            return circuit_open_body('error_fix'), 503
+        return {
+            "success": False,
+            "error": "Failed to get suggestion from Claude API"
+        }, 500
+    
+    # Check if Claude returned an error
+    if suggestion.startswith("ERROR:"):
+        return {
+            "success": False,
+            "error": suggestion.replace("ERROR:", "").strip()
+        }, 500
+    
+    return {
+        "success": True,
+        "suggestion": suggestion,
+        "original_command": original_command,
+        "error_message": error_message
+    }, 200
+
+
+# ============================================================================
+# STREAMING RESPONSES
+# ============================================================================
+
+STREAM_MIMETYPES = {
+    "sse": "text/event-stream",
+    "lines": "text/plain; charset=utf-8",
+}
+STREAM_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+def get_stream_mode(data: Dict, query_value: Optional[str], accept: str) -> Optional[str]:
+    """Pick the streaming mode for a request: 'sse', 'lines' or None (buffered JSON)."""
+    value = data.get('stream', query_value)
+    if isinstance(value, str):
+        value = value.lower()
+        if value in STREAM_MIMETYPES:
+            return value
+        value = value in ("1", "true", "yes")
+    if value is True or "text/event-stream" in accept:
+        return "sse"
+    return None
+
+
+class StreamFormatter:
+    """Format streamed text as Server-Sent Events or complete text lines."""
+
+    def __init__(self, mode: str):
+        self.mode = mode
+        self._pending = ""
+
+    def feed(self, text: str) -> list:
+        if self.mode == "sse":
+            return [f"data: {json.dumps({'text': text})}\n\n"]
+        # Line mode: hold back the unfinished line
+        self._pending += text
+        lines, _, self._pending = self._pending.rpartition("\n")
+        return [lines + "\n"] if lines or _ else []
+
+    def finish(self, body: Dict[str, Any]) -> list:
+        if self.mode == "sse":
+            return [f"event: done\ndata: {json.dumps(body)}\n\n"]
+        return [self._pending + "\n"] if self._pending else []
+
+    def error(self, message: str) -> list:
+        if self.mode == "sse":
+            return [f"event: error\ndata: {json.dumps({'success': False, 'error': message})}\n\n"]
+        flushed = [self._pending + "\n"] if self._pending else []
+        return flushed + [f"ERROR: {message}\n"]
+
+
+def stream_error_fix(user_prompt: str, original_command: str, error_message: str, mode: str,
+                     deadline: RequestDeadline) -> Iterator[str]:
+    """Yield an error-fix suggestion as it is generated."""
+    formatter = StreamFormatter(mode)
+    parts = []
+    try:
+        for text in stream_claude_api(user_prompt, custom_system_prompt=ERROR_FIX_SYSTEM_PROMPT, task='error_fix',
+                                      deadline=deadline):
+            parts.append(text)
+            yield from formatter.feed(text)
+    except Exception as e:
+        logger.error(f"Error streaming error-fix suggestion: {e}")
+        yield from formatter.error(str(e))
+        return
+    finally:
+        deadline.cancel()  # Also reached when the client disconnects mid-stream
+    body, _ = build_error_fix_response("".join(parts).strip(), original_command, error_message)
+    yield from formatter.finish(body)
+
+
+@app.route('/suggest-error-fix', methods=['POST'])
+@accounted('suggest_error_fix')
+def suggest_error_fix():
+    """Analyze command error and suggest fixes using Claude."""
+    try:
+        data = request.get_json()
         
-        if not suggestion:
+        if not data:
             return jsonify({
                 "success": False,
-                "error": "Failed to get suggestion from Claude API"
-            }), 500
+                "error": "Missing request body"
+            }), 400
+        
+        original_command = data.get('original_command', '')
+        error_message = data.get('error_message', '')
+        command_output = data.get('command_output', '')
         
-        # Check if Claude returned an error
-        if suggestion.startswith("ERROR:"):
+        if not original_command:
             return jsonify({
                 "success": False,
-                "error": suggestion.replace("ERROR:", "").strip()
-            }), 500
+                "error": "Missing 'original_command' in request body"
+            }), 400
         
-        return jsonify({
-            "success": True,
-            "suggestion": suggestion,
-            "original_command": original_command,
-            "error_message": error_message
-        })
+        scope = usage_scope.get()
+        if usage_ledger.over_quota(scope):
+            return jsonify(quota_exceeded_body(scope)), 429
+        
+        user_prompt = build_error_fix_prompt(original_command, error_message, command_output)
+        deadline = RequestDeadline(CONFIG['request_timeout'])
+        
+        stream_mode = get_stream_mode(data, request.args.get('stream'), request.headers.get('Accept', ''))
+        if stream_mode:
+            return Response(
+                stream_with_context(stream_error_fix(user_prompt, original_command, error_message, stream_mode,
+                                                     deadline)),
+                mimetype=STREAM_MIMETYPES[stream_mode],
+                headers=STREAM_HEADERS,
+            )
+
+        # Call Claude API with custom system prompt for error analysis
+        suggestion = call_claude_api(user_prompt, custom_system_prompt=ERROR_FIX_SYSTEM_PROMPT, deadline=deadline,
+                                     task='error_fix')
+        
+        body, status = build_error_fix_response(suggestion, original_command, error_message)
+        return jsonify(body), status
         
     except Exception as e:
         logger.error(f"Error in suggest_error_fix endpoint: {e}")
@@ -903,52 +5159,600 @@ Format your response clearly with the corrected command if possible."""
         }), 500
 
 
+# ============================================================================
+# ASYNC SERVING MODE (ASGI)
+# ============================================================================
+# /process-command and /suggest-error-fix run as native coroutines, so an
+# in-flight Claude call holds no thread. The remaining routes are served by
+# the Flask app mounted behind a WSGI adapter.
+
+async def call_claude_api_async(user_message: str, custom_system_prompt: Optional[str] = None,
+                                deadline: Optional[RequestDeadline] = None, task: str = 'translate') -> Optional[str]:
+    """Async variant of call_claude_api for the asgi serving mode."""
+    return (await call_llm_async(user_message, custom_system_prompt, deadline, task))[0]
+
+
+async def call_llm_async(user_message: str, custom_system_prompt: Optional[str] = None,
+                         deadline: Optional[RequestDeadline] = None, task: str = 'translate') -> tuple:
+    """Async variant of call_llm."""
+    backends = backends_for(task)
+    if not backends:
+        logger.error(f"No LLM backend configured for {task}")
+        return None, None
+    deadline = deadline or RequestDeadline(CONFIG['request_timeout'])
+    
+    with metrics.timer("relay_stage_duration_seconds", stage="prompt_build"):
+        system_prompt = custom_system_prompt or build_system_prompt()
+    
+    for index, backend in enumerate(backends):
+        if deadline.expired():
+            record_upstream_outcome("skipped", backend.name)
+            logger.warning("Skipping LLM call: caller deadline passed")
+            return None, None
+        if backend.breaker.allow():
+            text = await backend.complete_hedged_async(user_message, system_prompt, deadline, TASK_LANES[task])
+        else:
+            record_upstream_outcome("short_circuited", backend.name)
+            text = None
+        if text is not None:
+            return text, backend
+        if index + 1 < len(backends):
+            record_fallback(task, backend, backends[index + 1])
+    return None, None
+
+
+async def stream_claude_api_async(user_message: str, custom_system_prompt: Optional[str] = None,
+                                  task: str = 'translate', deadline: Optional[RequestDeadline] = None):
+    """Async variant of stream_claude_api."""
+    backends = backends_for(task)
+    if not backends:
+        raise RuntimeError(f"No LLM backend configured for {task}")
+    deadline = deadline or RequestDeadline(CONFIG['request_timeout'])
+    
+    with metrics.timer("relay_stage_duration_seconds", stage="prompt_build"):
+        system_prompt = custom_system_prompt or build_system_prompt()
+    
+    for index, backend in enumerate(backends):
+        deadline.check()
+        if not backend.breaker.allow():
+            if index + 1 == len(backends):
+                raise RuntimeError(f"LLM backends unavailable, retry in {llm_retry_after(task)}s")
+            record_fallback(task, backend, backends[index + 1])
+            continue
+        try:
+            response = await backend.open_stream_async(user_message, system_prompt, deadline, TASK_LANES[task])
+        except httpx.HTTPError:
+            if index + 1 == len(backends):
+                raise
+            record_fallback(task, backend, backends[index + 1])
+            continue
+        try:
+            async for line in response.aiter_lines():
+                text = backend.parse_stream_line(line)
+                if text:
+                    yield text
+        finally:
+            await response.aclose()
+        return
+
+
+async def stream_error_fix_async(user_prompt: str, original_command: str, error_message: str, mode: str,
+                                 deadline: RequestDeadline):
+    """Async variant of stream_error_fix."""
+    formatter = StreamFormatter(mode)
+    parts = []
+    try:
+        async for text in stream_claude_api_async(user_prompt, custom_system_prompt=ERROR_FIX_SYSTEM_PROMPT,
+                                                  task='error_fix', deadline=deadline):
+            parts.append(text)
+            for chunk in formatter.feed(text):
+                yield chunk
+    except Exception as e:
+        logger.error(f"Error streaming error-fix suggestion: {e}")
+        for chunk in formatter.error(str(e)):
+            yield chunk
+        return
+    finally:
+        deadline.cancel()
+    body, _ = build_error_fix_response("".join(parts).strip(), original_command, error_message)
+    for chunk in formatter.finish(body):
+        yield chunk
+
+
+async def process_smart_command_async(command: str, context: Optional[Dict] = None,
+                                      deadline: Optional[RequestDeadline] = None) -> Dict[str, Any]:
+    """Async variant of process_smart_command for the asgi serving mode."""
+    try:
+        prepared = prepare_smart_command(command, context)
+    except Exception as e:
+        return smart_command_error(command, e)
+    result = prepared.result or await translate_smart_command_async(command, context, deadline, prepared)
+    session_store.record(prepared.router, command, result)
+    return result
+
+
+async def translate_smart_command_async(command: str, context: Optional[Dict], deadline: Optional[RequestDeadline],
+                                        prepared: PreparedCommand) -> Dict[str, Any]:
+    """Async variant of translate_smart_command."""
+    deadline = deadline or RequestDeadline(CONFIG['request_timeout'])
+    history, cache_key = prepared.history, prepared.cache_key
+    try:
+        scope = usage_scope.get()
+        if usage_ledger.over_quota(scope):
+            return degraded_translation(command, cache_key, "quota", quota_exceeded_body(scope))
+        
+        deadline.check()
+        routeros_command, backend = await llm_flights.do_async(
+            flight_key(cache_key, context, history),
+            lambda shared: call_llm_async(build_translation_message(command, context, history), deadline=shared),
+            deadline,
+        )
+        if routeros_command is None and circuits_open('translate'):
+            return degraded_translation(command, cache_key, "circuit_open", circuit_open_body('translate'))
+        return finalize_llm_translation(command, routeros_command, cache_key, not prepared.contextual, backend)
+    
+    except Exception as e:
+        return smart_command_error(command, e)
+
+
+async def read_json_body(http_request) -> Optional[Dict[str, Any]]:
+    """Parse a JSON request body, returning None when missing or malformed."""
+    try:
+        data = await http_request.json()
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def accounted_async(endpoint: str):
+    """Async variant of accounted for the asgi handlers."""
+    def decorator(fn):
+        @wraps(fn)
+        async def wrapper(http_request):
+            router, identified = request_router(await read_json_body(http_request), http_request.headers.get('x-router-id'),
+                                                http_request.client.host if http_request.client else None)
+            scope = UsageScope(router, endpoint, identified)
+            usage_scope.set(scope)
+            started = time.perf_counter()
+            try:
+                return await fn(http_request)
+            finally:
+                usage_ledger.record_request(scope, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+async def wait_for_authorization_async(device_code: str, wait: float) -> Optional[Dict[str, Any]]:
+    """Async variant of wait_for_authorization; holds no worker thread."""
+    loop = asyncio.get_running_loop()
+    woken = asyncio.Event()
+    
+    def wake():
+        loop.call_soon_threadsafe(woken.set)
+    
+    if authorization_store.add_waiter(device_code, wake):
+        try:
+            await asyncio.wait_for(woken.wait(), timeout=wait)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            authorization_store.discard_waiter(device_code, wake)
+    return authorization_store.get(device_code)
+
+
+async def poll_device_authorization_async(http_request):
+    """Async /auth/poll endpoint, so long polls do not occupy the Flask worker pool."""
+    try:
+        data = await read_json_body(http_request) or {}
+        device_code = data.get('device_code', '')
+        
+        if not device_code:
+            return JSONResponse({
+                "success": False,
+                "error": "Missing 'device_code' in request"
+            }, status_code=400)
+        
+        wait = parse_poll_wait(data, http_request.query_params.get('wait'))
+        started = time.monotonic()
+        if wait > 0:
+            auth_info = await wait_for_authorization_async(device_code, wait)
+        else:
+            auth_info = authorization_store.get(device_code)
+        
+        body, status = build_poll_response(device_code, auth_info, wait, time.monotonic() - started)
+        return JSONResponse(body, status_code=status)
+    
+    except Exception as e:
+        logger.error(f"Error in poll_device_authorization: {e}")
+        return JSONResponse({
+            "success": False,
+            "error": str(e)
+        }, status_code=500)
+
+
+@accounted_async('process_command')
+async def process_command_async(http_request):
+    """Async /process-command endpoint."""
+    try:
+        with metrics.timer("relay_stage_duration_seconds", stage="json_parse"):
+            data = await read_json_body(http_request)
+        
+        if not data or 'command' not in data:
+            return JSONResponse({
+                "success": False,
+                "error": "Missing 'command' in request body"
+            }, status_code=400)
+        
+        deadline = RequestDeadline(CONFIG['request_timeout'])
+        try:
+            result = await asyncio.wait_for(
+                process_smart_command_async(data['command'], data.get('context', {}), deadline),
+                timeout=deadline.remaining(),
+            )
+        except asyncio.TimeoutError:
+            # Work still running for this request stops at its next deadline check
+            deadline.cancel()
+            logger.warning("Timed out processing /process-command")
+            return JSONResponse({
+                "success": False,
+                "error": "Timed out"
+            }, status_code=504)
+        with metrics.timer("relay_stage_duration_seconds", stage="serialization"):
+            return JSONResponse(result)
+    
+    except Exception as e:
+        logger.error(f"Error in process_command endpoint: {e!r}")
+        return JSONResponse({
+            "success": False,
+            "error": str(e) or type(e).__name__
+        }, status_code=500)
+
+
+@accounted_async('process_commands')
+async def process_commands_async(http_request):
+    """Async /process-commands endpoint."""
+    try:
+        items, timeout, error = parse_batch_request(await read_json_body(http_request), CONFIG['batch_max_items'])
+        if error:
+            return JSONResponse({
+                "success": False,
+                "error": error
+            }, status_code=400)
+        
+        deadline = RequestDeadline(timeout)
+        results = [None] * len(items)
+        tasks = {}
+        for index, (command, context) in enumerate(items):
+            if command is None:
+                results[index] = batch_item_error(None, "Missing 'command' in item")
+            else:
+                tasks[asyncio.ensure_future(process_smart_command_async(command, context, deadline))] = index
+        
+        if tasks:
+            await asyncio.wait(tasks, timeout=deadline.remaining())
+        deadline.cancel()
+        for task, index in tasks.items():
+            command = items[index][0]
+            if not task.done():
+                task.cancel()
+                results[index] = batch_item_error(command, "Timed out")
+            elif task.exception():
+                results[index] = batch_item_error(command, str(task.exception()))
+            else:
+                results[index] = task.result()
+        
+        return JSONResponse(build_batch_response(results))
+    
+    except Exception as e:
+        logger.error(f"Error in process_commands endpoint: {e}")
+        return JSONResponse({
+            "success": False,
+            "error": str(e)
+        }, status_code=500)
+
+
+@accounted_async('suggest_error_fix')
+async def suggest_error_fix_async(http_request):
+    """Async /suggest-error-fix endpoint."""
+    try:
+        data = await read_json_body(http_request)
+        
+        if not data:
+            return JSONResponse({
+                "success": False,
+                "error": "Missing request body"
+            }, status_code=400)
+        
+        original_command = data.get('original_command', '')
+        error_message = data.get('error_message', '')
+        command_output = data.get('command_output', '')
+        
+        if not original_command:
+            return JSONResponse({
+                "success": False,
+                "error": "Missing 'original_command' in request body"
+            }, status_code=400)
+        
+        scope = usage_scope.get()
+        if usage_ledger.over_quota(scope):
+            return JSONResponse(quota_exceeded_body(scope), status_code=429)
+        
+        user_prompt = build_error_fix_prompt(original_command, error_message, command_output)
+        deadline = RequestDeadline(CONFIG['request_timeout'])
+        
+        stream_mode = get_stream_mode(
+            data, http_request.query_params.get('stream'), http_request.headers.get('accept', '')
+        )
+        if stream_mode:
+            return StreamingResponse(
+                stream_error_fix_async(user_prompt, original_command, error_message, stream_mode, deadline),
+                media_type=STREAM_MIMETYPES[stream_mode],
+                headers=STREAM_HEADERS,
+            )
+        
+        suggestion = await call_claude_api_async(user_prompt, custom_system_prompt=ERROR_FIX_SYSTEM_PROMPT,
+                                                 deadline=deadline, task='error_fix')
+        
+        body, status = build_error_fix_response(suggestion, original_command, error_message)
+        return JSONResponse(body, status_code=status)
+    
+    except Exception as e:
+        logger.error(f"Error in suggest_error_fix endpoint: {e}")
+        return JSONResponse({
+            "success": False,
+            "error": str(e)
+        }, status_code=500)
+
+
+class ListenerDispatcher:
+    """Hand each ASGI connection to the app of the listener whose port accepted it."""
+
+    def __init__(self, apps: Dict[str, Any]):
+        self.apps = apps
+
+    async def __call__(self, scope, receive, send):
+        server = scope.get('server')
+        listener = listener_for_port(server[1] if server else None)
+        if scope['type'] == 'http':
+            metrics.inc("relay_http_requests_total", listener=listener)
+        await self.apps[listener](scope, receive, send)
+
+
+def negotiated(handler, endpoint: str):
+    """Wrap a native route so its JSON replies honor the compact formats (see COMPACT RESPONSES)."""
+    fields = COMPACT_FIELDS.get(endpoint)
+    if not fields:
+        return handler
+    
+    async def wrapper(http_request):
+        response = await handler(http_request)
+        if not isinstance(response, JSONResponse):
+            return response
+        try:
+            data = await http_request.json()
+        except Exception:
+            data = None
+        response_format = get_response_format(
+            data, http_request.query_params.get('format'), http_request.headers.get('accept', '')
+        )
+        if response_format == "json":
+            return response
+        headers = {key: value for key, value in response.headers.items()
+                   if key not in ('content-length', 'content-type')}
+        return ASGIResponse(
+            encode_compact(json.loads(response.body), fields, response_format),
+            status_code=response.status_code,
+            headers=headers,
+            media_type=RESPONSE_MIMETYPES[response_format],
+        )
+    
+    return wrapper
+
+
+def create_asgi_app(listener: str, wsgi_app) -> 'Starlette':
+    """Build the ASGI application for a listener ('local' or 'cloud').
+    
+    Native routes are filtered by the listener policy; the mounted Flask app
+    enforces it in enforce_listener_policy. wsgi_app is shared by all listeners.
+    """
+    cors = [Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])]
+    routes = [
+        Route(path, negotiated(handler, name), methods=['POST'], name=name, middleware=cors)
+        for path, handler, name in (
+            ('/process-command', process_command_async, 'process_command'),
+            ('/process-commands', process_commands_async, 'process_commands'),
+            ('/suggest-error-fix', suggest_error_fix_async, 'suggest_error_fix'),
+            ('/auth/poll', poll_device_authorization_async, 'poll_device_authorization'),
+        )
+        if listener_allows(listener, name)
+    ]
+    routes.append(Mount('/', app=wsgi_app))
+    return Starlette(routes=routes)
+
+
+def bind_listener_socket(host: str, port: int) -> socket.socket:
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    return socket.create_server((host, port), family=family, backlog=2048)
+
+
+def run_asgi_server():
+    """Serve every listener from one uvicorn server until SIGTERM or SIGINT."""
+    async def serve():
+        wsgi_app = WSGIMiddleware(app, workers=CONFIG['http_workers'])
+        listeners = configured_listeners()
+        dispatcher = ListenerDispatcher({name: create_asgi_app(name, wsgi_app) for name, _ in listeners})
+        sockets = [bind_listener_socket(CONFIG['host'], port) for _, port in listeners]
+        server = uvicorn.Server(uvicorn.Config(
+            dispatcher,
+            log_level='info',
+            timeout_graceful_shutdown=CONFIG['shutdown_grace'],
+        ))
+        for backend in active_backends():
+            asyncio.get_running_loop().create_task(
+                backend.async_http.warm(backend.url, CONFIG['api_prewarm_connections'])
+            )
+        try:
+            await server.serve(sockets=sockets)
+        finally:
+            for backend in llm_backends.values():
+                await backend.async_http.aclose()
+    
+    asyncio.run(serve())
+    session_store.close()
+    authorization_store.close()
+    usage_ledger.close()
+
+
+# ============================================================================
+# THREADED SERVING MODE
+# ============================================================================
+# All listener sockets are watched by one accept loop and every request runs
+# on one worker pool, so the local and cloud ports share capacity, metrics
+# and shutdown.
+
+class RelayRequestHandler(WSGIRequestHandler):
+    """One request per connection, so an idle keep-alive client never pins a worker."""
+    protocol_version = "HTTP/1.0"
+
+
+class ListenerSocket(BaseWSGIServer):
+    """A bound listener that hands accepted connections to its RelayServer."""
+    multithread = True
+
+    def __init__(self, name: str, host: str, port: int, wsgi_app, relay: 'RelayServer'):
+        super().__init__(host, port, wsgi_app, handler=RelayRequestHandler)
+        self.listener = name
+        self.relay = relay
+
+    def process_request(self, request, client_address):
+        self.relay.dispatch(self, request, client_address)
+
+
+class RelayServer:
+    """Serve several listeners from one accept loop and one HTTP worker pool.
+    
+    stop() only flags the loop, so it is safe as a signal handler; drain()
+    then closes the sockets and waits for in-flight requests.
+    """
+
+    def __init__(self, wsgi_app, host: str, listeners: list, workers: int):
+        self.workers = workers
+        self.in_flight = 0
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='http')
+        self._idle = threading.Condition()
+        self._stopping = threading.Event()
+        self.sockets = [ListenerSocket(name, host, port, wsgi_app, self) for name, port in listeners]
+
+    def dispatch(self, listener: ListenerSocket, request, client_address):
+        with self._idle:
+            self.in_flight += 1
+        metrics.inc("relay_http_requests_total", listener=listener.listener)
+        self._pool.submit(self._handle, listener, request, client_address)
+
+    def _handle(self, listener: ListenerSocket, request, client_address):
+        try:
+            listener.finish_request(request, client_address)
+        except Exception:
+            listener.handle_error(request, client_address)
+        finally:
+            listener.shutdown_request(request)
+            with self._idle:
+                self.in_flight -= 1
+                if not self.in_flight:
+                    self._idle.notify_all()
+
+    def serve_forever(self, poll_interval: float = 0.5):
+        with selectors.DefaultSelector() as selector:
+            for listener in self.sockets:
+                selector.register(listener, selectors.EVENT_READ)
+            while not self._stopping.is_set():
+                for key, _ in selector.select(poll_interval):
+                    key.fileobj._handle_request_noblock()
+
+    def stop(self, *_):
+        self._stopping.set()
+
+    def drain(self, grace: float) -> bool:
+        """Stop accepting, then wait up to grace seconds; True when every request finished."""
+        for listener in self.sockets:
+            listener.server_close()
+        deadline = time.monotonic() + grace
+        with self._idle:
+            while self.in_flight and deadline > time.monotonic():
+                self._idle.wait(deadline - time.monotonic())
+            drained = not self.in_flight
+        self._pool.shutdown(wait=drained, cancel_futures=True)
+        return drained
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "listeners": {listener.listener: listener.port for listener in self.sockets},
+            "workers": self.workers,
+            "in_flight": self.in_flight,
+            "stopping": self._stopping.is_set(),
+        }
+
+
+http_server = None  # RelayServer while serving in threaded mode
+
+
+def run_threaded_server():
+    """Serve every listener from one process until SIGTERM or SIGINT, then drain."""
+    global http_server
+    # Open upstream connections in the background so the first request skips TCP+TLS setup
+    for backend in active_backends():
+        threading.Thread(
+            target=backend.http.warm,
+            args=(backend.url, CONFIG['api_prewarm_connections']),
+            daemon=True,
+        ).start()
+    
+    http_server = RelayServer(app, CONFIG['host'], configured_listeners(), CONFIG['http_workers'])
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, http_server.stop)
+    for listener in http_server.sockets:
+        logger.info(f"Listening on {CONFIG['host']}:{listener.port} ({listener.listener})")
+    
+    http_server.serve_forever()
+    logger.info(f"Shutting down, waiting up to {CONFIG['shutdown_grace']:g}s for "
+                f"{http_server.in_flight} in-flight requests")
+    if not http_server.drain(CONFIG['shutdown_grace']):
+        logger.warning(f"Shutdown grace expired with {http_server.in_flight} requests still running")
+    session_store.close()
+    authorization_store.close()
+    usage_ledger.close()
+
+
 if __name__ == '__main__':
     # Load knowledge base
     load_knowledge_base()
+    if CONFIG['knowledge_reload_interval'] > 0:
+        KnowledgeWatcher(CONFIG['knowledge_base_path'], CONFIG['knowledge_reload_interval']).start()
+    if usage_ledger.store and CONFIG['usage_flush_interval'] > 0:
+        UsageFlusher(usage_ledger, CONFIG['usage_flush_interval']).start()
     
     # Check configuration
-    if not CONFIG['claude_api_key'] and CONFIG['claude_mode'] == 'anthropic':
-        logger.warning("Claude API key not configured. Set CLAUDE_API_KEY environment variable.")
+    for task, order in LLM_TASK_BACKENDS.items():
+        if 'anthropic' in order and not CONFIG['claude_api_key']:
+            logger.warning(f"Claude API key not configured for {task}. Set CLAUDE_API_KEY environment variable.")
+        if not backends_for(task):
+            logger.warning(f"No usable LLM backend for {task} (order: {', '.join(order) or 'none'})")
+    
+    if CONFIG['server_mode'] == 'asgi' and not ASGI_AVAILABLE:
+        logger.error("asgi mode requires starlette, uvicorn, httpx and a2wsgi - falling back to threaded mode")
+        CONFIG['server_mode'] = 'threaded'
     
     logger.info(f"Starting Claude Code Relay Node on {CONFIG['host']}:{CONFIG['port']}")
     if CONFIG['enable_cloud']:
         logger.info(f"Cloud access enabled on port {CONFIG['cloud_port']}")
     logger.info(f"Mode: {CONFIG['claude_mode']}")
+    for task, order in LLM_TASK_BACKENDS.items():
+        logger.info(f"LLM backends for {task}: {' -> '.join(order)}")
+    logger.info(f"Server: {CONFIG['server_mode']}")
     logger.info(f"Max workers: {CONFIG['max_workers']}")
     
     # Start main service
-    if CONFIG['enable_cloud']:
-        # Start cloud server on separate port
-        import threading
-        cloud_app = Flask(__name__)
-        CORS(cloud_app)
-        
-        # Copy routes to cloud app
-        cloud_app.add_url_rule('/health', 'health_check', health_check, methods=['GET'])
-        cloud_app.add_url_rule('/process-command', 'process_command', process_command, methods=['POST'])
-        cloud_app.add_url_rule('/suggest-error-fix', 'suggest_error_fix', suggest_error_fix, methods=['POST'])
-        cloud_app.add_url_rule('/handshake', 'handshake', handshake, methods=['POST'])
-        cloud_app.add_url_rule('/auth/request', 'request_device_authorization', request_device_authorization, methods=['POST'])
-        cloud_app.add_url_rule('/auth/<device_code>', 'device_authorization_page', device_authorization_page, methods=['GET', 'POST'])
-        cloud_app.add_url_rule('/auth/poll', 'poll_device_authorization', poll_device_authorization, methods=['POST'])
-        
-        def run_cloud_server():
-            cloud_app.run(
-                host=CONFIG['host'],
-                port=CONFIG['cloud_port'],
-                threaded=True,
-                debug=False
-            )
-        
-        cloud_thread = threading.Thread(target=run_cloud_server, daemon=True)
-        cloud_thread.start()
-        logger.info(f"Cloud server started on port {CONFIG['cloud_port']}")
-    
-    app.run(
-        host=CONFIG['host'],
-        port=CONFIG['port'],
-        threaded=True,
-        debug=False
-    )
-
+    if CONFIG['server_mode'] == 'asgi':
+        run_asgi_server()
+    else:
+        run_threaded_server()
@@ -0,0 +1,110 @@
+"""
+Compact reply encodings shared by claude-relay-node.py and relay-service/
+===========================================================================
+RouterOS scripts can ask for a reply that is cheaper to parse than JSON,
+by Accept header or a format parameter (body or query string):
+  kv  - one key=value line per field; a repeated key continues a multi-line
+        value and list items use list.index.field keys
+  dsv - tab-separated header row and value rows for :deserialize from=dsv
+        (one row per item for list replies)
+
+Each service keeps its own per-endpoint field table. A table entry is a
+tuple of field names; a (name, fields) pair describes a list of items, with
+fields None to keep every key of the items. Only those fields are sent.
+"""
+
+import csv
+import io
+from typing import Dict, Optional
+
+RESPONSE_MIMETYPES = {
+    "kv": "text/plain; charset=utf-8",
+    "dsv": "text/tab-separated-values; charset=utf-8",
+}
+
+
+def get_response_format(data: Optional[Dict], query_value: Optional[str], accept: str) -> str:
+    """Pick the reply encoding: 'json' (default), 'kv' or 'dsv'."""
+    value = data.get('format') if isinstance(data, dict) else None
+    value = str(value or query_value or "").lower()
+    if value in RESPONSE_MIMETYPES or value == "json":
+        return value
+    for name, mimetype in RESPONSE_MIMETYPES.items():
+        if mimetype.split(";")[0] in accept:
+            return name
+    return "json"
+
+
+def compact_value(value) -> str:
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+
+def item_fields(items: list, fields: Optional[tuple]) -> tuple:
+    """Fields of list items, in first-seen order when not fixed."""
+    if fields is not None:
+        return fields
+    return tuple(dict.fromkeys(key for item in items for key in item))
+
+
+def encode_kv(body: Dict, fields: tuple, prefix: str = "") -> list:
+    """Return the key=value lines of body restricted to fields."""
+    lines = []
+    for field in fields:
+        if isinstance(field, tuple):
+            name, names = field
+            items = body.get(name)
+            if not isinstance(items, list):
+                continue
+            for index, item in enumerate(items):
+                if isinstance(item, dict):
+                    lines.extend(encode_kv(item, item_fields([item], names), f"{prefix}{name}.{index}."))
+            continue
+        value = body.get(field)
+        if value is None:
+            continue
+        for line in compact_value(value).replace("\r", "").split("\n"):
+            lines.append(f"{prefix}{field}={line}")
+    return lines
+
+
+def encode_dsv(body: Dict, fields: tuple) -> str:
+    """Tab-separated header and rows; list replies get one row per item."""
+    rows, columns = [body], [field for field in fields if not isinstance(field, tuple)]
+    for field in fields:
+        if isinstance(field, tuple) and isinstance(body.get(field[0]), list):
+            rows = [row for row in body[field[0]] if isinstance(row, dict)]
+            columns = item_fields(rows, field[1])
+    columns = [column for column in columns if any(row.get(column) is not None for row in rows)]
+
+    out = io.StringIO()
+    writer = csv.writer(out, delimiter="\t", lineterminator="\n")
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow(["" if row.get(column) is None else compact_value(row[column]) for column in columns])
+    return out.getvalue()
+
+
+def encode_compact(body: Dict, fields: tuple, response_format: str) -> str:
+    if response_format == "dsv":
+        return encode_dsv(body, fields)
+    return "\n".join(encode_kv(body, fields)) + "\n"
+
+
+def negotiate_flask_response(response, request, fields: Optional[tuple]):
+    """Re-encode a Flask JSON reply when the request asked for a compact format.
+
+    Meant for an app.after_request hook; fields is the table entry of the
+    request's endpoint (None leaves the reply alone).
+    """
+    if not fields or response.mimetype != 'application/json':
+        return response
+    response_format = get_response_format(
+        request.get_json(silent=True), request.args.get('format'), request.headers.get('Accept', '')
+    )
+    if response_format == "json":
+        return response
+    response.set_data(encode_compact(response.get_json(), fields, response_format))
+    response.content_type = RESPONSE_MIMETYPES[response_format]
+    return response
@@ -9,6 +9,7 @@ Author: Phenix | Crafted with love & frustration
 """
 
 import os
+import sys
 import json
 import logging
 import hashlib
@@ -21,6 +22,10 @@ from flask import Flask, request, jsonify
 from cryptography.fernet import Fernet
 import routeros_api
 
+# compact_responses.py is shared with claude-relay-node.py one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from compact_responses import negotiate_flask_response
+
 # ============================================================================
 # CONFIGURATION
 # ============================================================================
@@ -390,6 +395,36 @@ encryption = EncryptionManager()
 router_manager = RouterManager(encryption)
 
 
+# ============================================================================
+# COMPACT RESPONSES
+# ============================================================================
+# RouterOS scripts can ask for kv or dsv replies instead of JSON; the
+# encoders live in ../compact_responses.py, shared with claude-relay-node.py.
+
+# Fields of compact replies per endpoint; a (name, fields) pair describes a
+# list of items, with fields None to keep every key of the items
+COMPACT_FIELDS = {
+  'health_check': ('status', 'routers_registered'),
+  'list_routers': ('success', 'count', 'error',
+                   ('routers', ('name', 'host', 'online', 'description'))),
+  'add_router': ('success', 'name', 'status', 'error'),
+  'remove_router': ('success', 'name', 'status', 'error'),
+  'get_router_status': ('success', 'router', 'online', 'identity', 'version', 'uptime',
+                        'cpu_load', 'memory_used', 'error'),
+  'execute_command': ('success', 'router', 'elapsed_ms', 'error', ('result', None)),
+  'execute_on_all': ('success', 'total', 'successful', 'failed', 'error',
+                     ('results', ('router', 'success', 'elapsed_ms', 'error'))),
+  'get_all_status': ('success', 'total', 'online', 'offline', 'error',
+                     ('routers', ('router', 'online', 'cpu_load', 'memory_used', 'error'))),
+}
+
+
+@app.after_request
+def negotiate_response_format(response):
+  """Re-encode JSON replies when a compact format was asked for."""
+  return negotiate_flask_response(response, request, COMPACT_FIELDS.get(request.endpoint))
+
+
 # ============================================================================
 # API ENDPOINTS
 # ============================================================================
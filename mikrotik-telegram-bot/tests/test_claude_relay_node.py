@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Tests for claude-relay-node.py against a local Messages API stub.
+
+The node is loaded from its file (the hyphenated name rules out a plain
+import) with CLAUDE_API_URL pointing at a stub that records request bodies
+and answers every call with a fixed translation.
+
+Usage:
+    python3 -m unittest discover -s tests
+"""
+
+import importlib.util
+import json
+import os
+import threading
+import unittest
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+NODE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+NODE_PATH = os.path.join(NODE_DIR, 'claude-relay-node.py')
+KNOWLEDGE_PATH = os.path.join(NODE_DIR, 'claude-relay-knowledge.json')
+
+STUB_REPLY = "/ip neighbor print"
+
+
+class MessagesStub(BaseHTTPRequestHandler):
+    """Records POSTed bodies on the server and answers with STUB_REPLY."""
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        self.server.bodies.append(body)
+        reply = json.dumps({
+            "content": [{"type": "text", "text": STUB_REPLY}],
+            "usage": {"input_tokens": 10, "output_tokens": 5},
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+    def do_HEAD(self):
+        self.send_response(405)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+stub = None
+node = None
+
+
+def setUpModule():
+    global stub, node
+    stub = ThreadingHTTPServer(('127.0.0.1', 0), MessagesStub)
+    stub.bodies = []
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    os.environ.update({
+        'CLAUDE_API_KEY': 'test-key',
+        'CLAUDE_API_URL': f"http://127.0.0.1:{stub.server_port}/v1/messages",
+        'CLAUDE_MODE': 'anthropic',
+        'USAGE_STORE_PATH': '',
+        'AUTH_STORE_PATH': '',
+        'HEDGE_ENABLED': 'false',
+        'PROMPT_RETRIEVAL_MIN_ENTRIES': '0',
+    })
+    spec = importlib.util.spec_from_file_location('claude_relay_node', NODE_PATH)
+    node = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(node)
+
+
+def tearDownModule():
+    stub.shutdown()
+    stub.server_close()
+
+
+def shipped_knowledge():
+    with open(KNOWLEDGE_PATH, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+class PayloadTest(unittest.TestCase):
+    """Shape of the Messages API payload and reuse of the system prompt."""
+
+    def setUp(self):
+        node.install_knowledge(shipped_knowledge(), "test")
+        stub.bodies.clear()
+
+    def test_system_block_carries_cache_control(self):
+        self.assertEqual(node.call_claude_api("list neighbors"), STUB_REPLY)
+        body = stub.bodies[-1]
+        self.assertEqual(body["model"], node.CONFIG['claude_model'])
+        self.assertEqual(len(body["system"]), 1)
+        self.assertEqual(body["system"][0]["type"], "text")
+        self.assertEqual(body["system"][0]["cache_control"], {"type": "ephemeral"})
+        self.assertEqual(body["messages"][0]["role"], "user")
+
+    def test_system_prompt_is_memoized_per_knowledge_version(self):
+        first = node.build_system_prompt()
+        self.assertIs(node.build_system_prompt(), first)
+        node.call_claude_api("list neighbors")
+        node.call_claude_api("show bridges")
+        self.assertEqual(stub.bodies[0]["system"], stub.bodies[1]["system"])
+        self.assertEqual(stub.bodies[0]["system"][0]["text"], first)
+
+    def test_system_prompt_is_rebuilt_after_reload(self):
+        before = node.build_system_prompt()
+        version = node.current_knowledge().version
+        knowledge = shipped_knowledge()
+        knowledge["common_operations"]["show_neighbors"] = "/ip neighbor print"
+        node.install_knowledge(knowledge, "test reload")
+        self.assertEqual(node.current_knowledge().version, version + 1)
+        after = node.build_system_prompt()
+        self.assertIsNot(after, before)
+        self.assertIn("/ip neighbor print", after)
+        node.call_claude_api("list neighbors")
+        self.assertEqual(stub.bodies[-1]["system"][0]["text"], after)
+
+
+class ValidatorTest(unittest.TestCase):
+    """Dangerous commands hidden in script bodies stored for later."""
+
+    def setUp(self):
+        node.install_knowledge(shipped_knowledge(), "test")
+
+    def assertBlocked(self, command):
+        is_valid, error = node.validate_routeros_command(command)
+        self.assertFalse(is_valid, command)
+        return error
+
+    def test_script_bodies_are_checked(self):
+        self.assertBlocked('/system script add name=x source="/system reset-configuration"')
+        self.assertBlocked('/system script add name=x source="/ip address print\\n/sys reset-configuration"')
+        self.assertBlocked('/system scheduler add name=s interval=1d on-event="/system reboot"')
+        self.assertBlocked('/tool netwatch add host=10.0.0.1 down-script="/file remove [find]"')
+        self.assertBlocked('/system script add name=x source=":execute \\"/system reboot\\""')
+
+    def test_harmless_script_bodies_pass(self):
+        for command in ('/system script add name=x source="/ip address print"',
+                        '/system scheduler add name=s interval=1d on-event=backup'):
+            self.assertTrue(node.validate_routeros_command(command)[0], command)
+
+
+class SessionResolutionTest(unittest.TestCase):
+    """Session history only bypasses local answers for follow-up questions."""
+
+    def setUp(self):
+        node.install_knowledge(shipped_knowledge(), "test")
+        self.client = node.app.test_client()
+        stub.bodies.clear()
+
+    def translate(self, command, router="core-rtr"):
+        response = self.client.post('/process-command', json={"command": command, "router_id": router})
+        self.assertEqual(response.status_code, 200)
+        return response.get_json()
+
+    def test_repeated_command_from_named_router_stays_local(self):
+        sources = [self.translate("show dhcp leases")["source"] for _ in range(3)]
+        self.assertNotIn("llm", sources)
+        self.assertEqual(stub.bodies, [])
+
+    def test_repeated_llm_translation_is_cached(self):
+        self.assertEqual(self.translate("list neighbors please")["source"], "llm")
+        self.assertEqual(self.translate("list neighbors please")["source"], "cache")
+        self.assertEqual(len(stub.bodies), 1)
+
+    def test_follow_up_goes_to_llm_with_history(self):
+        self.translate("show dhcp leases", router="edge-rtr")
+        result = self.translate("show the second one", router="edge-rtr")
+        self.assertEqual(result["source"], "llm")
+        self.assertIn("show dhcp leases", stub.bodies[-1]["messages"][0]["content"])
+
+
+class StreamProbeTest(unittest.TestCase):
+    """A half_open probe that never reaches the backend is given back."""
+
+    def setUp(self):
+        self.breaker = node.backends_for('error_fix')[0].breaker
+        self.breaker.state, self.breaker.probing = "half_open", False
+
+    def tearDown(self):
+        self.breaker.state, self.breaker.probing, self.breaker.failures = "closed", False, 0
+
+    def test_probe_released_when_scheduler_refuses(self):
+        with mock.patch.object(node.outbound_scheduler, 'acquire', return_value=False):
+            with self.assertRaises(node.requests.exceptions.Timeout):
+                list(node.stream_claude_api("fix it", task='error_fix'))
+        self.assertFalse(self.breaker.probing)
+        self.assertTrue(self.breaker.available())
+
+    def test_expired_deadline_claims_no_probe(self):
+        deadline = node.RequestDeadline(5)
+        deadline.cancel()
+        with self.assertRaises(node.DeadlineExpired):
+            list(node.stream_claude_api("fix it", task='error_fix', deadline=deadline))
+        self.assertFalse(self.breaker.probing)
+
+
+if __name__ == '__main__':
+    unittest.main()